@@ -1,12 +1,18 @@
 #!/usr/bin/python3
 
+import argparse
 import boto3
-from bs4 import BeautifulSoup
 import collections
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from configparser import ConfigParser
 from datetime import date
 from dateutil.parser import parse
-from functools import reduce
+import fcntl
+from functools import partial, reduce
+import glob
+import io
+import itertools
 from json import dumps
 import logging
 import logging.config
@@ -16,13 +22,17 @@ import pathlib
 import pysolr
 import re
 import requests
+import shutil
+import socket
 import subprocess
 import sys
+import threading
+import time
 from tinydb import TinyDB, Query
 import urllib.parse
 import validators
 
-from util import DateCleanerAndFaceter, HyperlinkRelevanceHeuristicSorter
+from util import CircuitBreaker, CollectionScheduler, DateCleanerAndFaceter, FileLayout, HostHealth, HostUnavailableError, HyperlinkRelevanceScorer, LeaseKeeper, PackedRecordStore, ResyncAction, RetryQueue, SitemapFetcher, SolrCsvUpdateWriter, SolrDocument, SolrDocumentArchive, SolrJsonUpdateWriter, SolrWriter, SyncHistory, ThumbnailDeletionQueue, ThumbnailJobQueue, ThumbnailProbeStats, ThumbnailProcessor, ThumbnailRules, ThumbnailStore, UrlClassifier, WorkQueue, backoffDelay, discoverCollections, metadataMapper, planChanges, resyncActions, urlClassifier
 
 '''
 # TODO: move everything inside class
@@ -44,114 +54,122 @@ logger = logging.getLogger('root')
 
 s3 = boto3.Session(profile_name=config['S3']['profile_name']).client('s3')
 
-# map from DC tag name to Solr field name
-tagNameToColumn = {
-    'title': 'title_keyword',
-    'creator': 'creator_keyword',
-    'subject': 'subject_keyword',
-    'description': 'description_keyword',
-    'publisher': 'publisher_keyword',
-    'contributor': 'contributor_keyword',
-    'date': 'date_keyword',
-    'type': 'type_keyword',
-    'format': 'format_keyword',
-    'identifier': 'identifier_keyword',
-    'source': 'source_keyword',
-    'language': 'language_keyword',
-    'relation': 'relation_keyword',
-    'coverage': 'coverage_keyword',
-    'rights': 'rights_keyword'
+# whether or not to index a DateRangeField value for each interval of years in a record
+indexDateRanges = config['Solr'].getboolean('date_range', False)
+
+# stop sending requests to services that keep failing
+breakers = {
+    'solr': CircuitBreaker(failureThreshold=5, resetTimeout=60.0),
+    's3': CircuitBreaker(failureThreshold=5, resetTimeout=60.0)
     }
 
-# list of BeautifulSoup filters to pass to the find_all function, in order of priority to check
-bsFilters = [
-    'identifier.thumbnail',
-    'identifier',
-    re.compile('identifier.*')
-    ]
+# response times and failures of the hosts that thumbnails are requested from, during this run
+hostHealth = HostHealth(
+    failureThreshold=config['Thumbnails'].getint('failure_threshold', 5),
+    defaultTimeout=config['Thumbnails'].getfloat('timeout', 30.0),
+    minTimeout=config['Thumbnails'].getfloat('min_timeout', 2.0),
+    maxTimeout=config['Thumbnails'].getfloat('max_timeout', 60.0))
+
+# shrinks and re-encodes thumbnails before they are uploaded, if Pillow is installed
+thumbnailProcessor = None
+if config['Thumbnails'].getboolean('process', True):
+    if ThumbnailProcessor.available():
+        thumbnailProcessor = ThumbnailProcessor(
+            maxWidth=config['Thumbnails'].getint('max_width', 400),
+            maxHeight=config['Thumbnails'].getint('max_height', 400),
+            format=config['Thumbnails'].get('format', 'JPEG'),
+            quality=config['Thumbnails'].getint('quality', 85))
+    else:
+        logger.warning('Pillow is not installed, so thumbnails will be uploaded without being processed')
 
+# which content-addressed thumbnail each record refers to
+thumbnailStore = ThumbnailStore(os.path.abspath(os.path.expanduser(config['Thumbnails'].get('index_path', '~/thumbnails.json'))))
 
-def addValuePossiblyDuplicateKey(key, value, dic):
-    '''Adds a key-value pair to a dictionary that may already have a value for that key. If that's the case, put both values into a list. This is how pysolr wants us to represent duplicate fields.'''
+# outcomes of looking for thumbnails during this run, per host
+thumbnailStats = ThumbnailProbeStats()
 
-    if key in dic:
-        if isinstance(dic[key], collections.MutableSequence):
-            dic[key].append(value)
-        else:
-            dic[key] = [dic[key], value]
-    else:
-        dic[key] = value
+# PackedRecordStores that have been opened, by path
+recordPacks = {}
+recordPacksLock = threading.Lock()
 
+# ThumbnailJobQueues that have been opened, by path (see thumbnailJobs)
+thumbnailJobQueues = {}
+thumbnailJobQueuesLock = threading.Lock()
 
-def createSolrDoc(identifier, rowInDB, thumbnailurl, tags, hostHeuristic):
-    '''Maps a Dublin Core record to a Solr document to be indexed.'''
+# HyperlinkRelevanceScorers by collection (see relevanceScorer)
+relevanceScorers = {}
 
-    doc = {
-        'id': identifier,
-        'collectionKey': rowInDB['collection_key'],
-        'collectionName': rowInDB['collection_name'],
-        'institutionKey': rowInDB['institution_key'],
-        'institutionName': rowInDB['institution_name']
-    }
-    if thumbnailurl is not None:
-        doc['thumbnail_url'] = thumbnailurl
 
-    years = set()
+def createSolrDoc(record, rowInDB, thumbnailurl, links=None):
+    '''
+    Maps a record (a MappedRecord, see MetadataMapper) to a Solr document to be indexed.
 
-    # TODO: change to set
-    hyperlinks = []
+    links - the landing pages of the record, most relevant first, if they've already been ranked (see relevanceScorer)
+    '''
 
-    for tag in tags:
+    identifier = record.identifier
+    doc = SolrDocument(
+        id=identifier,
+        collectionKey=rowInDB['collection_key'],
+        collectionName=rowInDB['collection_name'],
+        institutionKey=rowInDB['institution_key'],
+        institutionName=rowInDB['institution_name']
+        )
+    if thumbnailurl is not None:
+        doc.thumbnail_url = thumbnailurl
 
-        # ignore newlines and other whitespace in the list of tags
-        if tag.name is None:
-            continue
+    for field, values in record.fields.items():
+        for value in values:
+            doc.add(field, value)
 
-        try:
-            # only process Dublin Core fields (no qualified DC)
-            name = tagNameToColumn[tag.name]
-        except KeyError as e:
-            continue
-        else:
-            value = tag.string
-            addValuePossiblyDuplicateKey(name, value, doc)
+    titles = record.fields.get('title_keyword', [])
+    if len(titles) > 0:
+        doc.first_title = titles[0]
 
-            # build up a set of all the years included in the metadata
-            if name == tagNameToColumn['date']:
-                years.add(value)
-            elif name == tagNameToColumn['title'] and 'first_title' not in doc:
-                doc['first_title'] = value
-            elif name == tagNameToColumn['identifier'] and validators.url(value) and os.path.splitext(urllib.parse.urlparse(value).path)[1] not in ['.jpg', '.jpeg', '.png', '.tif', '.tiff']:
-                hyperlinks.append(value)
+    # build up a set of all the years included in the metadata
+    years = set(record.fields.get('date_keyword', []))
+
+    if links is None:
+        links = relevanceScorer(rowInDB).rank(identifier, record.links)
 
     if len(years) > 0:
-        decades = DateCleanerAndFaceter(years).decades()
+        dcf = DateCleanerAndFaceter(years)
+        decades = dcf.decades()
 
         if len(decades) > 0:
-            for decade in decades:
-                addValuePossiblyDuplicateKey('decade', decade, doc)
-            doc['sort_decade'] = min(decades, key=lambda x: int(x))
+            doc.decade = list(decades)
+            doc.sort_decade = min(decades, key=lambda x: int(x))
             logger.debug('years "{}" -> decades "{}"'.format(years, decades))
-    if len(hyperlinks) > 0:
-        if isOaiIdentifier(identifier):
-            ident = identifier.split(sep=':', maxsplit=2)[2]
-        else:
-            ident = identifier
-
-        heuristics = {
-            'host': hostHeuristic,
-            'identifier': ident
-        }
-        hrhs = HyperlinkRelevanceHeuristicSorter(heuristics, hyperlinks)
-        doc['external_link'] = hrhs.mostRelevant()
 
-        rest = hrhs.rest()
-        if len(rest) > 0:
-            doc['alternate_external_link'] = rest
+        # computed from the same intervals as the decades, for numeric range queries
+        intervals = dcf.intervals()
+        if len(intervals) > 0:
+            doc.year_start = intervals[0][0]
+            doc.year_end = intervals[-1][1]
+            if indexDateRanges:
+                doc.date_range = [DateCleanerAndFaceter.dateRangeValue(interval) for interval in intervals]
+    if len(links) > 0:
+        doc.external_link = links[0]
+        if len(links) > 1:
+            doc.alternate_external_link = links[1:]
 
     return doc
 
 
+def relevanceScorer(rowInDB):
+    '''Return the HyperlinkRelevanceScorer that ranks the landing pages of a collection's records. It's made once per process.'''
+
+    key = (rowInDB['institution_key'], rowInDB['collection_key'], rowInDB['url_map_from'])
+    scorer = relevanceScorers.get(key)
+    if scorer is None:
+        scorer = HyperlinkRelevanceScorer(
+            urllib.parse.urlparse(rowInDB['url_map_from']).netloc,
+            identifier=localIdentifier,
+            kinds=[UrlClassifier.LANDING_PAGE])
+        relevanceScorers[key] = scorer
+    return scorer
+
+
 def isOaiIdentifier(identifier):
     '''Return true if the given identifier follows the syntax specified here: http://www.openarchives.org/OAI/2.0/guidelines-oai-identifier.htm.'''
 
@@ -159,38 +177,63 @@ def isOaiIdentifier(identifier):
     return components[0] == 'oai' and len(components) == 3
 
 
-def findThumbnailUrl(bs, filters):
-    '''Return the URL of the thumbnail for a Dublin Core record. If none exists, return None.
+def localIdentifier(identifier):
+    '''Return the local identifier portion of an OAI identifier, or the identifier itself if it isn't structured that way.'''
 
-    bs - BeautifulSoup representation of the metadata file
-    filters - a list of filters to pass to the find_all function, that denote where a URL might live
+    if isOaiIdentifier(identifier):
+        return identifier.split(sep=':', maxsplit=2)[2]
+    else:
+        return identifier
+
+
+def findThumbnailUrl(candidates, rules=None, identifier=None):
+    '''Return the URL of the thumbnail for a record. If none exists, return None.
+
+    candidates - the possible thumbnail URLs of the record, in order of priority to check (see MetadataMapper)
+    rules - the ThumbnailRules of the collection, which are applied before making any requests
+    identifier - the OAI identifier of the record, used by the URL templates of the rules
+
+    Raises HostUnavailableError if no thumbnail was found, but some URLs weren't checked because their hosts have been failing.
     '''
 
-    checkedUrls = []
-    for f in filters:
-        # search for tags that match the filter (can be regex or string, see )
-        tags = bs.find_all(f)
+    if rules is not None and identifier is not None:
+        for url in rules.fromTemplates(localIdentifier(identifier), identifier):
+            logger.debug('Thumbnail URL from template: {}'.format(url))
+            thumbnailStats.record(url, ThumbnailProbeStats.TEMPLATE)
+            return url
 
-        for tag in tags:
-            possibleUrl = tag.string
-            if validators.url(possibleUrl) and possibleUrl not in checkedUrls:
-                logger.debug('Checking for thumbnail at {}'.format(possibleUrl))
-                # TODO: maybe check path extension before doing get request?
-                #r = requests.get(possibleUrl)
+    unavailableHosts = set()
+    for possibleUrl in candidates:
+        if urlClassifier.classify(possibleUrl).kind == UrlClassifier.INVALID:
+            continue
 
-                resp = makeThumbnailRequest(requests.head, possibleUrl, False, True)
+        # avoid a request if the rules already know the answer
+        verdict = rules.judge(possibleUrl) if rules is not None else None
+        if verdict is True:
+            logger.debug('Thumbnail URL accepted by rule: {}'.format(possibleUrl))
+            thumbnailStats.record(possibleUrl, ThumbnailProbeStats.RULE_ACCEPTED)
+            return possibleUrl
+        elif verdict is False:
+            thumbnailStats.record(possibleUrl, ThumbnailProbeStats.RULE_REJECTED)
+            continue
 
-                if resp is not None:
-                    try:
-                        m = re.search(re.compile('image/(?:jpeg|tiff|png)'), resp.headers['content-type'])
-                        logger.debug('Match: {}'.format(m))
-                        if m is not None:
-                            return resp.url
-                        else:
-                            checkedUrls.append(possibleUrl)
-                    # no content-type
-                    except KeyError:
-                        checkedUrls.append(possibleUrl)
+        logger.debug('Checking for thumbnail at {}'.format(possibleUrl))
+        try:
+            resp = makeThumbnailRequest(requests.head, possibleUrl, False, True)
+        except HostUnavailableError as e:
+            unavailableHosts.update(e.hosts)
+            continue
+
+        if resp is not None:
+            m = re.search(re.compile('image/(?:jpeg|tiff|png)'), resp.headers.get('content-type', ''))
+            logger.debug('Match: {}'.format(m))
+            if m is not None:
+                thumbnailStats.record(possibleUrl, ThumbnailProbeStats.PROBE_HIT)
+                return resp.url
+        thumbnailStats.record(possibleUrl, ThumbnailProbeStats.PROBE_MISS)
+
+    if len(unavailableHosts) > 0:
+        raise HostUnavailableError(unavailableHosts)
     return None
 
 
@@ -198,26 +241,44 @@ def makeThumbnailRequest(fn, url, stream, redirect):
     '''
     Make request to the given URL and handle the response.
 
-    If we can do something with the response, return it, otherwise return None.
+    If we can do something with the response, return it, otherwise return None. Raises HostUnavailableError if the host has been failing.
     '''
+    host = urlClassifier.classify(url).netloc
+
     nTries = 0
     maxTries = 3
     while nTries < maxTries:
+        if not hostHealth.allow(host):
+            logger.debug('Skipping request to {}, which has been failing'.format(host))
+            raise HostUnavailableError([host])
+
         try:
-            r = fn(url, stream=stream, timeout=60, allow_redirects=redirect)
+            start = time.monotonic()
+            r = fn(url, stream=stream, timeout=hostHealth.timeout(host), allow_redirects=redirect)
             r.raise_for_status()
+            hostHealth.success(host, time.monotonic() - start)
             break
         except requests.Timeout as e:
             # try a couple more times, server may be restarting
-            logger.debug('Trying again...')
+            hostHealth.failure(host)
             nTries += 1
+            if nTries < maxTries:
+                delay = backoffDelay(nTries, 1.0, 10.0)
+                logger.debug('Trying again in {:.1f} seconds...'.format(delay))
+                time.sleep(delay)
         except requests.ConnectionError as e:
+            hostHealth.failure(host)
             return None
         except requests.TooManyRedirects as e:
             return None
         except requests.URLRequired as e:
             return None
         except requests.HTTPError as e:
+            # the server is up, but it may be having trouble
+            if e.response is not None and e.response.status_code >= 500:
+                hostHealth.failure(host)
+            else:
+                hostHealth.success(host, time.monotonic() - start)
             return None
         except requests.RequestException as e:
             return None
@@ -229,219 +290,1737 @@ def makeThumbnailRequest(fn, url, stream, redirect):
         return r
 
 
-def getThumbnail(url, recordIdentifier, rowInDB):
-    '''Puts the thumbnail file in its place on the image server, and returns its URL.'''
+def getThumbnail(url, recordIdentifier, rowInDB, retryQueue=None, processPool=None):
+    '''Puts the thumbnail file in its place on the image server, and returns its URL.
+
+    If the upload fails and a RetryQueue is given, the upload is queued to be tried again later, and the URL is returned anyway.
+
+    If thumbnail processing is enabled, the image is shrunk and re-encoded first, in the given process pool if there is one.
+    '''
 
     r = makeThumbnailRequest(requests.get, url, True, True)
     if r is None:
         # disaster has struck
         raise Exception('Thumbnail was available, and now it\'s not: {}'.format(url))
 
+    if thumbnailProcessor is not None:
+        try:
+            if processPool is not None:
+                processed = processPool.submit(thumbnailProcessor.process, r.content).result()
+            else:
+                processed = thumbnailProcessor.process(r.content)
+        except Exception as e:
+            logger.warning('Cannot process thumbnail {}, uploading it as it is: {}'.format(url, e))
+        else:
+            logger.debug('Processed thumbnail {} into {}x{} {}'.format(url, processed.width, processed.height, processed.content_type))
+            return putThumbnail(processed.data, processed.extension, processed.content_type, processed.content_hash, recordIdentifier, rowInDB, retryQueue)
+
     basename = url.split('/')[-1]
     extension = os.path.splitext(basename)[1]
     if extension == '':
         extension = guess_extension(r.headers['content-type'])
         if extension is None:
-            # throw error
             logger.error('Cannot determine file type for {}'.format(url))
-            pass
+            extension = ''
 
-    # used as the local filename too
-    # need to save the file locally with slashes escaped
-    s3Key = urllib.parse.quote(recordIdentifier, safe='')
+    return putThumbnail(r.content, extension, guess_type(url)[0], ThumbnailStore.contentHash(r.content), recordIdentifier, rowInDB, retryQueue)
 
-    # url to the thumbnail needs to be encoded twice
-    s3KeyDoublyEncoded = urllib.parse.quote(s3Key, safe='')
 
-    # should use the same name for S3 object
-    filepath = os.path.join(
-        os.path.abspath(os.path.expanduser(config['S3']['thumbnail_dir'])),
-        rowInDB['institution_key'],
-        rowInDB['collection_key'],
-        s3Key + extension
-        )
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+def putThumbnail(data, extension, contentType, contentHash, recordIdentifier, rowInDB, retryQueue=None):
+    '''
+    Make a record refer to a thumbnail, and return the thumbnail's URL.
+
+    Thumbnails are stored once under a key made from the hash of their contents, so a thumbnail that is shared with other records (e.g., a placeholder image) is only written to disk and uploaded to S3 the first time.
+    '''
 
-    # https://stackoverflow.com/a/16696317
-    with open(filepath, 'wb') as f:
-        logger.info('Saving thumbnail to "{}"'.format(filepath))
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-    logger.debug('Thumbnail written to {}'.format(filepath))
+    objectKey = ThumbnailStore.objectKey(contentHash, extension)
+    filepath = thumbnailLayout().path(objectKey)
+
+    # it has either been uploaded already, or its upload is queued
+    if thumbnailStore.has(objectKey) and os.path.exists(filepath):
+        logger.debug('Thumbnail {} is already stored'.format(objectKey))
+    else:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            logger.info('Saving thumbnail to "{}"'.format(filepath))
+            f.write(data)
+        uploadThumbnailFile(objectKey, filepath, contentType, retryQueue)
+
+    thumbnailStore.assign(recordIdentifier, objectKey, rowInDB['institution_key'], rowInDB['collection_key'])
+    return thumbnailUrlFromKey(objectKey)
+
+
+def uploadThumbnailFile(s3Key, filepath, contentType, retryQueue=None):
+    '''Upload a thumbnail that has been written to disk to S3, and return its URL.'''
 
     # upload to S3
-    s3.put_object(Bucket=config['S3']['bucket'], Key=s3Key, Body=open(filepath, 'rb'), ContentType=guess_type(url)[0])
+    payload = {'key': s3Key, 'filepath': filepath, 'content_type': contentType}
+    if retryQueue is None:
+        uploadThumbnail(payload)
+    elif not breakers['s3'].allow():
+        retryQueue.discard('s3', s3Key)
+        retryQueue.push('s3', 'put', s3Key, payload, 'circuit breaker open')
+    else:
+        try:
+            uploadThumbnail(payload)
+        except Exception as e:
+            logger.error('Something went wrong while trying to upload thumbnail to S3: {}'.format(e))
+            breakers['s3'].failure()
+            retryQueue.discard('s3', s3Key)
+            retryQueue.push('s3', 'put', s3Key, payload, e)
+        else:
+            breakers['s3'].success()
+            retryQueue.discard('s3', s3Key)
 
     # return URL of image
-    thumbnailUrl = urllib.parse.urlunparse(('http', config['S3']['bucket'], s3KeyDoublyEncoded, '', '', ''))
+    thumbnailUrl = thumbnailUrlFromKey(s3Key)
     logger.debug('Thumbnail available at {}'.format(thumbnailUrl))
     return thumbnailUrl
 
 
-def deleteThumbnail(s3Key):
-    s3.delete_object(Bucket=config['S3']['bucket'], Key=s3Key)
+def thumbnailJob(localFile, rowInDB):
+    '''Return the payload of a job that gets the thumbnail of a record in the thumbnail stage, given the path that resync wrote its file to.'''
 
+    return {
+        'institution_key': rowInDB['institution_key'],
+        'collection_key': rowInDB['collection_key'],
+        'file_path_map_to': rowInDB['file_path_map_to'],
+        'local_file': os.fsdecode(localFile),
+        'metadata_format': rowInDB.get('metadata_format', 'oai_dc'),
+        'thumbnail_rules': rowInDB.get('thumbnail_rules')
+        }
 
-def main():
 
-    logger.info('--- STARTING RUN ---')
-    logger.info('')
+def fetchThumbnail(recordIdentifier, payload, rules, retryQueue=None, processPool=None):
+    '''
+    Find, download, and upload the thumbnail of a record, and return its URL. If the record has no thumbnail, or has been deleted since, return None.
+
+    Raises HostUnavailableError if the hosts of the thumbnail have been failing.
+    '''
+
+    if 'file_path_map_to' in payload:
+        # the file may have been moved by migrate-layout since the job was queued
+        localFile = findRecordFile(payload['local_file'], payload)
+    elif os.path.exists(payload['local_file']):
+        localFile = payload['local_file']
+    else:
+        localFile = None
+
+    if localFile is None:
+        return None
+    record = parseRecordFile(localFile, payload)
+    if record is None:
+        return None
+
+    thumbnailUrl = findThumbnailUrl(record.thumbnails, rules, recordIdentifier)
+    if thumbnailUrl is None:
+        return None
+    logger.debug('Found thumbnail URL: {}'.format(thumbnailUrl))
+
+    # the payload has the keys that determine where the thumbnail is stored
+    return getThumbnail(thumbnailUrl, recordIdentifier, payload, retryQueue, processPool)
+
+
+def setThumbnailUrls(solr, retryQueue, results, archive=None):
+    '''
+    Set the thumbnail URLs of Solr documents with a single atomic update, and remove their jobs from the queue.
+
+    results - a list of (job, thumbnail URL) tuples
+    archive - a SolrDocumentArchive to record the updates in, if any
+    '''
+
+    docs = [{'id': job['id'], 'thumbnail_url': thumbnailUrl} for job, thumbnailUrl in results]
+    fieldUpdates = {'thumbnail_url': 'set'}
+
+    sent = False
+    if breakers['solr'].allow():
+        try:
+            solr.add(docs, fieldUpdates=fieldUpdates)
+            sent = True
+            breakers['solr'].success()
+        except Exception as e:
+            logger.error('Something went wrong while trying to send data to Solr: {}'.format(e))
+            breakers['solr'].failure()
+
+    for (job, thumbnailUrl), doc in zip(results, docs):
+        if not sent:
+            # the thumbnail is in place, so only the update has to be tried again
+            retryQueue.discard('solr', doc['id'])
+            retryQueue.push('solr', 'add', doc['id'], {'docs': [doc], 'fieldUpdates': fieldUpdates}, 'cannot set thumbnail URL')
+        thumbnailJobs(retryQueue).succeeded(job)
+        if archive is not None:
+            archive.update(job['payload']['institution_key'], job['payload']['collection_key'], [doc])
+
+
+def thumbnailProcesses():
+    '''Return the configured number of processes that shrink thumbnails, or None to use one per CPU.'''
+
+    processes = config['Thumbnails'].get('processes', '')
+    return int(processes) if processes != '' else None
+
+
+def fetchThumbnails(solr, retryQueue, deletionQueue, workers=8, batchSize=100, processes=None, archive=None):
+    '''
+    Run the thumbnail stage: get the thumbnails of the records in the queue concurrently, and set their URLs on the Solr documents (which have already been indexed) in batches of atomic updates.
+
+    Threads download and upload thumbnails, while a pool of processes (as many as there are CPUs, if `processes` is None) shrinks them, if thumbnail processing is enabled.
+
+    Jobs whose thumbnails can't be fetched because their hosts are unavailable are tried again later. Thumbnails that are no longer used are scheduled for deletion with the given ThumbnailDeletionQueue. The updates are recorded in the SolrDocumentArchive, if one is given.
+    '''
+
+    jobs = thumbnailJobs(retryQueue).due()
+    if len(jobs) == 0:
+        return
+    logger.info('Getting {} thumbnails with {} workers'.format(len(jobs), workers))
+
+    # compile the thumbnail rules of each collection once
+    rules = {}
+    for job in jobs:
+        collection = (job['payload']['institution_key'], job['payload']['collection_key'])
+        if collection not in rules:
+            rules[collection] = ThumbnailRules(job['payload']['thumbnail_rules'])
+
+    processPool = ProcessPoolExecutor(max_workers=processes) if thumbnailProcessor is not None else None
+
+    def fetch(job):
+        collection = (job['payload']['institution_key'], job['payload']['collection_key'])
+        try:
+            return (fetchThumbnail(job['id'], job['payload'], rules[collection], retryQueue, processPool), None)
+        except Exception as e:
+            return (None, e)
+
+    found = 0
+    batch = []
+    replaced = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for job, (thumbnailUrl, error) in zip(jobs, pool.map(fetch, jobs)):
+            if error is not None:
+                if not isinstance(error, HostUnavailableError):
+                    logger.error('Cannot get thumbnail for {}: {}'.format(job['id'], error))
+                thumbnailJobs(retryQueue).failed(job, error)
+            elif thumbnailUrl is None:
+                thumbnailJobs(retryQueue).succeeded(job)
+            else:
+                found += 1
+                batch.append((job, thumbnailUrl))
+                if legacyThumbnailFile(job['id'], job['payload']) is not None:
+                    replaced.append(job)
+                if len(batch) >= batchSize:
+                    setThumbnailUrls(solr, retryQueue, batch, archive)
+                    batch = []
+
+    if processPool is not None:
+        processPool.shutdown()
+
+    if len(batch) > 0:
+        setThumbnailUrls(solr, retryQueue, batch, archive)
+    try:
+        solr.commit()
+    except Exception as e:
+        logger.error('Something went wrong while trying to commit to Solr: {}'.format(e))
+    logger.info('Got {} thumbnails, {} jobs left for later'.format(found, len(thumbnailJobs(retryQueue))))
+
+    # now that Solr documents refer to their new thumbnails, the ones they replaced can go
+    for job in replaced:
+        deletionQueue.delete(thumbnailKey(job['id']), thumbnailDir(job['payload']))
+    sweepThumbnails(deletionQueue)
+
+
+def uploadThumbnail(payload):
+    '''Upload a local thumbnail file to S3.
+
+    payload - a dictionary with the S3 "key", the local "filepath", and the "content_type" of the thumbnail
+    '''
+
+    # the file may have been moved by migrate-layout since the upload was queued
+    with open(thumbnailLayout().locate(payload['filepath']), 'rb') as body:
+        s3.put_object(Bucket=config['S3']['bucket'], Key=payload['key'], Body=body, ContentType=payload['content_type'])
+
+
+def thumbnailKey(recordIdentifier):
+    '''
+    Return the S3 key (and local filename, minus extension) that the thumbnail of a record was stored under before thumbnails were content-addressed. Slashes need to be escaped.
+
+    Thumbnails stored under these keys are still used until they are replaced, and deleted along with their records.
+    '''
+
+    return urllib.parse.quote(recordIdentifier, safe='')
+
+
+def thumbnailUrlFromKey(s3Key):
+    '''Return the public URL of the thumbnail stored under the given S3 key. The key needs to be encoded twice in the URL.'''
+
+    s3KeyDoublyEncoded = urllib.parse.quote(s3Key, safe='')
+    return urllib.parse.urlunparse(('http', config['S3']['bucket'], s3KeyDoublyEncoded, '', '', ''))
+
+
+def thumbnailDir(rowInDB):
+    '''Return the local directory that holds the thumbnails of a collection.'''
+
+    return os.path.join(
+        os.path.abspath(os.path.expanduser(config['S3']['thumbnail_dir'])),
+        rowInDB['institution_key'],
+        rowInDB['collection_key']
+        )
+
+
+def thumbnailObjectDir():
+    '''Return the local directory that holds the content-addressed thumbnails.'''
+
+    return os.path.join(os.path.abspath(os.path.expanduser(config['S3']['thumbnail_dir'])), 'objects')
+
+
+def thumbnailLayout():
+    '''Return the FileLayout of the content-addressed thumbnails on disk.'''
+
+    return FileLayout(thumbnailObjectDir(), config['Layout'].get('thumbnails', 'flat'), config['Layout'].getint('depth', 2))
+
+
+def legacyThumbnailFile(recordIdentifier, rowInDB):
+    '''Return the path of the local copy of a thumbnail stored under the record's own key (see thumbnailKey), or None if there is none.'''
+
+    s3Key = thumbnailKey(recordIdentifier)
+    for filepath in glob.iglob(os.path.join(glob.escape(thumbnailDir(rowInDB)), glob.escape(s3Key) + '.*')):
+        if os.path.splitext(os.path.basename(filepath))[0] == s3Key:
+            return filepath
+    return None
+
+
+def existingThumbnailUrl(recordIdentifier, rowInDB):
+    '''Return the URL of a thumbnail that has already been uploaded for a record, without making any network requests. If there is none, return None.'''
+
+    objectKey = thumbnailStore.get(recordIdentifier)
+    if objectKey is not None:
+        return thumbnailUrlFromKey(objectKey)
+    if legacyThumbnailFile(recordIdentifier, rowInDB) is not None:
+        return thumbnailUrlFromKey(thumbnailKey(recordIdentifier))
+    return None
+
+
+def releaseThumbnail(recordIdentifier, rowInDB, deletionQueue):
+    '''Remove the reference of a deleted record to its thumbnail. The thumbnail itself is deleted by sweepThumbnails once no record refers to it.'''
+
+    thumbnailStore.release(recordIdentifier)
+    if legacyThumbnailFile(recordIdentifier, rowInDB) is not None:
+        deletionQueue.delete(thumbnailKey(recordIdentifier), thumbnailDir(rowInDB))
+
+
+def sweepThumbnails(deletionQueue):
+    '''Delete the thumbnails that no record refers to anymore, and save the thumbnail index.'''
+
+    orphans = thumbnailStore.sweep()
+    layout = thumbnailLayout()
+    for objectKey in orphans:
+        deletionQueue.delete(objectKey, os.path.dirname(layout.path(objectKey)))
+    if len(orphans) > 0:
+        logger.info('Deleting {} thumbnails that are no longer used'.format(len(orphans)))
+    thumbnailStore.save()
+
+
+def identifierFromResourceUrl(url):
+    '''Return the value of the "identifier" query parameter of an OAI-PMH GetRecord URL, or None if it has none.'''
+
+    values = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('identifier')
+    return values[0] if values else None
+
+
+def collectionDir(rowInDB):
+    '''Return the local directory that resync writes the records of a collection to.'''
+
+    return os.path.join(rowInDB['file_path_map_to'], rowInDB['institution_key'], rowInDB['collection_key'])
+
+
+def recordLayout(rowInDB):
+    '''Return the FileLayout of the synced record files of a collection.'''
+
+    layout = config['Layout'].get('records', 'flat')
+    # resync writes files in the flat layout, and they're packed from there
+    if layout == 'packed':
+        layout = FileLayout.FLAT
+    return FileLayout(os.path.abspath(os.path.expanduser(collectionDir(rowInDB))), layout, config['Layout'].getint('depth', 2))
+
+
+def recordPackPath(rowInDB):
+    '''Return the path of the PackedRecordStore of a collection.'''
+
+    return os.path.abspath(os.path.expanduser(collectionDir(rowInDB))) + '.pack'
+
+
+def recordPack(rowInDB):
+    '''Return the PackedRecordStore of a collection if Layout.records is "packed", or else None.'''
+
+    if config['Layout'].get('records', 'flat') != 'packed':
+        return None
+
+    path = recordPackPath(rowInDB)
+    with recordPacksLock:
+        if path not in recordPacks:
+            recordPacks[path] = PackedRecordStore(path)
+        return recordPacks[path]
+
+
+def closeRecordPacks():
+    '''Save the indexes of the PackedRecordStores that have been opened, and close them.'''
+
+    with recordPacksLock:
+        for pack in recordPacks.values():
+            pack.close()
+        recordPacks.clear()
+
+
+def storeRecordFile(resyncFile, rowInDB, keep=False):
+    '''
+    Move a record file that resync has just written to where it belongs in the layout of its collection, and return its new path; or, if records are packed, put it in the pack of its collection, and return its contents.
+
+    keep - whether to leave resync's copy where it is too (hard-linked, unless records are packed), so that a baseline sync that's cut short doesn't fetch it again next run (see removeBaselineCopies)
+    '''
+
+    pack = recordPack(rowInDB)
+    if pack is None:
+        return recordLayout(rowInDB).place(resyncFile, link=keep)
+
+    with open(resyncFile, 'rb') as f:
+        data = f.read()
+    pack.put(recordLayout(rowInDB).name(resyncFile), data)
+    if not keep:
+        os.remove(resyncFile)
+    return data
+
+
+def removeBaselineCopies(rowInDB):
+    '''Remove the copies of record files that were kept where resync wrote them during a baseline sync (see storeRecordFile), and return how many were removed.'''
+
+    layout = recordLayout(rowInDB)
+    pack = recordPack(rowInDB)
+    if pack is None and layout.layout == FileLayout.FLAT:
+        return 0
+
+    removed = 0
+    for path in list(layout.files()):
+        if pack is not None or layout.path(layout.name(path)) != path:
+            os.remove(path)
+            removed += 1
+    # this only removes the directories that are left empty
+    layout.migrate()
+    return removed
+
+
+def findRecordFile(resyncFile, rowInDB):
+    '''Return the path of a synced record file given the path that resync wrote it to, or, if records are packed, its contents. If it's gone, return None.'''
+
+    pack = recordPack(rowInDB)
+    if pack is not None:
+        return pack.get(recordLayout(rowInDB).name(resyncFile))
+
+    localFile = recordLayout(rowInDB).locate(resyncFile)
+    return localFile if os.path.exists(localFile) else None
+
+
+def removeRecordFile(resyncFile, rowInDB):
+    '''Remove a record file that resync has reported deleted; resync only removes files from where it wrote them.'''
+
+    pack = recordPack(rowInDB)
+    if pack is not None:
+        pack.delete(recordLayout(rowInDB).name(resyncFile))
+        return
+
+    localFile = recordLayout(rowInDB).locate(resyncFile)
+    if localFile != resyncFile and os.path.exists(localFile):
+        os.remove(localFile)
+
+
+def iterRecordFiles(rowInDB):
+    '''Yield the path of every synced record file of a collection, or, if records are packed, the contents of every record, in the order they are stored in.'''
+
+    pack = recordPack(rowInDB)
+    if pack is None:
+        yield from recordLayout(rowInDB).files()
+    else:
+        for key, data in pack.items():
+            yield data
+
+
+def describeRecordFile(localFile):
+    '''Return a description of a record file (see iterRecordFiles) for log messages.'''
+
+    return '"{}"'.format(localFile) if isinstance(localFile, str) else 'a packed record'
+
+
+def parseRecordFile(localFile, rowInDB):
+    '''
+    Parse a synced OAI-PMH record file (its path, or its contents if records are packed) with the MetadataMapper for the metadata format of its collection.
+
+    Returns a MappedRecord, or None if the record is deleted or can't be read.
+    '''
+
+    if isinstance(localFile, bytes):
+        localFile = io.BytesIO(localFile)
+    return metadataMapper(rowInDB.get('metadata_format', 'oai_dc')).map(localFile)
+
+
+def reindexRecordFiles(localFiles, rowInDB):
+    '''
+    Rebuild the Solr documents for records that have already been synced. Runs in a worker process.
+
+    Thumbnails are not looked for again; if one has already been uploaded for a record, its URL is reused.
+    '''
+
+    records = []
+    for localFile in localFiles:
+        try:
+            record = parseRecordFile(localFile, rowInDB)
+        except Exception as e:
+            logger.error('Cannot read {}: {}'.format(describeRecordFile(localFile), e))
+            continue
+        if record is not None:
+            records.append(record)
+
+    ranked = relevanceScorer(rowInDB).rankMany((record.identifier, record.links) for record in records)
+    return [createSolrDoc(record, rowInDB, existingThumbnailUrl(record.identifier, rowInDB), links) for record, links in zip(records, ranked)]
+
+
+def reindex(rows, workers=None, batchSize=1000, outputPath=None, outputFormat='json', archive=None):
+    '''
+    Rebuild the Solr documents of the given collections from the record files on disk, without running resync.
+
+    Documents are sent to Solr in batches of `batchSize`, or, if `outputPath` is given, written to a bulk update file in the given format ("json" or "csv") instead. They are also added to the SolrDocumentArchive, if one is given.
+    '''
+
+    if outputPath is not None:
+        outputPath = os.path.abspath(os.path.expanduser(outputPath))
+        if outputFormat == 'csv':
+            writer = SolrCsvUpdateWriter(outputPath, SolrDocument.fields, multiValuedFields=SolrDocument.multiValuedFields)
+        else:
+            writer = SolrJsonUpdateWriter(outputPath)
+        logger.info('Writing Solr documents to "{}"'.format(writer.path))
+    else:
+        solr = getSolr()
+        retryQueue = getRetryQueue()
+
+    total = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for row in rows:
+            logger.info('Reindexing {}: {}'.format(row['institution_name'], row['collection_name']))
+
+            fn = partial(reindexRecordFiles, rowInDB=dict(row))
+            localFiles = iterRecordFiles(row)
+
+            # read a batch of files at a time, so that memory use doesn't depend on the size of the collection
+            while True:
+                batch = list(itertools.islice(localFiles, batchSize))
+                if len(batch) == 0:
+                    break
+
+                chunks = [batch[i:i + 16] for i in range(0, len(batch), 16)]
+                docs = [doc for docs in pool.map(fn, chunks) for doc in docs]
+                if len(docs) == 0:
+                    continue
+
+                docs = [doc.toSolr() for doc in docs]
+                if archive is not None:
+                    archive.add(docs)
+
+                if outputPath is not None:
+                    writer.write(docs)
+                else:
+                    try:
+                        solr.add(docs)
+                    except Exception as e:
+                        logger.error('Something went wrong while trying to send data to Solr: {}'.format(e))
+                        queueFailedBatch(retryQueue, docs, e)
+                        failed += len(docs)
+                        continue
+                total += len(docs)
+                logger.info('Reindexed {} documents'.format(total))
+
+    if outputPath is not None:
+        writer.close()
+        if outputFormat == 'csv':
+            logger.info('Post with: {}'.format(writer.updateParams()))
+    else:
+        solr.commit()
+    if archive is not None:
+        archive.close()
+    logger.info('Reindexed {} documents in total'.format(total))
+    if failed > 0:
+        logger.warning('{} documents couldn\'t be sent to Solr; they will be tried again by the next sync'.format(failed))
+
+
+def reload(rows, batchSize=1000):
+    '''
+    Index the current Solr documents of the given collections from the SolrDocumentArchive, without reading record files or looking for thumbnails.
+    '''
+
+    archive = getArchive()
+    if archive is None:
+        logger.error('Nothing to reload from, since Archive.path isn\'t set or pyarrow isn\'t installed')
+        return
+
+    solr = getSolr()
+    retryQueue = getRetryQueue()
+    total = 0
+    failed = 0
+    for row in rows:
+        logger.info('Reloading {}: {}'.format(row['institution_name'], row['collection_name']))
+
+        docs = archive.documents(row['institution_key'], row['collection_key'])
+        while True:
+            batch = list(itertools.islice(docs, batchSize))
+            if len(batch) == 0:
+                break
+            try:
+                solr.add(batch)
+            except Exception as e:
+                logger.error('Something went wrong while trying to send data to Solr: {}'.format(e))
+                queueFailedBatch(retryQueue, batch, e)
+                failed += len(batch)
+                continue
+            total += len(batch)
+            logger.info('Reloaded {} documents'.format(total))
+
+    solr.commit()
+    logger.info('Reloaded {} documents in total'.format(total))
+    if failed > 0:
+        logger.warning('{} documents couldn\'t be sent to Solr; they will be tried again by the next sync'.format(failed))
+
+
+def solrPhrase(value):
+    '''Return a value quoted as a phrase, for use in a Solr query.'''
+
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def collectionQuery(rowInDB):
+    '''Return a Solr query that matches every document of a collection.'''
+
+    return 'institutionKey:{} AND collectionKey:{}'.format(solrPhrase(rowInDB['institution_key']), solrPhrase(rowInDB['collection_key']))
+
+
+def iterSolrIds(solr, query, batchSize=1000):
+    '''Yield the ID of every Solr document that matches the query, paging through the results with a cursor.'''
+
+    cursorMark = '*'
+    while True:
+        results = solr.search(query, fl='id', sort='id asc', rows=batchSize, cursorMark=cursorMark)
+        for doc in results.docs:
+            yield doc['id']
+        if results.nextCursorMark is None or results.nextCursorMark == cursorMark:
+            return
+        cursorMark = results.nextCursorMark
+
+
+def iterLocalIds(rowInDB):
+    '''Yield the identifier of every record of a collection that has been synced to disk.'''
+
+    for localFile in iterRecordFiles(rowInDB):
+        try:
+            record = parseRecordFile(localFile, rowInDB)
+        except Exception as e:
+            logger.error('Cannot read {}: {}'.format(describeRecordFile(localFile), e))
+            continue
+        if record is not None:
+            yield record.identifier
+
+
+def updateMetadata(db, rows, idsFrom='solr', batchSize=1000, archive=None):
+    '''
+    Copy the collection and institution names of the given collections from the database to their Solr documents, using atomic updates of just those fields.
+
+    The IDs of the documents to update are either queried from Solr (`idsFrom` is "solr") or read from the record files on disk (`idsFrom` is "local").
+    '''
+
+    solr = getSolr()
+    Row = Query()
+
+    for row in rows:
+        logger.info('Updating metadata of {}: {}'.format(row['institution_name'], row['collection_name']))
+
+        if idsFrom == 'local':
+            ids = iterLocalIds(row)
+        else:
+            ids = iterSolrIds(solr, collectionQuery(row), batchSize)
+
+        total = 0
+        failed = False
+        while True:
+            batch = list(itertools.islice(ids, batchSize))
+            if len(batch) == 0:
+                break
+
+            docs = [{'id': i, 'collectionName': row['collection_name'], 'institutionName': row['institution_name']} for i in batch]
+            try:
+                solr.add(docs, fieldUpdates={'collectionName': 'set', 'institutionName': 'set'})
+            except Exception as e:
+                logger.error('Something went wrong while trying to send data to Solr: {}'.format(e))
+                failed = True
+                break
+            total += len(docs)
+            if archive is not None:
+                archive.update(row['institution_key'], row['collection_key'], docs)
+
+        logger.info('Updated {} documents'.format(total))
+
+        # try again next time if something went wrong
+        if not failed:
+            solr.commit()
+            with databaseLock():
+                db.update({'solr_metadata_stale': False}, (Row.institution_key == row['institution_key']) & (Row.collection_key == row['collection_key']))
+
+    if archive is not None:
+        archive.close()
+
+
+def countFiles(directory):
+    '''Return the number of files under a directory.'''
+
+    return sum(len(filenames) for dirpath, dirnames, filenames in os.walk(directory))
+
+
+def listThumbnailKeys(rowInDB):
+    '''Return the S3 keys of the thumbnails of a collection, according to the local copies.'''
+
+    try:
+        with os.scandir(thumbnailDir(rowInDB)) as entries:
+            return [os.path.splitext(entry.name)[0] for entry in entries if entry.is_file()]
+    except FileNotFoundError:
+        return []
+
+
+def removeTree(directory, pool):
+    '''Remove a directory and everything under it, removing its top-level entries in parallel.'''
+
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+
+    futures = [pool.submit(shutil.rmtree if entry.is_dir(follow_symlinks=False) else os.remove, entry.path) for entry in entries]
+    for future in wait(futures).done:
+        try:
+            future.result()
+        except OSError as e:
+            logger.error('Cannot remove a file under "{}": {}'.format(directory, e))
+    try:
+        os.rmdir(directory)
+    except OSError as e:
+        logger.error('Cannot remove "{}": {}'.format(directory, e))
+
+
+def purge(db, rows, dryRun=False, workers=8):
+    '''
+    Remove collections and everything that belongs to them: their Solr documents (with a delete-by-query), their thumbnails in S3 and on disk, their synced record files, their archived Solr documents, and their rows in the database.
+
+    If `dryRun` is True, only report how many of each would be removed.
+    '''
+
+    solr = getSolr()
+    Row = Query()
+
+    report = []
+    for row in rows:
+        recordDir = os.path.abspath(os.path.expanduser(collectionDir(row)))
+        try:
+            nDocs = solr.search(collectionQuery(row), rows=0).hits
+        except Exception as e:
+            logger.error('Something went wrong while trying to count documents in Solr: {}'.format(e))
+            nDocs = None
+        nFiles = countFiles(recordDir)
+        pack = recordPack(row)
+        if pack is not None:
+            nFiles += len(pack)
+        report.append((row, nDocs, nFiles, thumbnailStore.recordsOf(row['institution_key'], row['collection_key']), listThumbnailKeys(row)))
+
+    for row, nDocs, nFiles, recordIdentifiers, thumbnailKeys in report:
+        # thumbnails that are shared with records of other collections are kept
+        objectKeys = collections.Counter(thumbnailStore.get(recordIdentifier) for recordIdentifier in recordIdentifiers)
+        nObjects = len([objectKey for objectKey, n in objectKeys.items() if n == thumbnailStore.references(objectKey)])
+
+        logger.info('{} {}: {}: {} Solr documents, {} record files, {} thumbnails'.format(
+            'Would purge' if dryRun else 'Purging',
+            row['institution_name'],
+            row['collection_name'],
+            '?' if nDocs is None else nDocs,
+            nFiles,
+            nObjects + len(thumbnailKeys)))
+
+    if dryRun:
+        return
+
+    # thumbnails stored under the keys of their records (see thumbnailKey) are only listed in the local copies, which are removed below
+    deletionQueue = getDeletionQueue(getRetryQueue())
+    archive = getArchive()
+    purged = []
+    for row, nDocs, nFiles, recordIdentifiers, thumbnailKeys in report:
+        try:
+            solr.delete(q=collectionQuery(row))
+        except Exception as e:
+            # the rest of the collection is kept, so that it can be purged again
+            logger.error('Something went wrong while trying to delete documents of {}: {} from Solr: {}'.format(row['institution_name'], row['collection_name'], e))
+            continue
+        purged.append((row, recordIdentifiers))
+
+        for recordIdentifier in recordIdentifiers:
+            thumbnailStore.release(recordIdentifier)
+        for s3Key in thumbnailKeys:
+            deletionQueue.delete(s3Key)
+    sweepThumbnails(deletionQueue)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for row, recordIdentifiers in purged:
+            removeTree(os.path.abspath(os.path.expanduser(collectionDir(row))), pool)
+            removeRecordPack(row)
+            removeTree(thumbnailDir(row), pool)
+            if archive is not None:
+                removeTree(archive.partitionDir(row['institution_key'], row['collection_key']), pool)
+            with databaseLock():
+                db.remove((Row.institution_key == row['institution_key']) & (Row.collection_key == row['collection_key']))
+
+    deletionQueue.close()
+    solr.commit()
+
+
+def removeRecordPack(rowInDB):
+    '''Remove the PackedRecordStore of a collection, if it has one.'''
+
+    path = recordPackPath(rowInDB)
+    with recordPacksLock:
+        pack = recordPacks.pop(path, None)
+        if pack is not None:
+            pack.close()
+    for filepath in (path, path + '.idx'):
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+
+
+def packRecordFiles(rowInDB):
+    '''Move the record files of a collection into its PackedRecordStore, and return how many were moved.'''
+
+    pack = recordPack(rowInDB)
+    layout = recordLayout(rowInDB)
+    moved = 0
+    for localFile in layout.files():
+        with open(localFile, 'rb') as f:
+            pack.put(layout.name(localFile), f.read())
+        os.remove(localFile)
+        moved += 1
+    pack.save()
+    # the files are gone, so this only removes the directories they were in
+    layout.migrate()
+    return moved
+
+
+def unpackRecordFiles(rowInDB):
+    '''Move the records in the PackedRecordStore of a collection back into files, and return how many were moved.'''
+
+    layout = recordLayout(rowInDB)
+    pack = PackedRecordStore(recordPackPath(rowInDB))
+    moved = 0
+    for key, data in pack.items():
+        localFile = layout.path(key)
+        os.makedirs(os.path.dirname(localFile), exist_ok=True)
+        with open(localFile, 'wb') as f:
+            f.write(data)
+        moved += 1
+    pack.close()
+    removeRecordPack(rowInDB)
+    return moved
+
+
+def migrateLayout(rows, thumbnails=True):
+    '''Move the synced record files of the given collections, and the thumbnails if `thumbnails` is True, to where they belong in the layouts set in destination.ini.'''
+
+    for row in rows:
+        if recordPack(row) is not None:
+            logger.info('Packing record files of {}: {}'.format(row['institution_name'], row['collection_name']))
+            logger.info('Packed {} record files'.format(packRecordFiles(row)))
+            continue
+
+        layout = recordLayout(row)
+        if os.path.exists(recordPackPath(row)):
+            logger.info('Unpacking records of {}: {}'.format(row['institution_name'], row['collection_name']))
+            logger.info('Unpacked {} records'.format(unpackRecordFiles(row)))
+        logger.info('Moving record files of {}: {} to the {} layout'.format(row['institution_name'], row['collection_name'], layout.layout))
+        logger.info('Moved {} record files'.format(layout.migrate()))
+
+    if thumbnails:
+        layout = thumbnailLayout()
+        logger.info('Moving thumbnails to the {} layout'.format(layout.layout))
+        logger.info('Moved {} thumbnails'.format(layout.migrate()))
+
+
+def compactRecordPacks(rows):
+    '''Rewrite the PackedRecordStores of the given collections without the records that have been replaced or deleted.'''
+
+    for row in rows:
+        pack = recordPack(row)
+        if pack is None:
+            logger.error('Records are not packed (see Layout.records in destination.ini)')
+            return
+
+        logger.info('Compacting the records of {}: {} ({:.0%} reclaimable)'.format(row['institution_name'], row['collection_name'], pack.garbageRatio()))
+        logger.info('Reclaimed {} bytes'.format(pack.compact()))
+
+
+def getRetryQueue():
+    '''Return the queue of operations that failed and should be tried again.'''
+
+    return RetryQueue(
+        os.path.abspath(os.path.expanduser(config['Retry'].get('path', '~/retry.json'))),
+        os.path.abspath(os.path.expanduser(config['Retry'].get('dead_letter_path', '~/dead_letter.jsonl'))),
+        maxAttempts=config['Retry'].getint('max_attempts', 8),
+        baseDelay=config['Retry'].getfloat('base_delay', 30.0))
+
+
+def thumbnailJobs(retryQueue):
+    '''
+    Return the ThumbnailJobQueue of records whose thumbnails have to be looked for. It's opened once per process.
+
+    Jobs that older versions kept in the RetryQueue are moved to it the first time.
+    '''
+
+    path = os.path.abspath(os.path.expanduser(config['Thumbnails'].get('queue_path', '~/thumbnail_jobs.sqlite')))
+    with thumbnailJobQueuesLock:
+        if path not in thumbnailJobQueues:
+            thumbnailJobQueues[path] = ThumbnailJobQueue(
+                path,
+                os.path.abspath(os.path.expanduser(config['Retry'].get('dead_letter_path', '~/dead_letter.jsonl'))),
+                maxAttempts=config['Retry'].getint('max_attempts', 8),
+                baseDelay=config['Retry'].getfloat('base_delay', 30.0))
+            for entry in retryQueue.take('thumbnail'):
+                thumbnailJobQueues[path].schedule(entry['id'], entry['payload'])
+        return thumbnailJobQueues[path]
+
+
+def getArchive():
+    '''Return the SolrDocumentArchive that Solr documents are written to, or None if it isn't configured.'''
+
+    path = config['Archive'].get('path', '')
+    if path == '':
+        return None
+    if not SolrDocumentArchive.available():
+        logger.warning('pyarrow is not installed, so Solr documents will not be archived')
+        return None
+    return SolrDocumentArchive(os.path.abspath(os.path.expanduser(path)))
+
+
+def getDeletionQueue(retryQueue):
+    '''Return a ThumbnailDeletionQueue whose failed deletions are queued to be tried again.'''
+
+    return ThumbnailDeletionQueue(
+        s3,
+        config['S3']['bucket'],
+        onFailure=lambda keys: retryQueue.push('s3', 'delete', None, {'keys': keys}, 'DeleteObjects failed'))
+
+
+def performOperation(solr, target, operation, id, payload):
+    '''Carry out an operation on Solr (with a SolrWriter) or S3, in the calling thread. Raises an exception if it fails.'''
+
+    if target == 'solr':
+        solr.send(operation, payload)
+    elif target == 's3' and operation == 'put':
+        uploadThumbnail(payload)
+    elif target == 's3' and operation == 'delete':
+        response = s3.delete_objects(Bucket=config['S3']['bucket'], Delete={'Objects': [{'Key': key} for key in payload['keys']], 'Quiet': True})
+        if len(response.get('Errors', [])) > 0:
+            raise Exception('Cannot delete {} thumbnails'.format(len(response['Errors'])))
+    else:
+        raise ValueError('Unknown operation: {} {}'.format(target, operation))
+
+
+def sendToSolr(solr, retryQueue, operation, id, payload):
+    '''Buffer an add or delete operation for a document, to be sent to Solr in a batch, after the operations on the same document that were sent before (see SolrWriter). If it fails, or Solr has been failing, it's queued to be tried again later.'''
+
+    def done(error):
+        # a newer operation on a document supersedes any queued one
+        retryQueue.discard('solr', id)
+        if error is not None:
+            retryQueue.push('solr', operation, id, payload, error)
+
+    solr.buffer(operation, id, payload, done)
+
+
+def queueFailedBatch(retryQueue, docs, error):
+    '''Queue a batch of Solr documents that couldn't be added to be tried again, as a single entry. The next sync tries it before it sends anything newer.'''
+
+    retryQueue.push('solr', 'add', None, {'docs': docs}, error)
+
+
+def drainRetryQueue(solr, retryQueue):
+    '''Try again the Solr and S3 operations that are due. Targets whose circuit breaker is open are left alone until the next run. Thumbnail jobs are left to the thumbnail stage.'''
+
+    entries = retryQueue.due('solr') + retryQueue.due('s3')
+    if len(entries) == 0:
+        return
+
+    logger.info('Trying again {} operations that failed before'.format(len(entries)))
+    for entry in entries:
+        breaker = breakers[entry['target']]
+        if not breaker.allow():
+            continue
+
+        try:
+            performOperation(solr, entry['target'], entry['operation'], entry['id'], entry['payload'])
+        except Exception as e:
+            breaker.failure()
+            retryQueue.failed(entry, e)
+        else:
+            breaker.success()
+            retryQueue.succeeded(entry)
+    logger.info('{} operations are still waiting to be tried again'.format(retryQueue.count('solr') + retryQueue.count('s3')))
+
+
+def getSolr():
+    '''Return a SolrWriter for the configured index (see Solr in destination.ini), or exit if the URL is malformed.'''
 
     solrUrl = config['Solr']['url']
-    tinydbPath = os.path.abspath(os.path.expanduser(config['TinyDB']['path']))
 
     # make sure URL is well-formed
     if not validators.url(solrUrl):
         logger.critical('{} is not a valid URL'.format(solrUrl))
         exit(1)
     else:
-        solr = pysolr.Solr(solrUrl)
+        commitWithin = config['Solr'].get('commit_within', '')
+        return SolrWriter(
+            solrUrl,
+            streams=config['Solr'].getint('streams', 1),
+            compress=config['Solr'].getboolean('gzip', False),
+            commitWithin=int(commitWithin) if commitWithin != '' else None,
+            softCommit=config['Solr'].getboolean('soft_commit', False),
+            timeout=config['Solr'].getfloat('timeout', 60),
+            batchSize=config['Solr'].getint('batch_size', 100),
+            batchDelay=config['Solr'].getfloat('batch_delay', 1.0),
+            breaker=breakers['solr'])
+
+
+def getDatabase():
+    '''Return the TinyDB instance, or exit if it doesn't exist.'''
+
+    tinydbPath = os.path.abspath(os.path.expanduser(config['TinyDB']['path']))
 
     # make sure database exists
     try:
         with open(tinydbPath, 'r') as f:
             pass
-        db = TinyDB(tinydbPath)
+        return TinyDB(tinydbPath)
 
     except:
         logger.critical('{} does not exist'.format(tinydbPath))
         exit(1)
 
-    for row in db:
 
-        Row = Query()
+@contextlib.contextmanager
+def databaseLock():
+    '''Hold an exclusive lock on the database while writing to it, so that workers on other nodes that share it don't overwrite each other's changes.'''
+
+    with open(os.path.abspath(os.path.expanduser(config['TinyDB']['path'])) + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def selectRows(db, institutionKeys=None, collectionKeys=None):
+    '''Return the rows of the database that match the given institution and collection keys. If no keys are given, return all rows.'''
 
-        if row['new'] is True:
-            mode = '--baseline'
+    return [
+        row for row in db
+        if (institutionKeys is None or row['institution_key'] in institutionKeys)
+        and (collectionKeys is None or row['collection_key'] in collectionKeys)
+        ]
+
+
+def runResync(command, stopped=None):
+    '''
+    Run resync and yield a ResyncAction for each resource that it creates, updates, or deletes, as soon as it reports it.
+
+    Its output is read one line at a time instead of all at once, so memory use doesn't grow with the number of actions; while the actions are being indexed, resync blocks on the full pipe until they catch up.
+
+    stopped - if given, a function that is called after each action has been handled; once it returns True, resync is killed, and the actions that it had already reported are still yielded
+
+    Raises subprocess.CalledProcessError (after the last action) if resync exits with an error, unless it was killed.
+    '''
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    killed = False
+    try:
+        for action in resyncActions(process.stdout):
+            yield action
+            if not killed and stopped is not None and stopped():
+                # the files of the actions in the pipe have been written, so they're drained rather than dropped
+                process.kill()
+                killed = True
+    except BaseException:
+        # if the caller stops early, don't leave resync running
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        returnCode = process.wait()
+    if returnCode != 0 and not killed:
+        raise subprocess.CalledProcessError(returnCode, command)
+
+
+def resyncCommand(rowInDB):
+    '''Return the resync command that synchronizes a collection.'''
+
+    if rowInDB['new'] is True:
+        mode = '--baseline'
+    else:
+        mode = '--incremental'
+
+    return ['resync', mode, '--noauth', '--verbose', '--logger', '--delete', '--sitemap', rowInDB['resourcelist_uri'], '--changelist-uri', rowInDB['changelist_uri'], rowInDB['url_map_from'], collectionDir(rowInDB)]
+
+
+def indexResyncAction(solr, retryQueue, deletionQueue, archive, row, action, resourceUrl, resyncFile, localFile):
+    '''
+    Index a resource that resync has created, updated, or deleted.
+
+    resyncFile - the path that resync wrote the record file to
+    localFile - the path or contents of the record file (see storeRecordFile and findRecordFile), or None if it's gone
+    '''
+
+    if action == 'deleted' and localFile is None:
+        # resync has already removed the file, so the identifier has to come from the resource URL
+        recordIdentifier = identifierFromResourceUrl(resourceUrl)
+        if recordIdentifier is None:
+            logger.error('Cannot determine the identifier of deleted resource: {}'.format(resourceUrl))
+            return
+
+        logger.info('Deleting Solr document for {}'.format(recordIdentifier))
+        releaseThumbnail(recordIdentifier, row, deletionQueue)
+        thumbnailJobs(retryQueue).discard(recordIdentifier)
+        sendToSolr(solr, retryQueue, 'delete', recordIdentifier, {'id': recordIdentifier})
+        if archive is not None:
+            archive.delete(row['institution_key'], row['collection_key'], [recordIdentifier])
+        return
+
+    logger.debug('Opening {}'.format(describeRecordFile(localFile)))
+    record = parseRecordFile(localFile, row)
+    if record is None:
+        # if deleted or unreadable, skip to next record
+        # TODO: delete the file
+        return
+
+    logger.debug('Generating Solr document from records in {}'.format(describeRecordFile(localFile)))
+    recordIdentifier = record.identifier
+
+    if action == 'created':
+
+        logger.info('Creating Solr document for {}'.format(recordIdentifier))
+
+        # the thumbnail stage sets the URL of a new thumbnail later
+        thumbnailUrl = existingThumbnailUrl(recordIdentifier, row)
+
+        doc = createSolrDoc(record, row, thumbnailUrl)
+        logger.debug('Created Solr doc: {}'.format(dumps(doc.toSolr(), indent=4)))
+        sendToSolr(solr, retryQueue, 'add', recordIdentifier, {'docs': [doc.toSolr()]})
+        if archive is not None:
+            archive.add([doc.toSolr()])
+        thumbnailJobs(retryQueue).schedule(recordIdentifier, thumbnailJob(resyncFile, row))
+
+    elif action == 'updated':
+
+        logger.info('Updating Solr document for {}'.format(recordIdentifier))
+
+        # the thumbnail stage sets the URL of a new thumbnail later
+        thumbnailUrl = existingThumbnailUrl(recordIdentifier, row)
+
+        doc = createSolrDoc(record, row, thumbnailUrl)
+        logger.debug('Created Solr doc: {}'.format(dumps(doc.toSolr(), indent=4)))
+        sendToSolr(solr, retryQueue, 'add', recordIdentifier, {'docs': [doc.toSolr()]})
+        if archive is not None:
+            archive.add([doc.toSolr()])
+        thumbnailJobs(retryQueue).schedule(recordIdentifier, thumbnailJob(resyncFile, row))
+
+    elif action == 'deleted':
+
+        logger.info('Deleting Solr document for {}'.format(recordIdentifier))
+        releaseThumbnail(recordIdentifier, row, deletionQueue)
+        thumbnailJobs(retryQueue).discard(recordIdentifier)
+
+        sendToSolr(solr, retryQueue, 'delete', recordIdentifier, {'id': recordIdentifier})
+        if archive is not None:
+            archive.delete(row['institution_key'], row['collection_key'], [recordIdentifier])
+
+        removeRecordFile(resyncFile, row)
+
+
+def indexResyncActions(solr, retryQueue, deletionQueue, archive, row, actions):
+    '''Index a batch of ResyncActions whose record files have already been moved into place by syncCollection.'''
+
+    for action, resourceUrl, resyncFile in actions:
+        indexResyncAction(solr, retryQueue, deletionQueue, archive, row, action, resourceUrl, resyncFile, findRecordFile(resyncFile, row))
+
+
+def leftoverRecordFiles(rowInDB, since):
+    '''
+    Yield the paths of the record files of a collection that a baseline sync that was cut short (and started at `since`) may have written without reporting them: the files where resync wrote them that haven't been stored in the layout of the collection (or its pack), and, in the flat layout, where they're stored in place, the files that were changed since then.
+    '''
+
+    layout = recordLayout(rowInDB)
+    pack = recordPack(rowInDB)
+    for path in layout.files():
+        name = layout.name(path)
+        if pack is not None:
+            if pack.get(name) is None:
+                yield path
+        elif layout.path(name) != path:
+            if not os.path.exists(layout.path(name)):
+                yield path
+        elif layout.layout == FileLayout.FLAT:
+            # resync sets the modification times of files to those of their resources, but not their change times
+            try:
+                if os.stat(path).st_ctime >= since:
+                    yield path
+            except FileNotFoundError:
+                pass
+
+
+def syncCollection(solr, db, retryQueue, deletionQueue, archive, row, onBatch=None, batchSize=1000, stop=None, deadline=None, history=None):
+    '''
+    Run resync on a collection and index the changes that it reports. Returns False if resync failed or was stopped.
+
+    When syncing is stopped, the actions that resync has already reported are still indexed. If a baseline sync is cut short, the record files that it may have written without reporting them are indexed at the start of the next run (see leftoverRecordFiles), since the next baseline sync counts them as up to date.
+
+    onBatch - if given, a function that is called with lists of up to `batchSize` ResyncActions (whose record files have been moved into place) instead of indexing them, e.g. to have them indexed by other workers
+    stop - a threading.Event that is set when syncing should be abandoned
+    deadline - time (in seconds since the epoch) after which syncing is stopped, to be resumed by the next run
+    history - a SyncHistory to record the run in
+    '''
+
+    Row = Query()
+    rowQuery = (Row.institution_key == row['institution_key']) & (Row.collection_key == row['collection_key'])
+    batch = []
+    started = time.time()
+    actions = 0
+    completed = False
+    stopped = threading.Event()
+
+    def shouldStop():
+        if (stop is not None and stop.is_set()) or (deadline is not None and time.time() > deadline):
+            stopped.set()
+        return stopped.is_set()
+
+    def handle(action, resourceUrl, resyncFile):
+        # resync writes each file where its URL maps to, so it's moved to where it belongs in the layout of the collection (or into its pack)
+        if action == 'deleted':
+            localFile = findRecordFile(resyncFile, row)
         else:
-            mode = '--incremental'
+            try:
+                localFile = storeRecordFile(resyncFile, row, keep=row['new'] is True)
+            except OSError as e:
+                logger.error('Cannot move "{}" into place: {}'.format(resyncFile, e))
+                return
+
+        if onBatch is None:
+            indexResyncAction(solr, retryQueue, deletionQueue, archive, row, action, resourceUrl, resyncFile, localFile)
+            return
+
+        batch.append(ResyncAction(action, resourceUrl, resyncFile))
+        if len(batch) >= batchSize:
+            onBatch(batch[:])
+            del batch[:]
+
+    logger.info('Syncing {}: {}'.format(row['institution_name'], row['collection_name']))
+    try:
+        if row.get('baseline_cut_short') is not None:
+            logger.info('Indexing the record files that the last baseline sync of {}: {} may have left behind'.format(row['institution_name'], row['collection_name']))
+            for resyncFile in list(leftoverRecordFiles(row, row['baseline_cut_short'])):
+                handle('created', None, resyncFile)
+
+        for action, resourceUrl, resyncFile in runResync(resyncCommand(row), shouldStop):
+            actions += 1
+            handle(action, resourceUrl, resyncFile)
+
+        if stopped.is_set():
+            if deadline is not None and time.time() > deadline:
+                # the next run of resync picks up the changes that are left
+                logger.warning('Stopped syncing {}: {} after running out of time; it will be resumed next run'.format(row['institution_name'], row['collection_name']))
+            else:
+                logger.warning('Stopped syncing {}: {}'.format(row['institution_name'], row['collection_name']))
+        else:
+            completed = True
+
+    except subprocess.CalledProcessError as e:
+        # the actions that were reported before resync failed have been indexed
+        logger.error('Invalid invocation of "resync" with collection {}: {}'.format(row['collection_key'], e))
+        # TODO: note that we should come back to this collection later
+        return False
+    finally:
+        if len(batch) > 0:
+            onBatch(batch)
+        # the collection isn't done until its changes have been sent
+        solr.flush()
+        if history is not None:
+            history.record(row['institution_key'], row['collection_key'], row['new'] is True, started, time.time(), actions, completed)
+
+    if not completed:
+        if row['new'] == True:
+            with databaseLock():
+                db.update({'baseline_cut_short': started}, rowQuery)
+        return False
+
+    if row['new'] == True or row.get('baseline_cut_short') is not None:
+        removeBaselineCopies(row)
+        with databaseLock():
+            db.update({'new': False, 'baseline_cut_short': None}, rowQuery)
+    return True
+
+
+def finishRun(solr, retryQueue, deletionQueue, archive, sweep=True):
+    '''
+    Commit the records that have been indexed, get their thumbnails (unless Thumbnails.defer is set), delete the thumbnails that are no longer used if `sweep` is True, and log what's left to do.
+    '''
 
-        command = ['resync', mode, '--noauth', '--verbose', '--logger', '--delete', '--sitemap', row['resourcelist_uri'], '--changelist-uri', row['changelist_uri'], row['url_map_from'], os.path.join(row['file_path_map_to'], row['institution_key'], row['collection_key'])]
+    try:
+        solr.commit()
+    except Exception as e:
+        logger.error('Something went wrong while trying to commit to Solr: {}'.format(e))
 
-        try:
-            logger.info('Syncing {}: {}'.format(row['institution_name'], row['collection_name']))
-            actions = subprocess.check_output(
-                command,
-                stderr=subprocess.STDOUT
-                )
-            if row['new'] == True:
-                db.update({'new': False}, Row['institution_key'] == row['institution_key'] and Row['collection_key'] == row['collection_key'])
-        except subprocess.CalledProcessError as e:
-            logger.error('Invalid invocation of "resync" with collection {}: {}'.format(row['collection_key'], e))
-            # TODO: note that we should come back to this collection later
-            continue
+    # thumbnails are fetched after all of the metadata has been indexed
+    if not config['Thumbnails'].getboolean('defer', False):
+        fetchThumbnails(solr, retryQueue, deletionQueue, config['Thumbnails'].getint('workers', 8), config['Thumbnails'].getint('batch_size', 100), thumbnailProcesses(), archive)
 
-        for line in actions.splitlines():
+    if sweep:
+        sweepThumbnails(deletionQueue)
+    else:
+        thumbnailStore.save()
+    deletionQueue.close()
+    if archive is not None:
+        archive.close()
 
-            '''
-            # TODO: fault tolerance
-            failures = row['_failures'] or []
-            '''
+    solr.close()
 
-            action = line.split(b' ')[0]
-            if action in [b'created:', b'updated:', b'deleted:']:
+    if len(retryQueue) > 0:
+        logger.warning('{} failed operations will be tried again later'.format(len(retryQueue)))
 
-                localFile = line.split(b' -> ')[1]
+    for line in thumbnailStats.summary():
+        logger.info('Thumbnails from {}'.format(line))
+    for line in hostHealth.summary():
+        logger.info('Thumbnail host {}'.format(line))
 
-                logger.debug('Opening {}'.format(localFile))
-                with open(localFile) as fp:
-                    soup = BeautifulSoup(fp, 'xml')
 
-                    try:
-                        # if deleted, skip to next record
-                        # TODO: delete the file
-                        if soup.find('header')['status'] == 'deleted':
-                            continue
-                    except TypeError as e:
-                        # if error, skip to next record
-                        # TODO: delete the file
-                        continue
-                    except KeyError:
-                        # no 'status' attribute, so we're good
-                        logger.debug('Generating Solr document from records in "{}"'.format(localFile))
-                        recordIdentifier = soup.find('identifier').string
-                        tags = soup.find('dc').contents
+def sync():
+    '''Synchronize every collection in the database with its source, and index the changes in Solr.'''
 
-                oaiPmhHost = urllib.parse.urlparse(row['url_map_from']).netloc
+    solr = getSolr()
+    db = getDatabase()
 
-                if action == b'created:':
+    # operations that failed in earlier runs go first
+    retryQueue = getRetryQueue()
+    drainRetryQueue(solr, retryQueue)
 
-                    logger.info('Creating Solr document for {}'.format(recordIdentifier))
+    # thumbnails of deleted records are removed in the background
+    deletionQueue = getDeletionQueue(retryQueue)
 
-                    thumbnailUrl = findThumbnailUrl(soup, bsFilters)
-                    if thumbnailUrl is not None:
-                        logger.debug('Found thumbnail URL: {}'.format(thumbnailUrl))
-                        thumbnailUrl = getThumbnail(thumbnailUrl, recordIdentifier, row)
-                        logger.debug('Got thumbnail')
+    # every change is recorded in the archive, if it's configured
+    archive = getArchive()
 
-                    doc = createSolrDoc(recordIdentifier, row, thumbnailUrl, tags, oaiPmhHost)
-                    logger.debug('Created Solr doc: {}'.format(dumps(doc, indent=4)))
-                    try:
-                        solr.add([doc])
-                        logger.debug('Submitted Solr doc!')
-                    except:
-                        logger.error('Something went wrong while trying to send data to Solr')
-                        '''
-                        # TODO: fault tolerance
-                        failures.push({
-                            'collection_key': recordIdentifier,
-                            'action': action
-                            })
-                        '''
-                        continue
+    # small and stale collections go first, and big ones get a limited amount of time per run
+    history = getHistory()
+    rows = getScheduler(history).order(list(db))
+    runDeadline = budgetDeadline(config['Scheduler'].getfloat('run_budget', 0))
+    for i, row in enumerate(rows):
+        if runDeadline is not None and time.time() > runDeadline:
+            logger.warning('Ran out of time with {} collections left; they will be synced next run'.format(len(rows) - i))
+            break
 
-                elif action == b'updated:':
+        deadline = budgetDeadline(config['Scheduler'].getfloat('collection_budget', 0))
+        if runDeadline is not None:
+            deadline = min(deadline or runDeadline, runDeadline)
+        syncCollection(solr, db, retryQueue, deletionQueue, archive, row, deadline=deadline, history=history)
 
-                    logger.info('Updating Solr document for {}'.format(recordIdentifier))
+    finishRun(solr, retryQueue, deletionQueue, archive)
 
-                    thumbnailUrl = findThumbnailUrl(soup, bsFilters)
-                    if thumbnailUrl is not None:
-                        logger.debug('Found thumbnail URL: {}'.format(thumbnailUrl))
-                        thumbnailUrl = getThumbnail(thumbnailUrl, recordIdentifier, row)
-                        logger.debug('Got thumbnail')
 
-                    doc = createSolrDoc(recordIdentifier, row, thumbnailUrl, tags, oaiPmhHost)
-                    logger.debug('Created Solr doc: {}'.format(dumps(doc, indent=4)))
-                    try:
-                        solr.add([doc])
-                        logger.debug('Submitted Solr doc!')
-                    except:
-                        logger.error('Something went wrong while trying to send data to Solr')
-                        '''
-                        # TODO: fault tolerance
-                        failures.push({
-                            'collection_key': recordIdentifier,
-                            'action': action
-                            })
-                        '''
-                        continue
+def getHistory():
+    '''Return the history of the runs of resync on each collection.'''
 
-                elif action == b'deleted:':
+    return SyncHistory(os.path.abspath(os.path.expanduser(config['Scheduler'].get('history_path', '~/history.json'))))
 
-                    # TODO: delete the associated thumbnail as well
-                    logger.info('Deleting Solr document for {}'.format(recordIdentifier))
-                    deleteThumbnail(recordIdentifier)
 
-                    try:
-                        solr.delete(id=recordIdentifier)
-                    except:
-                        logger.error('Something went wrong while trying to send data to Solr')
-                        '''
-                        # TODO: fault tolerance
-                        failures.push({
-                            'collection_key': recordIdentifier,
-                            'action': action
+def getScheduler(history):
+    '''Return the CollectionScheduler that orders collections.'''
+
+    return CollectionScheduler(
+        history,
+        baselineEstimate=config['Scheduler'].getfloat('baseline_estimate', 3600),
+        incrementalEstimate=config['Scheduler'].getfloat('incremental_estimate', 60),
+        maxStaleness=config['Scheduler'].getfloat('max_staleness', 7 * 86400))
+
+
+def budgetDeadline(budget):
+    '''Return the time at which a budget of the given number of seconds from now runs out, or None if it's 0 (unlimited).'''
+
+    return time.time() + budget if budget > 0 else None
+
+
+def showSchedule(rows):
+    '''Log the order in which the given collections would be synced, and what it's based on.'''
+
+    history = getHistory()
+    scheduler = getScheduler(history)
+    for row in scheduler.order(rows):
+        runs = history.runs(row['institution_key'], row['collection_key'])
+        completed = [run for run in runs if run['completed']]
+        rates = [run['actions'] / run['seconds'] for run in completed if run['seconds'] > 0]
+        logger.info('{}: {}: priority {:.1f}, expected to take {:.0f}s, last synced {}, {} runs ({} cut short), {}'.format(
+            row['institution_name'],
+            row['collection_name'],
+            scheduler.priority(row, runs),
+            scheduler.estimate(row, runs),
+            '{:.0f}s ago'.format(scheduler.staleness(row, runs)) if len(completed) > 0 else 'never',
+            len(runs),
+            len(runs) - len(completed),
+            '{:.1f} changes/s'.format(sum(rates) / len(rates)) if len(rates) > 0 else 'throughput unknown'))
+
+
+CollectionPlan = collections.namedtuple('CollectionPlan', ['row', 'baseline', 'changes', 'thumbnail_lookups', 'seconds', 'runaway'])
+
+
+def planCollection(rowInDB, fetcher, runs, scheduler, runawayRatio=0.5):
+    '''
+    Return a CollectionPlan of what syncing a collection would do, from its ResourceList and ChangeList alone.
+
+    runs - the collection's runs in the SyncHistory, oldest first
+    runawayRatio - fraction of the collection's resources that an incremental sync may change before its ChangeList is considered runaway
+    '''
+
+    baseline = rowInDB['new'] is True
+    resources = fetcher.entries(rowInDB['resourcelist_uri'])
+    if baseline:
+        changes = planChanges(resources)
+    else:
+        # resync picks up where the last completed run started
+        completed = [run for run in runs if run['completed']]
+        since = completed[-1]['started'] if len(completed) > 0 else None
+        try:
+            changes = planChanges(resources, fetcher.entries(rowInDB['changelist_uri']), since)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            # the source hasn't published a ChangeList yet
+            changes = planChanges(resources, [])
+
+    # records whose thumbnail URLs come from templates don't need any requests
+    rules = ThumbnailRules(rowInDB.get('thumbnail_rules'))
+    thumbnailLookups = 0 if len(rules.templates) > 0 else changes.created + changes.updated
+
+    actions = changes.created + changes.updated + changes.deleted
+    rates = [run['actions'] / run['seconds'] for run in runs if run['completed'] and run['seconds'] > 0]
+    seconds = actions / (sum(rates) / len(rates)) if len(rates) > 0 and sum(rates) > 0 else scheduler.estimate(rowInDB, runs)
+
+    return CollectionPlan(
+        rowInDB,
+        baseline,
+        changes,
+        thumbnailLookups,
+        seconds,
+        not baseline and actions > runawayRatio * max(changes.resources, 1))
+
+
+def plan(rows, runs=None, workers=8, runawayRatio=0.5):
+    '''
+    Log what syncing the given collections would do, without writing anything to Solr, S3, the database, or the local filesystem: the number of records that would be created, updated, and deleted, the number of bytes that would be downloaded, and the number of records whose thumbnails would be looked for.
+
+    runs - a dictionary from (institution key, collection key) to the runs in the SyncHistory of each collection, or None if there is no history
+    workers - number of documents to fetch at the same time
+
+    Returns the list of CollectionPlans.
+    '''
+
+    runs = runs if runs is not None else {}
+    scheduler = getScheduler(None)
+    fetcher = SitemapFetcher(workers, config['Thumbnails'].getfloat('timeout', 30))
+    plans = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [(row, pool.submit(planCollection, row, fetcher, runs.get((row['institution_key'], row['collection_key']), []), scheduler, runawayRatio)) for row in rows]
+            for row, future in futures:
+                try:
+                    collectionPlan = future.result()
+                except Exception as e:
+                    logger.error('{}: {}: couldn\'t plan: {}'.format(row['institution_name'], row['collection_name'], e))
+                    continue
+                changes = collectionPlan.changes
+                logger.info('{}: {}: {} of {} resources: {} to create, {} to update, {} to delete, {} bytes{}, {} thumbnail lookups, about {:.0f}s{}'.format(
+                    row['institution_name'],
+                    row['collection_name'],
+                    'baseline' if collectionPlan.baseline else 'incremental',
+                    changes.resources,
+                    changes.created,
+                    changes.updated,
+                    changes.deleted,
+                    changes.bytes,
+                    ' (and {} records of unknown length)'.format(changes.unknown_lengths) if changes.unknown_lengths > 0 else '',
+                    collectionPlan.thumbnail_lookups,
+                    collectionPlan.seconds,
+                    ' - RUNAWAY CHANGELIST' if collectionPlan.runaway else ''))
+                plans.append(collectionPlan)
+    finally:
+        fetcher.close()
+
+    logger.info('Total: {} collections: {} to create, {} to update, {} to delete, {} bytes, {} thumbnail lookups, about {:.0f}s; {} runaway'.format(
+        len(plans),
+        sum(p.changes.created for p in plans),
+        sum(p.changes.updated for p in plans),
+        sum(p.changes.deleted for p in plans),
+        sum(p.changes.bytes for p in plans),
+        sum(p.thumbnail_lookups for p in plans),
+        sum(p.seconds for p in plans),
+        len([p for p in plans if p.runaway])))
+    logger.info('Fetched {} documents ({} bytes) to plan'.format(fetcher.fetched, fetcher.bytes))
+    return plans
+
+
+def getWorkQueue():
+    '''Return the queue of collections (and batches of records) that workers claim.'''
+
+    return WorkQueue(
+        os.path.abspath(os.path.expanduser(config['Workers'].get('queue_path', '~/work.sqlite'))),
+        config['Workers'].getint('max_attempts', 3))
+
+
+def collectionTaskKey(rowInDB):
+    return 'collection/{}/{}'.format(rowInDB['institution_key'], rowInDB['collection_key'])
+
+
+def enqueueCollections(rows):
+    '''Add a task to the work queue for each of the given collections that isn't already in it.'''
+
+    queue = getWorkQueue()
+    added = 0
+    # tasks are claimed in the order they are queued in
+    for row in getScheduler(getHistory()).order(rows):
+        if queue.enqueue(collectionTaskKey(row), {'kind': 'collection', 'institution_key': row['institution_key'], 'collection_key': row['collection_key']}):
+            added += 1
+    logger.info('Queued {} collections'.format(added))
+    logger.info('Work queue: {waiting} waiting, {claimed} claimed, {dead} given up on'.format(**queue.counts()))
+    queue.close()
+
+
+def worker(workerId=None, lease=300.0, batchSize=0, poll=0.0):
+    '''
+    Claim collections from the work queue and sync them, until there are none left (or, if `poll` is positive, forever, checking for new ones every `poll` seconds).
+
+    If `batchSize` is positive, the changes that resync reports are queued in batches of that many records instead of being indexed right away, so that they are indexed by whichever workers are free. This needs `file_path_map_to` to be on a filesystem that the workers share, and isn't done for collections whose records are packed.
+
+    Since each node keeps its own thumbnail index (Thumbnails.index_path), which doesn't know about the records that other nodes have indexed, workers never delete thumbnails, even once no record refers to them.
+    '''
+
+    queue = getWorkQueue()
+    if workerId is None:
+        workerId = '{}-{}'.format(socket.gethostname(), os.getpid())
+    logger.info('Working as {}'.format(workerId))
+
+    solr = getSolr()
+    db = getDatabase()
+    retryQueue = getRetryQueue()
+    drainRetryQueue(solr, retryQueue)
+    deletionQueue = getDeletionQueue(retryQueue)
+    archive = getArchive()
+    history = getHistory()
+
+    while True:
+        task = queue.claim(workerId, lease)
+        if task is None:
+            if poll <= 0:
+                break
+            time.sleep(poll)
+            continue
+
+        rows = selectRows(db, [task.payload['institution_key']], [task.payload['collection_key']])
+        if len(rows) == 0:
+            logger.warning('Collection of task {} is not in the database anymore'.format(task.key))
+            queue.complete(task)
+            continue
+        row = rows[0]
+
+        logger.info('Claimed task {} (attempt {})'.format(task.key, task.attempts))
+        with LeaseKeeper(queue, task, lease) as keeper:
+            try:
+                if task.payload['kind'] == 'collection':
+                    onBatch = None
+                    if batchSize > 0 and recordPack(row) is None:
+                        batchKeys = ('{}/batch/{}-{}-{}'.format(task.key, workerId, task.attempts, i) for i in itertools.count())
+                        onBatch = lambda actions: queue.enqueue(next(batchKeys), {
+                            'kind': 'batch',
+                            'institution_key': row['institution_key'],
+                            'collection_key': row['collection_key'],
+                            'actions': [list(action) for action in actions]
                             })
-                        '''
-                        continue
+                    deadline = budgetDeadline(config['Scheduler'].getfloat('collection_budget', 0))
+                    syncCollection(solr, db, retryQueue, deletionQueue, archive, row, onBatch, batchSize or 1000, keeper.lost, deadline, history)
+                else:
+                    indexResyncActions(solr, retryQueue, deletionQueue, archive, row, [ResyncAction(*action) for action in task.payload['actions']])
+                    solr.flush()
+            except Exception as e:
+                logger.error('Something went wrong while working on task {}: {}'.format(task.key, e))
+                queue.release(task, backoffDelay(task.attempts, 30.0, 600.0))
+                continue
+
+        if keeper.lost.is_set():
+            # another worker has claimed it
+            logger.warning('Abandoned task {}'.format(task.key))
+            continue
+        queue.complete(task)
+
+    logger.info('Work queue: {waiting} waiting, {claimed} claimed, {dead} given up on'.format(**queue.counts()))
+    queue.close()
+    finishRun(solr, retryQueue, deletionQueue, archive, sweep=False)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Synchronize collections from ResourceSync source servers and index them in Solr. Run without a command to synchronize every collection in the database.')
+    parser.set_defaults(command='sync')
+    subparsers = parser.add_subparsers(title='commands', metavar='COMMAND', description='For detailed usage instructions, run `python3 destination.py COMMAND -h`.')
+
+    ### Subcommand - reindex
+    parser_reindex = subparsers.add_parser('reindex', description='Rebuild Solr documents from the record files that have already been synced, without running resync or looking for thumbnails again.', help='rebuild the Solr index from disk')
+    parser_reindex.set_defaults(command='reindex')
+    parser_reindex.add_argument('--institution-key', metavar='<institution-key>', action='append', dest='institution_keys', help='only reindex collections of this institution (may be repeated)')
+    parser_reindex.add_argument('--collection-key', metavar='<collection-key>', action='append', dest='collection_keys', help='only reindex this collection (may be repeated)')
+    parser_reindex.add_argument('--workers', metavar='<n>', type=int, help='number of worker processes (if unspecified, defaults to the number of CPUs)')
+    parser_reindex.add_argument('--batch-size', metavar='<n>', type=int, default=1000, help='number of documents to send to Solr at once (if unspecified, defaults to 1000)')
+    parser_reindex.add_argument('--output', metavar='<path>', help='write a bulk update file to this path instead of sending documents to Solr')
+    parser_reindex.add_argument('--format', choices=['json', 'csv'], default='json', help='format of the bulk update file: "json" or "csv" (if unspecified, defaults to "json")')
+
+    ### Subcommand - update-metadata
+    parser_metadata = subparsers.add_parser('update-metadata', description='Update the collection and institution names in the Solr documents of collections that have been renamed in the database, using atomic updates. By default, only collections that have been renamed with `PRRLATinyDB.import_collections(..., overwrite=True)` since the last update are processed.', help='push renamed collections and institutions to Solr')
+    parser_metadata.set_defaults(command='update-metadata')
+    parser_metadata.add_argument('--institution-key', metavar='<institution-key>', action='append', dest='institution_keys', help='update collections of this institution, even if they haven\'t been renamed (may be repeated)')
+    parser_metadata.add_argument('--collection-key', metavar='<collection-key>', action='append', dest='collection_keys', help='update this collection, even if it hasn\'t been renamed (may be repeated)')
+    parser_metadata.add_argument('--ids-from', choices=['solr', 'local'], default='solr', help='where to get the IDs of the documents to update: "solr" (query the index) or "local" (read the synced record files) (if unspecified, defaults to "solr")')
+    parser_metadata.add_argument('--batch-size', metavar='<n>', type=int, default=1000, help='number of documents to update at once (if unspecified, defaults to 1000)')
+
+    ### Subcommand - purge
+    parser_purge = subparsers.add_parser('purge', description='Remove collections from the database along with their Solr documents, thumbnails, and synced record files.', help='remove collections and all of their data')
+    parser_purge.set_defaults(command='purge')
+    parser_purge.add_argument('institution_key', metavar='<institution-key>', help='institution whose collections to remove')
+    parser_purge.add_argument('--collection-key', metavar='<collection-key>', action='append', dest='collection_keys', help='only remove this collection (may be repeated)')
+    parser_purge.add_argument('--dry-run', action='store_true', help='only report what would be removed')
+    parser_purge.add_argument('--workers', metavar='<n>', type=int, default=8, help='number of threads that remove local files (if unspecified, defaults to 8)')
+
+    ### Subcommand - migrate-layout
+    parser_migrate = subparsers.add_parser('migrate-layout', description='Move synced record files and thumbnails to where they belong in the layouts set in destination.ini (see Layout.records and Layout.thumbnails). Run this after changing either, before syncing again.', help='move files on disk to a new layout')
+    parser_migrate.set_defaults(command='migrate-layout')
+    parser_migrate.add_argument('--institution-key', metavar='<institution-key>', action='append', dest='institution_keys', help='only move the record files of this institution (may be repeated)')
+    parser_migrate.add_argument('--collection-key', metavar='<collection-key>', action='append', dest='collection_keys', help='only move the record files of this collection (may be repeated)')
+    parser_migrate.add_argument('--no-thumbnails', action='store_false', dest='thumbnails', help="don't move thumbnails")
+
+    ### Subcommand - compact
+    parser_compact = subparsers.add_parser('compact', description='Rewrite the packed records of collections (see Layout.records in destination.ini) without the records that have been replaced or deleted.', help='reclaim the space of replaced and deleted packed records')
+    parser_compact.set_defaults(command='compact')
+    parser_compact.add_argument('--institution-key', metavar='<institution-key>', action='append', dest='institution_keys', help='only compact collections of this institution (may be repeated)')
+    parser_compact.add_argument('--collection-key', metavar='<collection-key>', action='append', dest='collection_keys', help='only compact this collection (may be repeated)')
+
+    ### Subcommand - schedule
+    parser_schedule = subparsers.add_parser('schedule', description='Show the order in which collections would be synced (see Scheduler in destination.ini), and the history that it is based on, without syncing them.', help='show the order of the next sync')
+    parser_schedule.set_defaults(command='schedule')
+
+    ### Subcommand - plan
+    parser_plan = subparsers.add_parser('plan', description='Estimate what syncing collections would do, from their ResourceLists and ChangeLists alone, without writing anything to Solr, S3, the database, or the local filesystem. Collections that aren\'t in the database yet can be planned with --source-description and --oaipmh-endpoint (see `PRRLATinyDB.import_collections`).', help='estimate the cost of the next sync')
+    parser_plan.set_defaults(command='plan')
+    parser_plan.add_argument('--institution-key', metavar='<institution-key>', action='append', dest='institution_keys', help='only plan collections of this institution (may be repeated)')
+    parser_plan.add_argument('--collection-key', metavar='<collection-key>', action='append', dest='collection_keys', help='only plan this collection (may be repeated)')
+    parser_plan.add_argument('--source-description', metavar='<url>', help='plan the baselines of the collections in this ResourceSync SourceDescription instead of those in the database')
+    parser_plan.add_argument('--oaipmh-endpoint', metavar='<url>', help='OAI-PMH endpoint of the institution of --source-description')
+    parser_plan.add_argument('--workers', metavar='<n>', type=int, default=config['Plan'].getint('workers', 8), help='number of documents to fetch at the same time (if unspecified, defaults to Plan.workers)')
+    parser_plan.add_argument('--runaway-ratio', metavar='<ratio>', type=float, default=config['Plan'].getfloat('runaway_ratio', 0.5), help='flag incremental syncs that would change more than this fraction of a collection (if unspecified, defaults to Plan.runaway_ratio)')
+
+    ### Subcommand - enqueue
+    parser_enqueue = subparsers.add_parser('enqueue', description='Add collections to the work queue (see Workers.queue_path in destination.ini), to be synced by `worker` processes on one or more nodes.', help='queue collections for workers')
+    parser_enqueue.set_defaults(command='enqueue')
+    parser_enqueue.add_argument('--institution-key', metavar='<institution-key>', action='append', dest='institution_keys', help='only queue collections of this institution (may be repeated)')
+    parser_enqueue.add_argument('--collection-key', metavar='<collection-key>', action='append', dest='collection_keys', help='only queue this collection (may be repeated)')
+
+    ### Subcommand - worker
+    parser_worker = subparsers.add_parser('worker', description='Claim collections from the work queue and sync them, until there are none left.', help='sync collections from the work queue')
+    parser_worker.set_defaults(command='worker')
+    parser_worker.add_argument('--id', metavar='<id>', dest='worker_id', help='name of this worker in the queue (if unspecified, defaults to the hostname and process ID)')
+    parser_worker.add_argument('--lease', metavar='<seconds>', type=float, default=config['Workers'].getfloat('lease', 300), help='number of seconds after which a task is claimed by another worker if this one stops renewing its lease (if unspecified, defaults to Workers.lease)')
+    parser_worker.add_argument('--batch-size', metavar='<n>', type=int, default=config['Workers'].getint('batch_size', 0), help='queue the changes of each collection in batches of this many records, to be indexed by any worker (if unspecified, defaults to Workers.batch_size; 0 to index them right away)')
+    parser_worker.add_argument('--poll', metavar='<seconds>', type=float, default=0, help='keep running, checking the queue this often, instead of exiting when it is empty')
+
+    ### Subcommand - thumbnails
+    parser_thumbnails = subparsers.add_parser('thumbnails', description='Get the thumbnails of records that have been indexed without them, and set their URLs on the Solr documents with atomic updates. Use this when `Thumbnails.defer` is enabled in destination.ini.', help='get the thumbnails of synced records')
+    parser_thumbnails.set_defaults(command='thumbnails')
+    parser_thumbnails.add_argument('--workers', metavar='<n>', type=int, default=config['Thumbnails'].getint('workers', 8), help='number of threads that get thumbnails (if unspecified, defaults to Thumbnails.workers)')
+    parser_thumbnails.add_argument('--batch-size', metavar='<n>', type=int, default=config['Thumbnails'].getint('batch_size', 100), help='number of thumbnail URLs to set per Solr update (if unspecified, defaults to Thumbnails.batch_size)')
+
+    ### Subcommand - reload
+    parser_reload = subparsers.add_parser('reload', description='Index the current Solr documents of collections from the archive (see Archive.path in destination.ini), without reading record files or looking for thumbnails.', help='reload Solr from the archive')
+    parser_reload.set_defaults(command='reload')
+    parser_reload.add_argument('--institution-key', metavar='<institution-key>', action='append', dest='institution_keys', help='only reload collections of this institution (may be repeated)')
+    parser_reload.add_argument('--collection-key', metavar='<collection-key>', action='append', dest='collection_keys', help='only reload this collection (may be repeated)')
+    parser_reload.add_argument('--batch-size', metavar='<n>', type=int, default=5000, help='number of documents to send to Solr at once (if unspecified, defaults to 5000)')
+
+    args = parser.parse_args()
+
+    logger.info('--- STARTING RUN ---')
+    logger.info('')
+
+    if args.command == 'reindex':
+        rows = selectRows(getDatabase(), args.institution_keys, args.collection_keys)
+        reindex(rows, args.workers, args.batch_size, args.output, args.format, getArchive())
+    elif args.command == 'update-metadata':
+        db = getDatabase()
+        if args.institution_keys is None and args.collection_keys is None:
+            rows = [row for row in db if row.get('solr_metadata_stale') is True]
+        else:
+            rows = selectRows(db, args.institution_keys, args.collection_keys)
+        updateMetadata(db, rows, args.ids_from, args.batch_size, getArchive())
+    elif args.command == 'purge':
+        db = getDatabase()
+        rows = selectRows(db, [args.institution_key], args.collection_keys)
+        purge(db, rows, args.dry_run, args.workers)
+    elif args.command == 'migrate-layout':
+        rows = selectRows(getDatabase(), args.institution_keys, args.collection_keys)
+        migrateLayout(rows, args.thumbnails)
+    elif args.command == 'schedule':
+        showSchedule(list(getDatabase()))
+    elif args.command == 'plan':
+        if args.source_description is not None:
+            if args.oaipmh_endpoint is None:
+                parser_plan.error('--source-description requires --oaipmh-endpoint')
+            rows = discoverCollections(args.source_description, args.oaipmh_endpoint, args.collection_keys)
+            runs = None
+        else:
+            rows = selectRows(getDatabase(), args.institution_keys, args.collection_keys)
+            historyPath = os.path.abspath(os.path.expanduser(config['Scheduler'].get('history_path', '~/history.json')))
+            # don't create the history file if there isn't one
+            runs = getHistory().all() if os.path.exists(historyPath) else None
+        plan(rows, runs, args.workers, args.runaway_ratio)
+    elif args.command == 'enqueue':
+        rows = selectRows(getDatabase(), args.institution_keys, args.collection_keys)
+        enqueueCollections(rows)
+    elif args.command == 'worker':
+        worker(args.worker_id, args.lease, args.batch_size, args.poll)
+    elif args.command == 'compact':
+        rows = selectRows(getDatabase(), args.institution_keys, args.collection_keys)
+        compactRecordPacks(rows)
+    elif args.command == 'thumbnails':
+        retryQueue = getRetryQueue()
+        deletionQueue = getDeletionQueue(retryQueue)
+        archive = getArchive()
+        fetchThumbnails(getSolr(), retryQueue, deletionQueue, args.workers, args.batch_size, thumbnailProcesses(), archive)
+        deletionQueue.close()
+        if archive is not None:
+            archive.close()
+        for line in hostHealth.summary():
+            logger.info('Thumbnail host {}'.format(line))
+    elif args.command == 'reload':
+        rows = selectRows(getDatabase(), args.institution_keys, args.collection_keys)
+        reload(rows, args.batch_size)
+    else:
+        sync()
 
-        '''
-        # TODO: fault tolerance
-        # keep track of any documents that failed to get added to Solr
-        db.update({'_failures': failures}, Row['collection_key'] == row['collection_key'])
-        # TODO: consider the case where a document is added/updated/deleted from Solr after it fails. Do we do a check each time we do some action to see if it exists in a _failures property?
-        '''
+    closeRecordPacks()
 
     logger.info('')
     logger.info('---  ENDING RUN  ---\n')
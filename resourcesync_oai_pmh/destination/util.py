@@ -2,29 +2,80 @@
 
 from bs4 import BeautifulSoup
 import collections
+from concurrent.futures import ThreadPoolExecutor, wait
 import csv
 from datetime import date
 from dateutil.parser import parse
 import functools
 from functools import reduce
+import glob
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
 from json import dumps
 import logging
 import logging.config
+from lxml import etree
+import mmap
 import os
+import pysolr
+import queue
+import random
 import re
-from requests import get
+from requests import Session, get
+from requests.adapters import HTTPAdapter
 from sickle import Sickle
+import sqlite3
+import struct
 import sys
+import threading
+import time
 from tinydb import TinyDB, Query
 import urllib.parse
+import uuid
+import validators
+import zlib
 import pdb
 
+try:
+    from PIL import Image
+except ImportError:
+    # thumbnails are uploaded as they are
+    Image = None
+
+try:
+    import numpy
+except ImportError:
+    # decade facets of columns are computed in pure Python
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Solr documents aren't archived
+    pyarrow = None
+
+logger = logging.getLogger('root')
+
 
 class DateCleanerAndFaceter:
     '''
     Class for cleaning and creating decade or year facets for dates.
     '''
 
+    # fast path for the most common shapes of dates: YYYY, YYYY-MM, YYYY-MM-DD, and ISO 8601 timestamps
+    isoDate = re.compile(r'\s*([1-9]\d{3})(?:-(?:0[1-9]|1[0-2])(?:-(?:0[1-9]|[12]\d|3[01])(?:[T ](?:[01]\d|2[0-3]):[0-5]\d(?::[0-5]\d(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?)?)?\s*$')
+
+    # the same in the ISO 8601 basic format (YYYYMMDD, YYYYMMDDTHHMMSS), which the dirty date patterns would split into several years
+    isoBasicDate = re.compile(r'\s*([1-9]\d{3})(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])(?:T(?:[01]\d|2[0-3])[0-5]\d(?:[0-5]\d(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?\s*$')
+
+    # numeric dates with the day or month first (DD-MM-YYYY, MM-DD-YYYY, MM-YYYY, and the same with 2 digit years), which the dirty date patterns would mistake for years with a mystery one's digit; these are left to dateutil
+    numericDate = re.compile(r'\s*(?:\d{1,2}-)?\d{1,2}-(?:\d{2}|\d{4})\s*$')
+
     def __init__(self, data):
         '''
         Initialize the object for use.
@@ -33,54 +84,63 @@ class DateCleanerAndFaceter:
         '''
 
         self.data = data
+        self.regexes = self.__sharedRegexes()
+
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def __sharedRegexes():
+        '''
+        Returns the regular expressions used for matching non-standard date formats. They are only built once.
+        '''
 
-        # regular expressions used for matching non-standard date formats
         # TODO: move to separate file
-        self.regexes = {
+        regexes = {
             'match': {},
             'substitution': {},
-            'capture': {}
+            'capture': {},
+            'compiled': {}
             }
 
         # years before 0
-        self.regexes['match']['suffix-bce'] = r'BC|B\.C\.|BCE|B\.C\.E\.'
+        regexes['match']['suffix-bce'] = r'BC|B\.C\.|BCE|B\.C\.E\.'
 
         # years after 0
-        self.regexes['match']['suffix-ce']= r'AD|A\.D\.|CE|C\.E\.'
+        regexes['match']['suffix-ce']= r'AD|A\.D\.|CE|C\.E\.'
 
         # a suffix may indicate years before 0 or years after 0
-        self.regexes['match']['suffix'] = r'(?:{}|{})'.format(
-            self.regexes['match']['suffix-bce'],
-            self.regexes['match']['suffix-ce'])
+        regexes['match']['suffix'] = r'(?:{}|{})'.format(
+            regexes['match']['suffix-bce'],
+            regexes['match']['suffix-ce'])
 
         # two-digit representation of a month: 01 - 12
-        self.regexes['match']['mm'] = r'(?:0[1-9]|1[0-2])'
+        regexes['match']['mm'] = r'(?:0[1-9]|1[0-2])'
 
         # two-digit representation of a day of a month: 01 - 31
-        self.regexes['match']['dd'] = r'(?:0[1-9]|[1-2]\d|3[0-1])'
+        regexes['match']['dd'] = r'(?:0[1-9]|[1-2]\d|3[0-1])'
 
         # three-character representation of a month
-        self.regexes['match']['mon'] = r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)'
+        regexes['match']['mon'] = r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)'
 
         # time: e.g., 02:00 am, 12:55 P.M., 3:40
-        self.regexes['match']['time'] = r'\d{1,2}[.:]\d{2}(?:[apAP]\.?[mM]\.?)?'
+        regexes['match']['time'] = r'\d{1,2}[.:]\d{2}(?:[apAP]\.?[mM]\.?)?'
 
         # require a 1 or 2 digit year to have a suffix
-        self.regexes['match']['year0,1'] = r'[1-9]\d{{0,1}}'
-        self.regexes['match']['year0,1-plus-suffix'] = r'{} {}'.format(
-            self.regexes['match']['year0,1'],
-            self.regexes['match']['suffix'])
+        regexes['match']['year0,1'] = r'[1-9]\d{{0,1}}'
+        regexes['match']['year0,1-plus-suffix'] = r'{} {}'.format(
+            regexes['match']['year0,1'],
+            regexes['match']['suffix'])
 
         # 3 or 4 digit years may or may not have a suffix
-        self.regexes['match']['year2,3'] = r'[1-9]\d{{2,3}}'.format(self.regexes['match']['suffix'])
-        self.regexes['match']['year2,3-plus-suffix'] = r'{}(?: {})?'.format(
-            self.regexes['match']['year2,3'],
-            self.regexes['match']['suffix'])
+        regexes['match']['year2,3'] = r'[1-9]\d{{2,3}}'.format(regexes['match']['suffix'])
+        regexes['match']['year2,3-plus-suffix'] = r'{}(?: {})?'.format(
+            regexes['match']['year2,3'],
+            regexes['match']['suffix'])
 
         # a year can have 1, 2, 3, or 4 digits, and may or may not have a suffix according to the above
-        self.regexes['match']['year'] = r'(?:{}|{})'.format(
-            self.regexes['match']['year0,1-plus-suffix'],
-            self.regexes['match']['year2,3-plus-suffix'])
+        regexes['match']['year'] = r'(?:{}|{})'.format(
+            regexes['match']['year0,1-plus-suffix'],
+            regexes['match']['year2,3-plus-suffix'])
 
         #
         # year ranges
@@ -88,73 +148,78 @@ class DateCleanerAndFaceter:
 
         # parsing them is complicated, so we'll have a subset of special rules for them
         # we want to capture certain aspects of the year range
-        self.regexes['capture']['year0,1-plus-suffix'] = r'({}) ({})'.format(
-            self.regexes['match']['year0,1'],
-            self.regexes['match']['suffix'])
+        regexes['capture']['year0,1-plus-suffix'] = r'({}) ({})'.format(
+            regexes['match']['year0,1'],
+            regexes['match']['suffix'])
 
         # 3 or 4 digit years may or may not have a suffix
-        self.regexes['capture']['year2,3-plus-suffix'] = r'({})(?: ({}))?'.format(
-            self.regexes['match']['year2,3'],
-            self.regexes['match']['suffix'])
+        regexes['capture']['year2,3-plus-suffix'] = r'({})(?: ({}))?'.format(
+            regexes['match']['year2,3'],
+            regexes['match']['suffix'])
 
         # a year can have 1, 2, 3, or 4 digits, and may or may not have a suffix according to the above
         # 1: 1-2 digit year
         # 2: suffix
         # 3: 3-4 digit year
         # 4: suffix
-        self.regexes['capture']['year'] = r'(?:{}|{})'.format(
-            self.regexes['capture']['year0,1-plus-suffix'],
-            self.regexes['capture']['year2,3-plus-suffix'])
+        regexes['capture']['year'] = r'(?:{}|{})'.format(
+            regexes['capture']['year0,1-plus-suffix'],
+            regexes['capture']['year2,3-plus-suffix'])
 
         # sometimes metadata indicates uncertainty about a year, either with a question mark at the end or some other character in place of the one's digit
-        self.regexes['match']['year?'] = r'[1-9]\d{1,2}\d?[-*?]'
+        # (but not a day of the month followed by a month name, like "13-Mar-76")
+        regexes['match']['year?'] = r'[1-9]\d{1,2}\d?[-*?](?![A-Za-z])'
 
         # matches a year followed by a 2 digit month (must not be followed by another digit), the year can have a mystery one's place
         # assume that if a month is given, there's no suffix
-        self.regexes['match']['year-mm'] = r'{}(?:(?:[-/]{})|[-*?])?(?=\D|$)'.format(
-            self.regexes['match']['year'],
-            self.regexes['match']['mm'])
+        regexes['match']['year-mm'] = r'{}(?:(?:[-/]{})|[-*?])?(?=\D|$)'.format(
+            regexes['match']['year'],
+            regexes['match']['mm'])
 
         # matches a range of years, separated by either - or /
-        self.regexes['match']['year-year'] = r'{}\s*[-/]\s*{}'.format(
-            self.regexes['match']['year-mm'],
-            self.regexes['match']['year-mm'])
+        regexes['match']['year-year'] = r'{}\s*[-/]\s*{}'.format(
+            regexes['match']['year-mm'],
+            regexes['match']['year-mm'])
 
-        self.regexes['match']['dd-mon-year-time'] = r'{}\s+{}\s+{}(?:\.\s+{})?'.format(
-            self.regexes['match']['dd'],
-            self.regexes['match']['mon'],
-            self.regexes['match']['year'],
-            self.regexes['match']['time'])
+        regexes['match']['dd-mon-year-time'] = r'{}\s+{}\s+{}(?:\.\s+{})?'.format(
+            regexes['match']['dd'],
+            regexes['match']['mon'],
+            regexes['match']['year'],
+            regexes['match']['time'])
 
         # matches a century string
-        self.regexes['match']['century'] = r'(?:1st|2nd|3rd|(?:[4-9]|1[0-9]|20)th)\s+[cC](?:entury)?'
-        self.regexes['match']['century-plus-suffix'] = r'{}(?:\s+{})?'.format(
-            self.regexes['match']['century'],
-            self.regexes['match']['suffix'])
+        regexes['match']['century'] = r'(?:1st|2nd|3rd|(?:[4-9]|1[0-9]|20)th)\s+[cC](?:entury)?'
+        regexes['match']['century-plus-suffix'] = r'{}(?:\s+{})?'.format(
+            regexes['match']['century'],
+            regexes['match']['suffix'])
 
         # order of alternate patterns is important
-        self.regexes['match']['date'] = r'(?:({})|({})|({})|({})|({}))'.format(
-            self.regexes['match']['century-plus-suffix'],
-            self.regexes['match']['year-year'],
-            self.regexes['match']['dd-mon-year-time'],
-            self.regexes['match']['year?'],
-            self.regexes['match']['year'])
+        regexes['match']['date'] = r'(?:({})|({})|({})|({})|({}))'.format(
+            regexes['match']['century-plus-suffix'],
+            regexes['match']['year-year'],
+            regexes['match']['dd-mon-year-time'],
+            regexes['match']['year?'],
+            regexes['match']['year'])
 
         # split the year range in half
-        self.regexes['substitution']['year-year-splitter'] = r'({})\s*[-/]\s*({})'.format(
-            self.regexes['match']['year-mm'],
-            self.regexes['match']['year-mm'])
+        regexes['substitution']['year-year-splitter'] = r'({})\s*[-/]\s*({})'.format(
+            regexes['match']['year-mm'],
+            regexes['match']['year-mm'])
 
-        self.regexes['substitution']['dd-mon-year-time'] = r'{}\s+{}\s+({})(?:\.\s+{})?'.format(
-            self.regexes['match']['dd'],
-            self.regexes['match']['mon'],
-            self.regexes['match']['year'],
-            self.regexes['match']['time'])
+        regexes['substitution']['dd-mon-year-time'] = r'{}\s+{}\s+({})(?:\.\s+{})?'.format(
+            regexes['match']['dd'],
+            regexes['match']['mon'],
+            regexes['match']['year'],
+            regexes['match']['time'])
 
         # capture century info
-        self.regexes['capture']['century-plus-suffix'] = r'({})(?:\s+({}))?'.format(
-            self.regexes['match']['century'],
-            self.regexes['match']['suffix'])
+        regexes['capture']['century-plus-suffix'] = r'({})(?:\s+({}))?'.format(
+            regexes['match']['century'],
+            regexes['match']['suffix'])
+
+        regexes['compiled']['date'] = re.compile(regexes['match']['date'])
+
+        return regexes
 
 
     # Public methods
@@ -164,27 +229,10 @@ class DateCleanerAndFaceter:
         '''
         Returns a set of decades that covers all of the years and year ranges in the data.
 
-        disjoint - whether or not tp exclude decades in the interim between the earliest and latest decades
+        disjoint - whether or not to exclude decades in the interim between the earliest and latest decades
         '''
 
-        try:
-            return self.decadeSet
-
-        except AttributeError:
-            # set self.decadeSet and return it
-            self.decadeSet = set()
-            try:
-                # multi valued
-                assert isinstance(self.data, set)
-                for datum in self.data:
-                    preprocessedYearData = self.__extractYearData(datum)
-                    self.decadeSet = self.decadeSet | self.__enumerateDecades(preprocessedYearData, disjoint)
-            except (AssertionError, TypeError):
-                # single value
-                preprocessedYearData = self.__extractYearData(self.data)
-                self.decadeSet = self.decadeSet | self.__enumerateDecades(preprocessedYearData, disjoint)
-
-            return self.decadeSet
+        return self.__enumerateDecades(self.intervals(disjoint))
 
 
     def years(self, disjoint=True):
@@ -194,25 +242,116 @@ class DateCleanerAndFaceter:
         disjoint - whether or not to exclude years in the interim between the earliest and latest years
         '''
 
+        return self.__enumerateYears(self.intervals(disjoint))
+
+
+    def intervals(self, disjoint=True):
+        '''
+        Returns a sorted list of non-overlapping (start, end) tuples of years that covers all of the years and year ranges in the data. Single years are represented as (year, year).
+
+        disjoint - if False, return a single interval that spans from the earliest to the latest year
+        '''
+
         try:
-            return self.yearSet
+            merged = self.mergedIntervals
 
         except AttributeError:
-            # set self.yearSet and return it
-            self.yearSet= set()
-            try:
+            # set self.mergedIntervals and return it
+            if isinstance(self.data, (set, frozenset, list, tuple)):
                 # multi valued
-                assert isinstance(self.data, set)
-                for datum in self.data:
-                    preprocessedYearData = self.__extractYearData(datum)
-                    self.yearSet= self.yearSet | self.__enumerateYears(preprocessedYearData, disjoint)
-
-            except TypeError:
+                data = self.data
+            else:
                 # single value
-                preprocessedYearData = self.__extractYearData(self.data)
-                self.yearSet = self.__enumerateYears(preprocessedYearData, disjoint)
+                data = [self.data]
+
+            intervals = []
+            for datum in data:
+                if isinstance(datum, str):
+                    for yearData in self.__extractYearData(datum):
+                        interval = self.__toInterval(yearData)
+                        if interval is not None:
+                            intervals.append(interval)
+
+            self.mergedIntervals = merged = self.mergeIntervals(intervals)
+
+        if disjoint or len(merged) == 0:
+            return merged
+        else:
+            return [(merged[0][0], merged[-1][1])]
+
+
+    @staticmethod
+    def mergeIntervals(intervals):
+        '''
+        Returns a sorted list of non-overlapping intervals that covers the same years as the given intervals. Intervals that overlap or are adjacent are merged.
+
+        intervals - an iterable of (start, end) tuples of years
+        '''
+
+        merged = []
+        for start, end in sorted(intervals):
+            if len(merged) > 0 and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+
+    @staticmethod
+    def dateRangeValue(interval):
+        '''
+        Returns a string that represents an interval of years as a value of a Solr DateRangeField, e.g. "1922" or "[1922 TO 1927]".
+
+        Years before 0 are converted to the ISO 8601 numbering that Solr uses, in which year 0 is 1 BCE.
+
+        interval - a (start, end) tuple of years
+        '''
+
+        def isoYear(year):
+            if year < 0:
+                return '-{:04d}'.format(-(year + 1))
+            else:
+                return '{:04d}'.format(year)
 
-            return self.yearSet
+        start, end = interval
+        if start == end:
+            return isoYear(start)
+        else:
+            return '[{} TO {}]'.format(isoYear(start), isoYear(end))
+
+
+    @staticmethod
+    def decadeColumn(intervalColumn):
+        '''
+        Returns a list of sets of decades, one for each row of a column of normalized intervals, like the ones returned by `intervals`. Each set is the same as what `decades` returns for the row.
+
+        With numpy, the decades of the whole column are computed with array operations, and only put into sets on output; without it, they're computed an interval at a time.
+
+        intervalColumn - a list whose elements are lists of (start, end) tuples of years
+        '''
+
+        decades = [set() for intervals in intervalColumn]
+        if numpy is None:
+            for i, intervals in enumerate(intervalColumn):
+                for start, end in intervals:
+                    decades[i].update(range(start // 10 * 10, end // 10 * 10 + 1, 10))
+            return decades
+
+        # flatten the column into parallel arrays of interval bounds, remembering which row each interval belongs to
+        counts = numpy.fromiter((len(intervals) for intervals in intervalColumn), dtype=numpy.int64, count=len(intervalColumn))
+        bounds = numpy.fromiter((year for intervals in intervalColumn for interval in intervals for year in interval), dtype=numpy.int64, count=2 * int(counts.sum())).reshape(-1, 2)
+        rows = numpy.repeat(numpy.arange(len(intervalColumn)), counts)
+
+        # round every bound down to its decade, and expand each interval into the decades it covers
+        startDecades = bounds[:, 0] // 10 * 10
+        lengths = (bounds[:, 1] // 10 * 10 - startDecades) // 10 + 1
+        offsets = numpy.arange(int(lengths.sum())) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        years = numpy.repeat(startDecades, lengths) + 10 * offsets
+
+        for i, decade in zip(numpy.repeat(rows, lengths).tolist(), years.tolist()):
+            decades[i].add(decade)
+        return decades
 
 
     # Private methods
@@ -232,7 +371,7 @@ class DateCleanerAndFaceter:
             4 -> 'year'
         '''
 
-        years = set()
+        years = None
         try:
             if m[0] != '':
                 # year-range derived from a century
@@ -327,31 +466,53 @@ class DateCleanerAndFaceter:
         return years
 
 
-    def __enumerateDecades(self, preprocessedData, disjoint):
+    def __enumerateDecades(self, intervals):
         '''
-        Return a set of decades. If disjoint is false, returns a set of decades that spans the entire range.
+        Return the set of decades that the given intervals cover.
 
-        preprocessedData - a heterogeneous set of ints and tuples of ints
+        intervals - a list of (start, end) tuples of years
         '''
 
-        if disjoint:
-            decades = set()
-            for decade in preprocessedData:
-                if isinstance(decade, int):
-                    decades.add(decade // 10 * 10)
-                elif isinstance(decade, tuple):
-                    decades = decades | set(range(decade[0] // 10 * 10, decade[1] + 1, 10))
+        decades = set()
+        for start, end in intervals:
+            decades.update(range(start // 10 * 10, end // 10 * 10 + 1, 10))
+        return decades
 
-            return decades
 
+    def __enumerateYears(self, intervals):
+        '''
+        Return the set of years that the given intervals cover.
+
+        intervals - a list of (start, end) tuples of years
+        '''
+
+        years = set()
+        for start, end in intervals:
+            years.update(range(start, end + 1))
+        return years
 
-    def __enumerateYears(self, preprocessedData, disjoint):
+
+    def __toInterval(self, yearData):
         '''
-        Return a set of years. If disjoint is false, returns a set of years that spans the entire range.
+        Return a (start, end) tuple for a year or year range, or None if it is neither.
+
+        A range whose end comes before its start is only turned around when that's plausibly what was meant: both ends have the same number of digits (e.g. "1990-1980"), or it's BCE (e.g. "432-447 BC"). Otherwise (e.g. the ordinal date "1976-123") it isn't a range of years.
 
-        preprocessedData - a heterogeneous set of ints and tuples of ints
+        yearData - an int (year) or a tuple of ints (year range, start/end)
         '''
-        pass
+
+        if isinstance(yearData, int):
+            return (yearData, yearData)
+        elif isinstance(yearData, tuple) and len(yearData) == 2:
+            start, end = yearData
+            if start <= end:
+                return (start, end)
+            elif start < 0 or end < 0 or len(str(abs(start))) == len(str(abs(end))):
+                return (end, start)
+            else:
+                return None
+        else:
+            return None
 
 
     def __extractYearData(self, dateString):
@@ -361,25 +522,35 @@ class DateCleanerAndFaceter:
         dateString - the string containing the dirty date
         '''
 
+        # cheapest first: plain years, ISO 8601 dates and timestamps
+        m = self.isoDate.match(dateString) or self.isoBasicDate.match(dateString)
+        if m is not None:
+            return {int(m.group(1))}
+
+        alpha = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+        if self.numericDate.match(dateString.lstrip(alpha + ' .')) is not None:
+            try:
+                return {parse(dateString.lstrip(alpha + ' .')).year}
+            except (ValueError, OverflowError):
+                pass
+
+        # find as many substrings that look like dates as possible
+        matches = self.regexes['compiled']['date'].findall(dateString)
+        #logger.debug('{} date string matches found in "{}"'.format(len(matches), dateString))
+        if len(matches) > 0:
+            return {self.__dateMatchToIntOrTuple(m) for m in matches}
+
         try:
-            # first see if dateutil can parse the date string
-            # simplest case, a single year
+            # last resort: see if dateutil can parse the date string
             return {parse(dateString).year}
 
-        except ValueError:
+        except (ValueError, OverflowError):
             try:
                 # strip alphabetical chars and spaces from the left side and try again
-                alpha = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
                 return {parse(dateString.lstrip(alpha + ' ')).year}
 
-            except ValueError:
-                # find as many substrings that look like dates as possible
-                matches = re.findall(re.compile(self.regexes['match']['date']), dateString)
-                #logger.debug('{} date string matches found in "{}"'.format(len(matches), dateString))
-                if len(matches) > 0:
-                    return {self.__dateMatchToIntOrTuple(m) for m in matches}
-                else:
-                    return set()
+            except (ValueError, OverflowError):
+                return set()
 
 
     def __resolveUnknownOnes(self, i):
@@ -395,266 +566,2902 @@ class DateCleanerAndFaceter:
             return i if m is None else int(m.group(1) + '0')
 
 
-class HyperlinkRelevanceHeuristicSorter:
+ClassifiedUrl = collections.namedtuple('ClassifiedUrl', ['url', 'kind', 'netloc', 'path'])
+
+
+class UrlClassifier:
     '''
-    Sorts a list of hyperlinks in order of decreasing relevance based on the scoring heuristic.
+    Classifies URLs found in metadata records as images, landing pages, or invalid.
+
+    Each URL is validated and parsed only once; results are memoized, since hosts and URL shapes repeat heavily within a collection.
     '''
 
-    def __init__(self, heuristics, links):
+    IMAGE = 'image'
+    LANDING_PAGE = 'landing-page'
+    INVALID = 'invalid'
+
+    # path extensions that identify a URL as an image
+    imageExtension = re.compile(r'\.(?:jpe?g|png|tiff?)$', re.IGNORECASE)
+
+    def __init__(self, maxsize=65536):
         '''
-        heuristics - a dictionary consisting of the following keys:
-        - "host": a string retrieved from the netloc property of the return value of urllib.parse.urlparse
-        - "identifier": the local identifier portion of the OAI identifier as described in http://www.openarchives.org/OAI/2.0/guidelines-oai-identifier.htm if the identifier is structured that way, otherwise the entire OAI identifier
-        links - a list of HTTP URLs
+        maxsize - maximum number of classified URLs to remember
         '''
-        self.host = heuristics['host']
-        self.identifier = heuristics['identifier']
+        self.__cachedClassify = functools.lru_cache(maxsize=maxsize)(self.__classify)
 
-        self.links = self.__heuristicSort(links)
 
+    def classify(self, url):
+        '''
+        Return a ClassifiedUrl for the given string.
 
-    def mostRelevant(self):
-        '''Return the most relevant link.'''
+        url - a string that may or may not be a URL, or None
+        '''
 
-        return self.links[0]
+        if url is None:
+            return ClassifiedUrl(url, self.INVALID, None, None)
 
+        # make sure the cache doesn't hold on to a parse tree via a BeautifulSoup string
+        return self.__cachedClassify(str(url))
 
-    def rest(self):
-        '''Return the rest of the links.'''
 
-        return self.links[1:]
+    def cacheInfo(self):
+        '''Return the hit and miss statistics of the memoized classifications.'''
+
+        return self.__cachedClassify.cache_info()
+
+
+    def __classify(self, url):
+        if not validators.url(url):
+            return ClassifiedUrl(url, self.INVALID, None, None)
+
+        parsed = urllib.parse.urlparse(url)
+        if self.imageExtension.search(parsed.path) is not None:
+            kind = self.IMAGE
+        else:
+            kind = self.LANDING_PAGE
+        return ClassifiedUrl(url, kind, parsed.netloc, parsed.path)
 
 
-    def __heuristicSort(self, links):
+# shared by everything that classifies URLs, so that results are memoized across records
+urlClassifier = UrlClassifier()
+
+
+class ThumbnailRules:
+    '''
+    Per-collection rules for finding or rejecting thumbnail URLs without making network requests.
+
+    Rules are stored in the `thumbnail_rules` column of a collection's row in the database, as a dictionary with any of the following keys:
+    - "templates": a list of URL templates that produce the thumbnail URL of a record, with "{identifier}" (the local identifier) and "{record_identifier}" (the entire OAI identifier) placeholders
+    - "patterns": a list of regular expressions; a URL that matches one of them is a thumbnail
+    - "image_extensions": a list of path extensions (e.g., ".jpg"); a URL whose path ends with one of them is a thumbnail
+    - "non_image_hosts": a list of hosts that never serve thumbnails
+    '''
+
+    def __init__(self, rules=None, classifier=urlClassifier):
         '''
-        Sort links based on a heuristic for relevance.
+        rules - a dictionary as described above, or None
+        classifier - a UrlClassifier used to parse candidate URLs
+        '''
+        rules = rules or {}
+        self.templates = list(rules.get('templates', []))
+        self.patterns = [re.compile(pattern) for pattern in rules.get('patterns', [])]
+        self.imageExtensions = tuple(extension.lower() for extension in rules.get('image_extensions', []))
+        self.nonImageHosts = frozenset(rules.get('non_image_hosts', []))
+        self.classifier = classifier
+
+
+    def fromTemplates(self, identifier, recordIdentifier):
         '''
+        Return the list of thumbnail URLs produced by the templates for a record.
 
-        scores = {}
-        for link in links:
-            scores[link] = self.__score(link)
+        identifier - the local identifier of the record
+        recordIdentifier - the entire OAI identifier of the record
+        '''
 
-        links.sort(key=lambda x: scores[x], reverse=True)
-        return links
+        return [template.format(identifier=identifier, record_identifier=recordIdentifier) for template in self.templates]
 
 
-    def __score(self, link):
+    def judge(self, url):
         '''
-        Highest scoring links are most relevant.
+        Return True if the URL is a thumbnail, False if it isn't, and None if a request needs to be made to find out.
         '''
 
-        score = 0
-        if self.identifier in link:
-            score += 1
-        netloc = urllib.parse.urlparse(link).netloc
-        if self.host == netloc:
-            score += 1
-        return score
+        classified = self.classifier.classify(url)
+        if classified.kind == UrlClassifier.INVALID or classified.netloc in self.nonImageHosts:
+            return False
+        for pattern in self.patterns:
+            if pattern.search(url) is not None:
+                return True
+        if self.imageExtensions and classified.path.lower().endswith(self.imageExtensions):
+            return True
+        return None
 
 
-class PRRLATinyDB:
+class ThumbnailProbeStats:
     '''
-    Helper class for simplifying interactions with the TinyDB instance.
+    Keeps track of how thumbnail URLs were found for each host, in order to suggest rules that would avoid requests.
     '''
 
-    def __init__(self, path):
-        self.db = TinyDB(path)
+    TEMPLATE = 'template'
+    RULE_ACCEPTED = 'rule-accepted'
+    RULE_REJECTED = 'rule-rejected'
+    PROBE_HIT = 'probe-hit'
+    PROBE_MISS = 'probe-miss'
 
-
-    def show_collections(self, institution_keys=None):
+    def __init__(self, classifier=urlClassifier):
         '''
-        Prints a list of collections from the database.
+        classifier - a UrlClassifier used to parse URLs
+        '''
+        self.classifier = classifier
+        self.hosts = collections.defaultdict(collections.Counter)
+        self.hitExtensions = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
 
-        If a list of institution keys is specified (with values found in the 
-        `institution_key` column in the database), then show collections of 
-        only those institutions. Otherwise, show all collections in the 
-        database.
 
-        Args:
-          institution_keys: a list of values found in the `institution_key` 
-              column in the database
+    def record(self, url, outcome):
+        '''
+        Count the outcome of looking for a thumbnail at a URL.
 
-        Returns:
-          None
+        outcome - one of the constants defined on this class
         '''
-        # TODO: add parameter to choose which fields to print, or to print data in tabular form
-        if (institution_keys is None):
-            print(dumps(self.db.all(), indent=4))
-        else:
-            Row = Query()
-            results = []
-            for institution_key in institution_keys:
-                results += self.db.search(Row.institution_key == institution_key)
-            print(dumps(results, indent=4))
+
+        classified = self.classifier.classify(url)
+        with self.lock:
+            self.hosts[classified.netloc][outcome] += 1
+            if outcome == self.PROBE_HIT and classified.path is not None:
+                self.hitExtensions[classified.netloc][os.path.splitext(classified.path)[1].lower()] += 1
 
 
-    def import_collections(self, resourcesync_sourcedescription, oaipmh_endpoint, collection_keys=None, institution_name=None, resource_dir='resourcesync', overwrite=False):
+    def summary(self, minimumProbes=10):
         '''
-        Adds an institution's ResourceSync-able collections to the database.
+        Return a list of lines that describe the outcomes for each host, along with a suggested rule when requests to a host always have the same outcome.
 
-        If `collection_keys` is specified, then add to the database only
-        the collections specified by that list. Otherwise, add all collections 
-        to the database.
+        minimumProbes - number of requests to a host that must be made before suggesting a rule
+        '''
 
-        Args:
-          resourcesync_sourcedescription: a ResourceSync SourceDescription URL
-              see https://www.openarchives.org/rs/1.1/resourcesync#SourceDesc
-          oaipmh_endpoint: a OAI-PMH base URL
-              see https://www.openarchives.org/OAI/openarchivesprotocol.html#Identify
-          collection_keys: a list of collection keys specifying an
-              exclusive list of collections to add to the database
-          institution_name: human-readable name of the institution which
-              should be used instead of its OAI-PMH repositoryName
-          resource_dir: path to the local directory to store copies of the
-              synced resources to, relative to the home directory "~"
-          overwrite: whether or not to overwrite rows in the database that
-              match the `collection_key` and `institution_key`
+        lines = []
+        for host in sorted(self.hosts, key=lambda h: h or ''):
+            counts = self.hosts[host]
+            line = '{}: {} template, {} accepted by rule, {} rejected by rule, {} probe hits, {} probe misses'.format(
+                host,
+                counts[self.TEMPLATE],
+                counts[self.RULE_ACCEPTED],
+                counts[self.RULE_REJECTED],
+                counts[self.PROBE_HIT],
+                counts[self.PROBE_MISS])
+
+            probes = counts[self.PROBE_HIT] + counts[self.PROBE_MISS]
+            if probes >= minimumProbes:
+                if counts[self.PROBE_HIT] == 0:
+                    line += ' (suggested rule: "non_image_hosts": ["{}"])'.format(host)
+                elif counts[self.PROBE_MISS] == 0 and len(self.hitExtensions[host]) == 1:
+                    extension = next(iter(self.hitExtensions[host]))
+                    if extension != '':
+                        line += ' (suggested rule: "image_extensions": ["{}"])'.format(extension)
+                    else:
+                        line += ' (suggested rule: "patterns": ["^https?://{}/"])'.format(re.escape(host))
+            lines.append(line)
+        return lines
 
-        Returns:
-          None
+
+ProcessedThumbnail = collections.namedtuple('ProcessedThumbnail', ['data', 'extension', 'content_type', 'content_hash', 'perceptual_hash', 'width', 'height'])
+
+
+class ThumbnailProcessor:
+    '''
+    Shrinks thumbnails to fit within maximum dimensions and re-encodes them, so that full-size images (e.g., TIFFs) aren't uploaded as they are. Requires Pillow.
+
+    Each processed thumbnail comes with a SHA-256 hash of its contents, to find identical thumbnails, and a 64-bit difference hash ("dHash") of its pixels, to find thumbnails that look alike.
+    '''
+
+    formats = {
+        'JPEG': ('.jpg', 'image/jpeg'),
+        'WEBP': ('.webp', 'image/webp')
+        }
+
+    def __init__(self, maxWidth=400, maxHeight=400, format='JPEG', quality=85):
+        '''
+        maxWidth, maxHeight - the dimensions that thumbnails are shrunk to fit within, preserving their aspect ratio
+        format - "JPEG" or "WEBP"
+        quality - encoder quality, from 1 to 100
         '''
-        rs_soup = BeautifulSoup(get(resourcesync_sourcedescription).content, 'xml')
-        capabilitylist_urls = [a.string for a in rs_soup.find_all('loc')]
+        if Image is None:
+            raise ImportError('Pillow is required to process thumbnails')
 
-        sickle = Sickle(oaipmh_endpoint)
-        sets = sickle.ListSets()
-        identify = sickle.Identify()
+        self.maxSize = (maxWidth, maxHeight)
+        self.format = format.upper()
+        if self.format not in self.formats:
+            raise ValueError('Unsupported thumbnail format: {}'.format(format))
+        self.extension, self.contentType = self.formats[self.format]
+        self.quality = quality
 
-        set_spec_to_name = {z.setSpec:z.setName for z in sets}
-        url_map_from = '/'.join(oaipmh_endpoint.split(sep='/')[:-1]) + '/'
 
-        i_name = institution_name if institution_name is not None else identify.repositoryName
+    @staticmethod
+    def available():
+        '''Return True if Pillow is installed.'''
 
-        has_capability = lambda c, tag: tag.md is not None and 'capability' in tag.md.attrs and tag.md['capability'] == c
+        return Image is not None
 
-        for capabilitylist_url in capabilitylist_urls:
 
-            # For now, get setSpec from the path component of the CapabilityList URL (which may have percent-encoded characters)
-            set_spec = urllib.parse.unquote(urllib.parse.urlparse(capabilitylist_url).path.split(sep='/')[2])
+    def process(self, data):
+        '''Return a ProcessedThumbnail made from the bytes of an image. Raises an exception if the image can't be decoded.'''
 
-            # If a subset of collections is specified, only add collections that belong to it. Otherwise, add all collections.
-            if collection_keys is None or (collection_keys is not None and set_spec in collection_keys):
+        with Image.open(io.BytesIO(data)) as image:
+            # let the JPEG decoder downscale while decoding, which is much faster than decoding at full size
+            image.draft('RGB', self.maxSize)
+            image.load()
 
-                r_soup = BeautifulSoup(get(capabilitylist_url).content, 'xml')
+            if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                # flatten transparency onto white, since JPEG has none
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.split()[3])
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
 
-                # ResourceList should always exist, but if it doesn't, log it and skip this collection
-                try:
-                    resourcelist_url = r_soup.find(functools.partial(has_capability, 'resourcelist')).loc.string
-                except AttributeError:
-                    # TODO: log it
-                    pass
-                    continue
+            image.thumbnail(self.maxSize, Image.LANCZOS)
 
-                # If no ChangeList exists yet, that's ok; predict what its URL will be
-                try:
-                    changelist_url = r_soup.find(functools.partial(has_capability, 'changelist')).loc.string
-                except AttributeError:
-                    changelist_url = '/'.join(resourcelist_url.split(sep='/')[:-1] + ['changelist_0000.xml'])
-
-                print(self.__collection_identifier(i_name, identify.repositoryIdentifier, set_spec_to_name[set_spec], set_spec))
-
-                # We can add the collection to the database now
-                # TODO: catch exceptions
-                self.__insert_or_update(
-                    identify.repositoryIdentifier,
-                    i_name,
-                    set_spec,
-                    set_spec_to_name[set_spec],
-                    resourcelist_url,
-                    changelist_url,
-                    url_map_from,
-                    resource_dir,
-                    overwrite
-                    )
+            output = io.BytesIO()
+            image.save(output, self.format, quality=self.quality, optimize=True)
+            encoded = output.getvalue()
 
+            return ProcessedThumbnail(
+                encoded,
+                self.extension,
+                self.contentType,
+                hashlib.sha256(encoded).hexdigest(),
+                self.differenceHash(image),
+                image.size[0],
+                image.size[1])
 
-    def remove_collections(self, institution_key, collection_keys=None):
-        '''
-        Removes collections of a given institution from the database.
 
-        If a list of collection keys is specified (with values found in the 
-        `collection_key` column in the database), then remove only those 
-        collections. Otherwise, remove all of the institution's collections.
+    @staticmethod
+    def differenceHash(image, size=8):
+        '''Return the difference hash of an image as a hexadecimal string: one bit for each pair of horizontally adjacent pixels of a small grayscale copy, set if the left one is brighter.'''
 
-        Args:
-          institution_key: a value found in the `institution_key` column in 
-              the database
-          collection_keys: a list of values found in the `collection_key` 
-              column in the database
+        pixels = image.convert('L').resize((size + 1, size), Image.LANCZOS).tobytes()
+        bits = 0
+        for row in range(size):
+            for column in range(size):
+                left = pixels[row * (size + 1) + column]
+                right = pixels[row * (size + 1) + column + 1]
+                bits = (bits << 1) | (left > right)
+        return '{:0{}x}'.format(bits, size * size // 4)
 
-        Returns
-          None
-        '''
-        # TODO: print collections that we remove
-        Row = Query()
-        if (collection_keys is None):
-            self.db.remove(Row.institution_key == institution_key)
-        else:
-            for collection_key in collection_keys:
-                self.db.remove(Row.institution_key == institution_key and Row.collection_key == collection_key)
 
+class ThumbnailStore:
+    '''
+    Index of content-addressed thumbnails. Each distinct image is stored once, under a key made from the SHA-256 hash of its contents, and records refer to it by that key.
+
+    The number of records that refer to each object is counted, so that an object is only deleted once no record refers to it: objects whose count drops to zero are returned by `sweep`. The index is kept in memory, since it is consulted for every record, and saved to a JSON file.
+    '''
 
-    def __insert_or_update(self, institution_key, institution_name, collection_key, collection_name, resourcelist_uri, changelist_uri, url_map_from, resource_dir='resourcesync', overwrite=False):
+    def __init__(self, path):
         '''
-        Adds or updates a single row in the database.
+        path - location of the JSON file that holds the index
+        '''
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = False
 
-        This method should normally be called only by `import_collections`.
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = {'records': {}, 'objects': {}}
 
-        Args:
-          institution_key: a machine-readable name for an institution
-          institution_name: a human-readable name for an institution
-          collection_key: a machine-readable name for a collection
-          collection_name: a human-readable name for a collection
-          resourcelist_uri: a URL for a ResourceSync ResourceList
-          changelist_uri: a URL for a ResourceSync ChangeList
-          url_map_from: the leading part of a Resource's URL to cut off in 
-              order to map the URL to a local filename
-          resource_dir: path to the local directory to store copies of the 
-              synced resources to, relative to the home directory "~"
-          overwrite: whether or not to overwrite rows in the database that 
-              match the `collection_key` and `institution_key`
+        # record identifier -> {"key", "institution_key", "collection_key"}
+        self.records = index['records']
+        # object key -> number of records that refer to it
+        self.objects = index['objects']
 
-        Returns:
-          None
-        '''
-        # TODO: change *_uri parameters to *_url
-        # TODO: throw errors when warranted
-        Row = Query()
-        if not self.db.contains(Row.institution_key == institution_key and Row.collection_key == collection_key):
-            # NOTE: if either `collection_key` or `institution_key` change for any given collection,
-            # the filesystem location of the saved files will also change,
-            # since resources are saved under the path `file_path_map_to`/`institution_key`/`collection_key`.
 
-            # TODO: keep track of potential stale directories so they can be manually deleted.
-            # This could involve logging calls to `add` where a row in the DB doesn't match the `institution_key` and `collection_key` parameters,
-            # but DOES match either 1) both the `institution_name` and `collection_name` parameters, or 2) one of the URI parameters.
+    def __len__(self):
+        return len(self.objects)
 
-            self.db.insert({
-                'institution_key': institution_key,
-                'institution_name': institution_name,
-                'collection_key': collection_key,
-                'collection_name': collection_name,
-                'resourcelist_uri': resourcelist_uri,
-                'changelist_uri': changelist_uri,
-                'url_map_from': url_map_from,
-                'file_path_map_to': resource_dir,
-                'new': True
-                })
-        elif overwrite == True:
 
-            # TODO: if `file_path_map_to` changes, then we need to do a baseline synchronization again,
-            # because that means the files will change location on the filesystem.
-            # However, `file_path_map_to` should not be changed once chosen.
-            self.db.update({
-                'institution_key': institution_key,
-                'institution_name': institution_name,
-                'collection_key': collection_key,
-                'collection_name': collection_name,
-                'resourcelist_uri': resourcelist_uri,
-                'changelist_uri': changelist_uri,
-                'url_map_from': url_map_from,
-                'file_path_map_to': resource_dir,
-                }, Row.institution_key == institution_key and Row.collection_key == collection_key)
+    @staticmethod
+    def contentHash(data):
+        '''Return the SHA-256 hash of some bytes, as a hexadecimal string.'''
+
+        return hashlib.sha256(data).hexdigest()
+
+
+    @staticmethod
+    def objectKey(contentHash, extension):
+        '''Return the key of the object with the given hash and file extension.'''
+
+        return contentHash + extension
+
+
+    def get(self, recordIdentifier):
+        '''Return the key of the object that a record refers to, or None if it refers to none.'''
+
+        with self.lock:
+            entry = self.records.get(recordIdentifier)
+            return None if entry is None else entry['key']
+
+
+    def has(self, objectKey):
+        '''Return True if an object has been stored, and hasn't been swept.'''
+
+        with self.lock:
+            return objectKey in self.objects
+
+
+    def references(self, objectKey):
+        '''Return the number of records that refer to an object.'''
+
+        with self.lock:
+            return self.objects.get(objectKey, 0)
+
+
+    def recordsOf(self, institutionKey, collectionKey):
+        '''Return the identifiers of the records of a collection that refer to an object.'''
+
+        with self.lock:
+            return [recordIdentifier for recordIdentifier, entry in self.records.items() if entry['institution_key'] == institutionKey and entry['collection_key'] == collectionKey]
+
+
+    def assign(self, recordIdentifier, objectKey, institutionKey, collectionKey):
+        '''Make a record refer to an object (which must have been stored), instead of the one it referred to before, if any.'''
+
+        with self.lock:
+            previous = self.records.get(recordIdentifier)
+            if previous is not None and previous['key'] == objectKey:
+                return
+            if previous is not None:
+                self.objects[previous['key']] -= 1
+
+            self.objects[objectKey] = self.objects.get(objectKey, 0) + 1
+            self.records[recordIdentifier] = {'key': objectKey, 'institution_key': institutionKey, 'collection_key': collectionKey}
+            self.dirty = True
+
+
+    def release(self, recordIdentifier):
+        '''Remove the reference of a record to its object, e.g., because the record has been deleted.'''
+
+        with self.lock:
+            previous = self.records.pop(recordIdentifier, None)
+            if previous is not None:
+                self.objects[previous['key']] -= 1
+                self.dirty = True
+
+
+    def sweep(self):
+        '''Remove the objects that no record refers to from the index, and return their keys so that they can be deleted.'''
+
+        with self.lock:
+            orphans = [objectKey for objectKey, references in self.objects.items() if references <= 0]
+            for objectKey in orphans:
+                del self.objects[objectKey]
+            if len(orphans) > 0:
+                self.dirty = True
+            return orphans
+
+
+    def save(self):
+        '''Write the index to its file, if it has changed.'''
+
+        with self.lock:
+            if not self.dirty:
+                return
+            # write a new file and move it into place, so that a crash can't leave a partial index behind
+            temporaryPath = self.path + '.tmp'
+            with open(temporaryPath, 'w') as f:
+                json.dump({'records': self.records, 'objects': self.objects}, f)
+            os.replace(temporaryPath, self.path)
+            self.dirty = False
+
+
+class FileLayout:
+    '''
+    Maps the names of the files in a directory to their paths.
+
+    In the flat layout, a file is at "<root>/<name>". In the sharded layout, it's under a prefix of the SHA-1 hash of its name, e.g. "<root>/3f/a2/<name>", so that no directory holds more than a few thousand files even when there are hundreds of millions of them; opening, listing, and stat-ing files in huge flat directories gets slow on most filesystems.
+    '''
+
+    FLAT = 'flat'
+    SHARDED = 'sharded'
+
+    def __init__(self, root, layout='flat', depth=2, width=2):
+        '''
+        root - the directory that holds the files
+        layout - "flat" or "sharded"
+        depth - number of levels of shard directories
+        width - number of hexadecimal digits in the name of each shard directory
+        '''
+        if layout not in (self.FLAT, self.SHARDED):
+            raise ValueError('Unknown file layout: {}'.format(layout))
+
+        self.root = root
+        self.layout = layout
+        self.depth = depth
+        self.width = width
+
+
+    @staticmethod
+    def hash(name):
+        return hashlib.sha1(name.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+    def shard(self, name):
+        '''Return the list of shard directories that a file with the given name is in.'''
+
+        if self.layout == self.FLAT:
+            return []
+        digest = self.hash(name)
+        return [digest[i * self.width:(i + 1) * self.width] for i in range(self.depth)]
+
+
+    def path(self, name):
+        '''Return the path of the file with the given name (which may contain slashes).'''
+
+        return os.path.join(self.root, *self.shard(name), *name.split('/'))
+
+
+    def name(self, path):
+        '''
+        Return the name of the file at the given path under the root, in either layout, with any depth or width of shard directories.
+        '''
+
+        parts = os.path.relpath(path, self.root).split(os.sep)
+        for i in range(1, len(parts)):
+            prefix = ''.join(parts[:i])
+            if len(parts[i - 1]) == 0 or len(prefix) > 40:
+                break
+            name = '/'.join(parts[i:])
+            if self.hash(name).startswith(prefix):
+                return name
+        return '/'.join(parts)
+
+
+    def locate(self, path):
+        '''Return the given path if there is a file there, or else the path that a file with the same name has in this layout.'''
+
+        if os.path.exists(path):
+            return path
+        return self.path(self.name(path))
+
+
+    def place(self, path, link=False):
+        '''
+        Move the file at the given path to where it belongs in this layout, and return its new path.
+
+        link - whether to hard-link the file there instead, leaving it where it is too
+        '''
+
+        target = self.path(self.name(path))
+        if target != path:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if link:
+                try:
+                    os.remove(target)
+                except FileNotFoundError:
+                    pass
+                os.link(path, target)
+            else:
+                os.replace(path, target)
+        return target
+
+
+    def files(self):
+        '''Yield the path of every file under the root.'''
+
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(dirpath, filename)
+
+
+    def migrate(self):
+        '''Move every file under the root to where it belongs in this layout, remove the directories that are left empty, and return the number of files that were moved.'''
+
+        moved = 0
+        # directories are listed before their files are moved, so files that have already been moved aren't visited again
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if self.place(path) != path:
+                    moved += 1
+
+        for dirpath, dirnames, filenames in os.walk(self.root, topdown=False):
+            if dirpath != self.root:
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    # not empty
+                    pass
+        return moved
+
+
+class PackedRecordStore:
+    '''
+    Append-only store of the record files of a collection in a single file, as an alternative to one small file per record, which wastes inodes and turns reading a whole collection into random I/O.
+
+    Each entry is a header (kind, length of the key, length of the data, and CRC-32 of both), the UTF-8 key, and the zlib-compressed data. Putting a record appends an entry, and deleting one appends a tombstone; the last entry for a key wins, and the space of the others is reclaimed by compact. The offset of each record's data is kept in an in-memory index, which is saved to "<path>.idx" by save and caught up on by reading the entries after it when the store is opened again. Records are read through a memory map.
+
+    Safe to use from several threads.
+    '''
+
+    header = struct.Struct('>BHII')
+
+    RECORD = 0
+    TOMBSTONE = 1
+
+    def __init__(self, path, compressionLevel=6):
+        '''
+        path - the file that holds the entries, created if it doesn't exist
+        compressionLevel - zlib compression level of the records that are put
+        '''
+        self.path = path
+        self.indexPath = path + '.idx'
+        self.compressionLevel = compressionLevel
+        self.lock = threading.RLock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__open()
+
+
+    def __open(self):
+        self.file = open(self.path, 'a+b')
+        self.map = None
+        self.unflushed = False
+        self.offsets = {}
+        # number of bytes taken up by entries that have been superseded
+        self.garbage = 0
+
+        size = os.path.getsize(self.path)
+        start = 0
+        try:
+            with open(self.indexPath) as f:
+                index = json.load(f)
+            if index['size'] <= size:
+                self.offsets = {key: tuple(offset) for key, offset in index['offsets'].items()}
+                self.garbage = index['garbage']
+                start = index['size']
+        except (OSError, ValueError, KeyError):
+            # read every entry instead
+            pass
+        self.__scan(start, size)
+
+
+    def __scan(self, start, size):
+        '''Add the entries between the given offsets to the index, and cut off a partial entry at the end, which a crash can leave behind.'''
+
+        if size == start:
+            return
+        self.__remap()
+        offset = start
+        while offset < size:
+            if offset + self.header.size > size:
+                break
+            kind, keyLength, dataLength, checksum = self.header.unpack_from(self.map, offset)
+            end = offset + self.header.size + keyLength + dataLength
+            if end > size or zlib.crc32(self.map[offset + self.header.size:end]) != checksum:
+                break
+            key = self.map[offset + self.header.size:offset + self.header.size + keyLength].decode('utf-8', 'surrogateescape')
+            self.__index(key, kind, offset + self.header.size + keyLength, dataLength)
+            offset = end
+
+        if offset < size:
+            logger.warning('Discarding {} bytes of partial entries at the end of "{}"'.format(size - offset, self.path))
+            self.map.close()
+            self.map = None
+            self.file.truncate(offset)
+
+
+    def __index(self, key, kind, dataOffset, dataLength):
+        previous = self.offsets.pop(key, None)
+        if previous is not None:
+            self.garbage += self.__entrySize(key, previous[1])
+        if kind == self.RECORD:
+            self.offsets[key] = (dataOffset, dataLength)
+        else:
+            self.garbage += self.__entrySize(key, dataLength)
+
+
+    def __entrySize(self, key, dataLength):
+        return self.header.size + len(key.encode('utf-8', 'surrogateescape')) + dataLength
+
+
+    def __remap(self):
+        if self.unflushed:
+            self.file.flush()
+            self.unflushed = False
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def __append(self, key, kind, data):
+        keyBytes = key.encode('utf-8', 'surrogateescape')
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        self.file.write(self.header.pack(kind, len(keyBytes), len(data), zlib.crc32(keyBytes + data)))
+        self.file.write(keyBytes)
+        self.file.write(data)
+        self.unflushed = True
+        self.__index(key, kind, offset + self.header.size + len(keyBytes), len(data))
+
+
+    def put(self, key, data):
+        '''Store the contents (bytes) of the record with the given key, replacing any that were stored before.'''
+
+        compressed = zlib.compress(data, self.compressionLevel)
+        with self.lock:
+            self.__append(key, self.RECORD, compressed)
+
+
+    def delete(self, key):
+        '''Delete the record with the given key. Returns False if there is none.'''
+
+        with self.lock:
+            if key not in self.offsets:
+                return False
+            self.__append(key, self.TOMBSTONE, b'')
+            return True
+
+
+    def get(self, key):
+        '''Return the contents of the record with the given key, or None if there is none.'''
+
+        with self.lock:
+            offset = self.offsets.get(key)
+            if offset is None:
+                return None
+            dataOffset, dataLength = offset
+            if self.map is None or dataOffset + dataLength > len(self.map):
+                self.__remap()
+            return zlib.decompress(self.map[dataOffset:dataOffset + dataLength])
+
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def keys(self):
+        '''Return the keys of the records.'''
+
+        with self.lock:
+            return list(self.offsets)
+
+
+    def items(self):
+        '''Yield the (key, contents) of every record, in the order they are stored in, so that the file is read sequentially.'''
+
+        with self.lock:
+            offsets = sorted(self.offsets.items(), key=lambda item: item[1][0])
+        for key, offset in offsets:
+            with self.lock:
+                # the record may have been replaced or deleted since
+                if self.offsets.get(key) != offset:
+                    continue
+                dataOffset, dataLength = offset
+                if self.map is None or dataOffset + dataLength > len(self.map):
+                    self.__remap()
+                data = self.map[dataOffset:dataOffset + dataLength]
+            yield key, zlib.decompress(data)
+
+
+    def size(self):
+        '''Return the size of the file, in bytes.'''
+
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            return self.file.tell()
+
+
+    def garbageRatio(self):
+        '''Return the fraction of the file that compact would reclaim.'''
+
+        size = self.size()
+        return self.garbage / size if size > 0 else 0.0
+
+
+    def compact(self):
+        '''Rewrite the file with only the current entries, and return the number of bytes reclaimed.'''
+
+        with self.lock:
+            before = self.size()
+            temporaryPath = self.path + '.tmp'
+            with open(temporaryPath, 'wb') as f:
+                for key, offset in sorted(self.offsets.items(), key=lambda item: item[1][0]):
+                    if self.map is None or offset[0] + offset[1] > len(self.map):
+                        self.__remap()
+                    keyBytes = key.encode('utf-8', 'surrogateescape')
+                    data = self.map[offset[0]:offset[0] + offset[1]]
+                    f.write(self.header.pack(self.RECORD, len(keyBytes), len(data), zlib.crc32(keyBytes + data)))
+                    f.write(keyBytes)
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.__close()
+            os.replace(temporaryPath, self.path)
+            # the saved index refers to the old file
+            try:
+                os.remove(self.indexPath)
+            except FileNotFoundError:
+                pass
+            self.__open()
+            self.save()
+            return before - self.size()
+
+
+    def save(self):
+        '''Write the entries to disk and save the index.'''
+
+        with self.lock:
+            self.file.flush()
+            self.unflushed = False
+            index = {'size': self.size(), 'garbage': self.garbage, 'offsets': self.offsets}
+            # write a new file and move it into place, so that a crash can't leave a partial index behind
+            temporaryPath = self.indexPath + '.tmp'
+            with open(temporaryPath, 'w') as f:
+                json.dump(index, f)
+            os.replace(temporaryPath, self.indexPath)
+
+
+    def close(self):
+        '''Save the index and close the file.'''
+
+        with self.lock:
+            self.save()
+            self.__close()
+
+
+    def __close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class ThumbnailDeletionQueue:
+    '''
+    Deletes thumbnails from S3 and from the local filesystem in a background thread.
+
+    S3 objects are deleted in batches with DeleteObjects, which accepts up to 1000 keys per request.
+    '''
+
+    maxBatchSize = 1000
+
+    def __init__(self, s3, bucket, batchSize=1000, flushInterval=5.0, onFailure=None):
+        '''
+        s3 - a boto3 S3 client
+        bucket - name of the S3 bucket that holds the thumbnails
+        batchSize - number of keys to delete per request, at most 1000
+        flushInterval - number of seconds to wait for more keys before sending a partial batch
+        onFailure - function called (from the background thread) with the list of keys that couldn't be deleted
+        '''
+        self.onFailure = onFailure
+        self.s3 = s3
+        self.bucket = bucket
+        self.batchSize = min(batchSize, self.maxBatchSize)
+        self.flushInterval = flushInterval
+        self.deleted = 0
+        self.failed = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.__run, name='thumbnail-deletion', daemon=True)
+        self.thread.start()
+
+
+    def delete(self, s3Key, localDir=None):
+        '''
+        Schedule a thumbnail for deletion. Returns immediately.
+
+        s3Key - the key of the S3 object
+        localDir - the directory that holds the local copy of the thumbnail, named after the key (possibly plus an extension)
+        '''
+
+        self.queue.put((s3Key, localDir))
+
+
+    def close(self):
+        '''Delete everything that has been scheduled and stop the background thread.'''
+
+        self.queue.put(None)
+        self.thread.join()
+        logger.info('Deleted {} thumbnails from S3 ({} failed)'.format(self.deleted, self.failed))
+
+
+    def __run(self):
+        keys = []
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flushInterval)
+            except queue.Empty:
+                self.__flush(keys)
+                keys = []
+                continue
+
+            if item is None:
+                self.__flush(keys)
+                return
+
+            s3Key, localDir = item
+            if localDir is not None:
+                self.__deleteLocal(s3Key, localDir)
+
+            keys.append(s3Key)
+            if len(keys) >= self.batchSize:
+                self.__flush(keys)
+                keys = []
+
+
+    def __deleteLocal(self, s3Key, localDir):
+        try:
+            os.remove(os.path.join(localDir, s3Key))
+            logger.debug('Deleted local thumbnail "{}"'.format(os.path.join(localDir, s3Key)))
+        except FileNotFoundError:
+            pass
+
+        for filepath in glob.iglob(os.path.join(glob.escape(localDir), glob.escape(s3Key) + '.*')):
+            if os.path.splitext(os.path.basename(filepath))[0] == s3Key:
+                try:
+                    os.remove(filepath)
+                    logger.debug('Deleted local thumbnail "{}"'.format(filepath))
+                except FileNotFoundError:
+                    pass
+
+
+    def __flush(self, keys):
+        if len(keys) == 0:
+            return
+
+        try:
+            response = self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    'Objects': [{'Key': key} for key in keys],
+                    'Quiet': True
+                    })
+        except Exception as e:
+            logger.error('Something went wrong while trying to delete {} thumbnails from S3: {}'.format(len(keys), e))
+            self.failed += len(keys)
+            if self.onFailure is not None:
+                self.onFailure(keys)
+            return
+
+        errors = response.get('Errors', [])
+        for error in errors:
+            logger.error('Cannot delete thumbnail "{}" from S3: {}'.format(error.get('Key'), error.get('Message')))
+        self.failed += len(errors)
+        self.deleted += len(keys) - len(errors)
+        if len(errors) > 0 and self.onFailure is not None:
+            self.onFailure([error.get('Key') for error in errors])
+
+
+def backoffDelay(attempts, baseDelay, maxDelay):
+    '''
+    Return a random number of seconds to wait after the given number of failed attempts: exponential backoff with "full jitter", so that clients that failed at the same time don't all try again at the same time.
+    '''
+
+    return random.uniform(0, min(maxDelay, baseDelay * 2 ** attempts))
+
+
+class CircuitBreaker:
+    '''
+    Stops sending requests to a target after consecutive failures, and lets a single trial request through after a while to see if it has recovered.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failureThreshold=5, resetTimeout=60.0, clock=time.monotonic):
+        '''
+        failureThreshold - number of consecutive failures that opens the breaker
+        resetTimeout - number of seconds to wait before letting a trial request through, or None to never let one through
+        clock - function that returns the current time in seconds
+        '''
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.openedAt = None
+        self.lock = threading.Lock()
+
+
+    def allow(self):
+        '''Return True if a request may be sent.'''
+
+        with self.lock:
+            if self.state == self.OPEN and self.resetTimeout is not None and self.clock() - self.openedAt >= self.resetTimeout:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+
+    def success(self):
+        '''Record a successful request.'''
+
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+
+    def failure(self):
+        '''Record a failed request.'''
+
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failureThreshold:
+                if self.state != self.OPEN:
+                    logger.warning('Circuit breaker opened after {} consecutive failures'.format(self.failures))
+                self.state = self.OPEN
+                self.openedAt = self.clock()
+
+
+class HostUnavailableError(Exception):
+    '''Raised when requests to a host are being skipped because it has been failing.'''
+
+    def __init__(self, hosts):
+        self.hosts = sorted(hosts)
+        super().__init__('Skipping requests to unavailable hosts: {}'.format(', '.join(self.hosts)))
+
+
+class HostHealth:
+    '''
+    Tracks how quickly each host responds, and whether it keeps failing.
+
+    The timeout for a host is derived from the 99th percentile of its recent response times. Once a host fails a number of times in a row, its circuit breaker opens and stays open for the rest of the run.
+    '''
+
+    def __init__(self, failureThreshold=5, defaultTimeout=30.0, minTimeout=2.0, maxTimeout=60.0, multiplier=3.0, minSamples=20, window=500):
+        '''
+        failureThreshold - number of consecutive failures after which a host is skipped
+        defaultTimeout - number of seconds to wait for a host before enough of its response times have been observed
+        minTimeout, maxTimeout - bounds of the learned timeout
+        multiplier - factor that the 99th percentile response time is multiplied by to get the timeout
+        minSamples - number of response times to observe before learning the timeout
+        window - number of recent response times to keep for each host
+        '''
+        self.failureThreshold = failureThreshold
+        self.defaultTimeout = defaultTimeout
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        self.multiplier = multiplier
+        self.minSamples = minSamples
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.breakers = collections.defaultdict(lambda: CircuitBreaker(failureThreshold=failureThreshold, resetTimeout=None))
+        self.skips = collections.Counter()
+        self.lock = threading.Lock()
+
+
+    def p99(self, host):
+        '''Return the 99th percentile of the recent response times of a host, or None if there are too few of them.'''
+
+        with self.lock:
+            samples = sorted(self.latencies[host])
+        if len(samples) < self.minSamples:
+            return None
+        return samples[-(-len(samples) * 99 // 100) - 1]
+
+
+    def timeout(self, host):
+        '''Return the number of seconds to wait for a response from a host.'''
+
+        p99 = self.p99(host)
+        if p99 is None:
+            return self.defaultTimeout
+        return min(self.maxTimeout, max(self.minTimeout, p99 * self.multiplier))
+
+
+    def allow(self, host):
+        '''Return True if a request may be sent to a host, otherwise count it as skipped.'''
+
+        with self.lock:
+            breaker = self.breakers[host]
+        if breaker.allow():
+            return True
+        with self.lock:
+            self.skips[host] += 1
+        return False
+
+
+    def success(self, host, elapsed):
+        '''Record a response from a host that took the given number of seconds.'''
+
+        with self.lock:
+            self.latencies[host].append(elapsed)
+            breaker = self.breakers[host]
+        breaker.success()
+
+
+    def failure(self, host):
+        '''Record a timeout, connection error, or server error from a host.'''
+
+        with self.lock:
+            breaker = self.breakers[host]
+        breaker.failure()
+
+
+    def summary(self):
+        '''Return a list of lines that describe the learned timeout of each host, and how many requests to it were skipped.'''
+
+        lines = []
+        for host in sorted(set(self.latencies) | set(self.skips)):
+            p99 = self.p99(host)
+            line = '{}: {} responses, p99 {}, timeout {:.1f}s'.format(
+                host,
+                len(self.latencies[host]),
+                'unknown' if p99 is None else '{:.2f}s'.format(p99),
+                self.timeout(host))
+            if self.skips[host] > 0:
+                line += ', {} requests skipped after {} consecutive failures'.format(self.skips[host], self.failureThreshold)
+            lines.append(line)
+        return lines
+
+
+class RetryQueue:
+    '''
+    Persistent queue of operations that failed and should be tried again later, with exponential backoff and jitter.
+
+    Each entry has a target (e.g., "solr"), an operation (e.g., "add"), the ID of the object it applies to, and a JSON-serializable payload. Entries that fail too many times are moved to a dead-letter file of JSON lines.
+    '''
+
+    def __init__(self, path, deadLetterPath, maxAttempts=8, baseDelay=30.0, maxDelay=6 * 3600.0, clock=time.time):
+        '''
+        path - location of the TinyDB file that holds the queue
+        deadLetterPath - location of the file that entries are appended to when they are given up on
+        maxAttempts - number of times to try an operation before giving up on it
+        baseDelay - number of seconds to wait before the first retry; the wait doubles with each attempt
+        maxDelay - maximum number of seconds to wait between attempts
+        clock - function that returns the current time in seconds since the epoch
+        '''
+        self.db = TinyDB(path)
+        self.deadLetterPath = deadLetterPath
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        # (target, id) pairs that have an entry, so that successes don't have to touch the file
+        self.pending = {(entry['target'], entry['id']) for entry in self.db.all()}
+
+
+    def __len__(self):
+        return len(self.db)
+
+
+    def delay(self, attempts):
+        '''Return the number of seconds to wait after the given number of failed attempts.'''
+
+        return backoffDelay(attempts, self.baseDelay, self.maxDelay)
+
+
+    def push(self, target, operation, id, payload, error=None):
+        '''
+        Add an operation that failed for the first time.
+
+        target - name of the service the operation is sent to
+        operation - name of the operation
+        id - ID of the object that the operation applies to
+        payload - JSON-serializable data needed to carry out the operation
+        error - the reason it failed
+        '''
+
+        with self.lock:
+            self.db.insert({
+                'key': uuid.uuid4().hex,
+                'target': target,
+                'operation': operation,
+                'id': id,
+                'payload': payload,
+                'attempts': 1,
+                'next_attempt': self.clock() + self.delay(1),
+                'error': None if error is None else str(error)
+                })
+            self.pending.add((target, id))
+
+
+    def schedule(self, target, operation, id, payload):
+        '''
+        Add an operation that hasn't been tried yet, to be carried out as soon as possible.
+
+        The arguments are the same as those of push.
+        '''
+
+        with self.lock:
+            self.db.insert({
+                'key': uuid.uuid4().hex,
+                'target': target,
+                'operation': operation,
+                'id': id,
+                'payload': payload,
+                'attempts': 0,
+                'next_attempt': self.clock(),
+                'error': None
+                })
+            self.pending.add((target, id))
+
+
+    def count(self, target):
+        '''Return the number of entries for a target.'''
+
+        with self.lock:
+            return self.db.count(Query().target == target)
+
+
+    def due(self, target=None):
+        '''Return the entries (optionally, only those for a target) that are ready to be tried again, oldest first.'''
+
+        now = self.clock()
+        with self.lock:
+            return [entry for entry in self.db.all() if entry['next_attempt'] <= now and (target is None or entry['target'] == target)]
+
+
+    def discard(self, target, id):
+        '''Remove the entries for an object, e.g., because a newer operation on it has succeeded.'''
+
+        with self.lock:
+            if (target, id) in self.pending:
+                Entry = Query()
+                self.db.remove((Entry.target == target) & (Entry.id == id))
+                self.pending.discard((target, id))
+
+
+    def take(self, target):
+        '''Remove the entries for a target, and return them.'''
+
+        with self.lock:
+            Entry = Query()
+            entries = self.db.search(Entry.target == target)
+            if len(entries) > 0:
+                self.db.remove(Entry.target == target)
+                self.pending = {(t, id) for (t, id) in self.pending if t != target}
+            return entries
+
+
+    def succeeded(self, entry):
+        '''Remove an entry that has been carried out.'''
+
+        with self.lock:
+            self.db.remove(Query().key == entry['key'])
+            self.__forget(entry)
+
+
+    def failed(self, entry, error=None):
+        '''Schedule an entry to be tried again later, or move it to the dead-letter file if it has failed too many times.'''
+
+        with self.lock:
+            Entry = Query()
+            attempts = entry['attempts'] + 1
+            if attempts >= self.maxAttempts:
+                with open(self.deadLetterPath, 'a') as f:
+                    f.write(dumps(dict(entry, attempts=attempts, error=None if error is None else str(error), dead_at=self.clock())) + '\n')
+                self.db.remove(Entry.key == entry['key'])
+                self.__forget(entry)
+                logger.error('Giving up on {} {} of {} after {} attempts: {}'.format(entry['target'], entry['operation'], entry['id'], attempts, error))
+            else:
+                self.db.update({
+                    'attempts': attempts,
+                    'next_attempt': self.clock() + self.delay(attempts),
+                    'error': None if error is None else str(error)
+                    }, Entry.key == entry['key'])
+
+
+    def __forget(self, entry):
+        Entry = Query()
+        if not self.db.contains((Entry.target == entry['target']) & (Entry.id == entry['id'])):
+            self.pending.discard((entry['target'], entry['id']))
+
+
+class ThumbnailJobQueue:
+    '''
+    Queue of records whose thumbnails have to be looked for, in a SQLite database, so that adding and removing a job doesn't rewrite the queue the way it would a TinyDB file. Jobs that fail are tried again later with exponential backoff, like the entries of a RetryQueue, and are moved to a dead-letter file after `maxAttempts` attempts.
+
+    Jobs are dictionaries with the ID of the record ("id"), a JSON-serializable payload ("payload"), the number of attempts so far ("attempts"), and a key that identifies this job of the record ("key"). Each record has at most one job; scheduling another one replaces it.
+    '''
+
+    def __init__(self, path=':memory:', deadLetterPath=None, maxAttempts=8, baseDelay=30.0, maxDelay=6 * 3600.0, clock=time.time):
+        '''
+        path - location of the SQLite database
+        deadLetterPath - location of the file that jobs are appended to when they are given up on, or None to drop them
+        maxAttempts, baseDelay, maxDelay, clock - see RetryQueue
+        '''
+        self.deadLetterPath = deadLetterPath
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # the queue can be rebuilt by syncing again, so commits don't have to wait for the disk
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE NOT NULL,
+                key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                error TEXT
+                )''')
+        self.db.commit()
+
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+
+    def schedule(self, id, payload):
+        '''Add a job for a record, to be carried out as soon as possible, in place of any job that it already has.'''
+
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO jobs (id, key, payload, next_attempt) VALUES (?, ?, ?, ?)',
+                (id, uuid.uuid4().hex, dumps(payload), self.clock()))
+            self.db.commit()
+
+
+    def discard(self, id):
+        '''Remove the job of a record, if it has one.'''
+
+        with self.lock:
+            self.db.execute('DELETE FROM jobs WHERE id = ?', (id,))
+            self.db.commit()
+
+
+    def due(self):
+        '''Return the jobs that are ready to be carried out, oldest first.'''
+
+        with self.lock:
+            rows = self.db.execute('SELECT id, key, payload, attempts FROM jobs WHERE next_attempt <= ? ORDER BY seq', (self.clock(),)).fetchall()
+        return [{'id': id, 'key': key, 'payload': json.loads(payload), 'attempts': attempts} for id, key, payload, attempts in rows]
+
+
+    def succeeded(self, job):
+        '''Remove a job that has been carried out, unless it has been replaced since.'''
+
+        with self.lock:
+            self.db.execute('DELETE FROM jobs WHERE key = ?', (job['key'],))
+            self.db.commit()
+
+
+    def failed(self, job, error=None):
+        '''Schedule a job to be tried again later, or move it to the dead-letter file if it has failed too many times.'''
+
+        attempts = job['attempts'] + 1
+        with self.lock:
+            if attempts >= self.maxAttempts:
+                if self.deadLetterPath is not None:
+                    with open(self.deadLetterPath, 'a') as f:
+                        f.write(dumps(dict(job, target='thumbnail', attempts=attempts, error=None if error is None else str(error), dead_at=self.clock())) + '\n')
+                self.db.execute('DELETE FROM jobs WHERE key = ?', (job['key'],))
+                logger.error('Giving up on thumbnail of {} after {} attempts: {}'.format(job['id'], attempts, error))
+            else:
+                self.db.execute(
+                    'UPDATE jobs SET attempts = ?, next_attempt = ?, error = ? WHERE key = ?',
+                    (attempts, self.clock() + backoffDelay(attempts, self.baseDelay, self.maxDelay), None if error is None else str(error), job['key']))
+            self.db.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+WorkTask = collections.namedtuple('WorkTask', ['key', 'payload', 'worker', 'attempts'])
+
+
+class WorkQueue:
+    '''
+    Queue of tasks that are shared by several workers (e.g., sync nodes), in a SQLite database.
+
+    A worker claims a task with a lease, which it renews with heartbeats while it works on the task (see LeaseKeeper). If the worker dies, its lease runs out, and the task can be claimed by another worker. Each task has a unique key, so a task that is already in the queue isn't added again. Tasks that have been claimed `maxAttempts` times without being completed are left in the queue, but not claimed anymore.
+
+    With the default path of ":memory:", the queue only lives as long as the object, which is useful for tests. Otherwise, the database has to be on a filesystem whose locks work across the nodes that share it.
+    '''
+
+    def __init__(self, path=':memory:', maxAttempts=3, clock=time.time):
+        '''
+        path - location of the SQLite database
+        maxAttempts - number of times a task can be claimed
+        clock - function that returns the current time in seconds since the epoch
+        '''
+        self.maxAttempts = maxAttempts
+        self.clock = clock
+        self.lock = threading.Lock()
+        # transactions are begun explicitly
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                worker TEXT,
+                lease_expires REAL,
+                available_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                seq INTEGER NOT NULL
+                )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tasks_available ON tasks (attempts, available_at, seq)')
+
+
+    def enqueue(self, key, payload=None):
+        '''Add a task with a JSON-serializable payload, unless there is one with the same key already. Returns True if the task was added.'''
+
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT OR IGNORE INTO tasks (key, payload, available_at, seq) VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM tasks))',
+                (key, json.dumps(payload), self.clock()))
+            return cursor.rowcount == 1
+
+
+    def claim(self, worker, lease=300.0):
+        '''
+        Claim the task that has been waiting the longest, for `lease` seconds, and return it as a WorkTask. Tasks whose leases have run out are claimed again. Returns None if there are no tasks to claim.
+        '''
+
+        with self.lock:
+            now = self.clock()
+            # take the write lock right away, so that two workers can't claim the same task
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute(
+                    'SELECT key, payload, attempts FROM tasks WHERE attempts < ? AND available_at <= ? AND (worker IS NULL OR lease_expires < ?) ORDER BY seq LIMIT 1',
+                    (self.maxAttempts, now, now)).fetchone()
+                if row is None:
+                    self.db.execute('COMMIT')
+                    return None
+                key, payload, attempts = row
+                self.db.execute('UPDATE tasks SET worker = ?, lease_expires = ?, attempts = ? WHERE key = ?', (worker, now + lease, attempts + 1, key))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return WorkTask(key, json.loads(payload), worker, attempts + 1)
+
+
+    def heartbeat(self, task, lease=300.0):
+        '''Extend the lease on a task by `lease` seconds from now. Returns False if the task has been claimed by another worker or completed since.'''
+
+        with self.lock:
+            cursor = self.db.execute('UPDATE tasks SET lease_expires = ? WHERE key = ? AND worker = ?', (self.clock() + lease, task.key, task.worker))
+            return cursor.rowcount == 1
+
+
+    def complete(self, task):
+        '''Remove a task that has been done. Returns False if it has been claimed by another worker since.'''
+
+        with self.lock:
+            cursor = self.db.execute('DELETE FROM tasks WHERE key = ? AND worker = ?', (task.key, task.worker))
+            return cursor.rowcount == 1
+
+
+    def release(self, task, delay=0.0):
+        '''Give up a claimed task, so that it can be claimed again after `delay` seconds.'''
+
+        with self.lock:
+            self.db.execute(
+                'UPDATE tasks SET worker = NULL, lease_expires = NULL, available_at = ? WHERE key = ? AND worker = ?',
+                (self.clock() + delay, task.key, task.worker))
+
+
+    def counts(self):
+        '''Return the number of tasks that are waiting, claimed, and given up on.'''
+
+        with self.lock:
+            now = self.clock()
+            waiting, claimed, dead = self.db.execute(
+                'SELECT '
+                'COALESCE(SUM(attempts < ? AND (worker IS NULL OR lease_expires < ?)), 0), '
+                'COALESCE(SUM(worker IS NOT NULL AND lease_expires >= ?), 0), '
+                'COALESCE(SUM(attempts >= ? AND (worker IS NULL OR lease_expires < ?)), 0) '
+                'FROM tasks',
+                (self.maxAttempts, now, now, self.maxAttempts, now)).fetchone()
+            return {'waiting': waiting, 'claimed': claimed, 'dead': dead}
+
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class LeaseKeeper:
+    '''
+    Context manager that renews the lease on a WorkTask in a background thread while it's being worked on.
+
+    If the lease can't be renewed (e.g., because the worker was stalled for longer than the lease, and another worker claimed the task), `lost` is set, and the work should be abandoned.
+    '''
+
+    def __init__(self, queue, task, lease=300.0, interval=None):
+        '''
+        queue - the WorkQueue that the task was claimed from
+        task - the WorkTask
+        lease - number of seconds to extend the lease by with each heartbeat
+        interval - number of seconds between heartbeats (a third of the lease by default)
+        '''
+        self.queue = queue
+        self.task = task
+        self.lease = lease
+        self.interval = interval if interval is not None else lease / 3
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name='lease-keeper', daemon=True)
+
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                renewed = self.queue.heartbeat(self.task, self.lease)
+            except Exception as e:
+                logger.error('Cannot renew the lease on task {}: {}'.format(self.task.key, e))
+                continue
+            if not renewed:
+                logger.error('Lost the lease on task {}'.format(self.task.key))
+                self.lost.set()
+                return
+
+
+class SyncHistory:
+    '''
+    History of the runs of resync on each collection, in a TinyDB file: when each one started, how long it took, how many changes it reported, and whether it finished (or was cut short by a time budget or an error). Only the latest `keep` runs of each collection are kept.
+    '''
+
+    def __init__(self, path, keep=20):
+        self.db = TinyDB(path)
+        self.keep = keep
+        self.lock = threading.Lock()
+
+
+    def record(self, institutionKey, collectionKey, baseline, started, finished, actions, completed):
+        '''Add a run of resync on a collection.'''
+
+        Run = Query()
+        with self.lock:
+            self.db.insert({
+                'institution_key': institutionKey,
+                'collection_key': collectionKey,
+                'baseline': baseline,
+                'started': started,
+                'seconds': finished - started,
+                'actions': actions,
+                'completed': completed
+                })
+            runs = self.runs(institutionKey, collectionKey)
+            if len(runs) > self.keep:
+                cutoff = runs[-self.keep]['started']
+                self.db.remove((Run.institution_key == institutionKey) & (Run.collection_key == collectionKey) & (Run.started < cutoff))
+
+
+    def runs(self, institutionKey, collectionKey):
+        '''Return the runs of a collection, oldest first.'''
+
+        Run = Query()
+        return sorted(self.db.search((Run.institution_key == institutionKey) & (Run.collection_key == collectionKey)), key=lambda run: run['started'])
+
+
+    def all(self):
+        '''Return the runs of every collection, by (institution key, collection key), oldest first.'''
+
+        runs = collections.defaultdict(list)
+        for run in sorted(self.db.all(), key=lambda run: run['started']):
+            runs[(run['institution_key'], run['collection_key'])].append(run)
+        return runs
+
+
+class CollectionScheduler:
+    '''
+    Decides the order in which collections are synced, so that small collections and those that haven't been synced for a long time don't wait behind huge baselines.
+
+    The priority of a collection is how long ago it was last synced completely (up to `maxStaleness` seconds, which is also assumed for collections that never have been), divided by how long syncing it is expected to take: the median duration of its latest completed runs of the same kind (baseline or incremental), or a default for each kind if there are none.
+    '''
+
+    def __init__(self, history, baselineEstimate=3600.0, incrementalEstimate=60.0, maxStaleness=7 * 86400.0, samples=5, clock=time.time):
+        '''
+        history - a SyncHistory
+        baselineEstimate, incrementalEstimate - number of seconds that a baseline or incremental sync of a collection without any history is expected to take
+        maxStaleness - number of seconds after which collections are considered equally stale
+        samples - number of latest completed runs that estimates are based on
+        clock - function that returns the current time in seconds since the epoch
+        '''
+        self.history = history
+        self.baselineEstimate = baselineEstimate
+        self.incrementalEstimate = incrementalEstimate
+        self.maxStaleness = maxStaleness
+        self.samples = samples
+        self.clock = clock
+
+
+    def estimate(self, row, runs=None):
+        '''Return the number of seconds that syncing a collection is expected to take.'''
+
+        baseline = row['new'] is True
+        if runs is None:
+            runs = self.history.runs(row['institution_key'], row['collection_key'])
+        # the runs are oldest first
+        seconds = sorted([run['seconds'] for run in runs if run['completed'] and run['baseline'] == baseline][-self.samples:])
+        if len(seconds) == 0:
+            return self.baselineEstimate if baseline else self.incrementalEstimate
+        return seconds[len(seconds) // 2]
+
+
+    def staleness(self, row, runs=None):
+        '''Return the number of seconds since a collection was last synced completely, up to `maxStaleness`.'''
+
+        if runs is None:
+            runs = self.history.runs(row['institution_key'], row['collection_key'])
+        finished = [run['started'] + run['seconds'] for run in runs if run['completed']]
+        if len(finished) == 0:
+            return self.maxStaleness
+        return min(max(self.clock() - max(finished), 0.0), self.maxStaleness)
+
+
+    def priority(self, row, runs=None):
+        '''Return the priority of a collection; higher goes first.'''
+
+        if runs is None:
+            runs = self.history.runs(row['institution_key'], row['collection_key'])
+        return self.staleness(row, runs) / max(self.estimate(row, runs), 1.0)
+
+
+    def order(self, rows):
+        '''Return the given collections in the order they should be synced in.'''
+
+        history = self.history.all()
+        return sorted(rows, key=lambda row: -self.priority(row, history.get((row['institution_key'], row['collection_key']), [])))
+
+
+class HyperlinkRelevanceScorer:
+    '''
+    Ranks the hyperlinks of records in order of decreasing relevance. Everything that doesn't depend on the record (the host of the collection, how identifiers are matched, and the rules) is set up once, so one scorer should be made per collection and reused for all of its records.
+
+    A rule is a function that takes the ClassifiedUrl of a link, the identifier that is looked for, and the host of the collection, and returns whether the link matches it. The score of a link is the sum of the weights of the rules that it matches; links with equal scores keep their order.
+    '''
+
+    def __init__(self, host, rules=None, identifier=None, kinds=None, classifier=urlClassifier):
+        '''
+        host - the netloc of the collection's landing pages (usually that of its OAI-PMH endpoint)
+        rules - a list of (weight, rule) pairs (if unspecified, the identifier and host rules below are weighted equally)
+        identifier - function that returns the string to look for in the links of a record, given its identifier (e.g., its local identifier); if unspecified, the identifier itself
+        kinds - the UrlClassifier kinds of links to keep, or None to keep all links
+        classifier - a UrlClassifier used to parse the links
+        '''
+        self.host = host
+        self.rules = list(rules) if rules is not None else [(1, HyperlinkRelevanceScorer.containsIdentifier), (1, HyperlinkRelevanceScorer.onHost)]
+        self.identifier = identifier if identifier is not None else lambda identifier: identifier
+        self.kinds = frozenset(kinds) if kinds is not None else None
+        self.classifier = classifier
+
+
+    @staticmethod
+    def containsIdentifier(classified, identifier, host):
+        '''Rule that matches links that contain the identifier.'''
+
+        return identifier in classified.url
+
+
+    @staticmethod
+    def onHost(classified, identifier, host):
+        '''Rule that matches links on the host of the collection.'''
+
+        return classified.netloc == host
+
+
+    def score(self, classified, identifier):
+        '''Return the score of a link, given its ClassifiedUrl and the string looked for in it.'''
+
+        return sum(weight for weight, rule in self.rules if rule(classified, identifier, self.host))
+
+
+    def rank(self, identifier, links):
+        '''Return the distinct links of a record (of the kinds kept by this scorer), most relevant first.'''
+
+        return self.rankMany([(identifier, links)])[0]
+
+
+    def rankMany(self, records):
+        '''
+        Return the ranked links of each of the given records, like `rank`. Links shared by several records are only classified once.
+
+        records - an iterable of (identifier, links) pairs
+        '''
+
+        classified = {}
+        ranked = []
+        for identifier, links in records:
+            lookFor = self.identifier(identifier)
+            scored = []
+            for link in dict.fromkeys(links):
+                c = classified.get(link)
+                if c is None:
+                    c = classified[link] = self.classifier.classify(link)
+                if self.kinds is not None and c.kind not in self.kinds:
+                    continue
+                scored.append((self.score(c, lookFor), link))
+            scored.sort(key=lambda pair: pair[0], reverse=True)
+            ranked.append([link for score, link in scored])
+        return ranked
+
+
+class HyperlinkRelevanceHeuristicSorter:
+    '''
+    Sorts a list of hyperlinks in order of decreasing relevance based on the scoring heuristic. To rank the links of many records, make a HyperlinkRelevanceScorer once instead.
+    '''
+
+    def __init__(self, heuristics, links, classifier=urlClassifier):
+        '''
+        heuristics - a dictionary consisting of the following keys:
+        - "host": a string retrieved from the netloc property of the return value of urllib.parse.urlparse
+        - "identifier": the local identifier portion of the OAI identifier as described in http://www.openarchives.org/OAI/2.0/guidelines-oai-identifier.htm if the identifier is structured that way, otherwise the entire OAI identifier
+        links - a list of HTTP URLs
+        classifier - a UrlClassifier used to parse the links
+        '''
+        self.host = heuristics['host']
+        self.identifier = heuristics['identifier']
+        self.classifier = classifier
+
+        self.links = HyperlinkRelevanceScorer(self.host, classifier=classifier).rank(self.identifier, links)
+
+
+    def mostRelevant(self):
+        '''Return the most relevant link.'''
+
+        return self.links[0]
+
+
+    def rest(self):
+        '''Return the rest of the links.'''
+
+        return self.links[1:]
+
+
+MappedRecord = collections.namedtuple('MappedRecord', ['identifier', 'fields', 'thumbnails', 'links'])
+
+
+class MetadataMapper:
+    '''
+    Maps OAI-PMH records of a metadata format to Solr fields, in a single streaming pass over the XML.
+
+    Rules are dictionaries with the following keys:
+    - "path": slash-separated local names (without namespace prefixes) of the elements from the root element of the metadata (e.g., "mods/titleInfo/title"); "*" matches any part of a name
+    - "field" (optional): name of the Solr field that the text of the element goes in
+    - "thumbnail" (optional): priority of the text of the element as a possible thumbnail URL (lower is checked first)
+    - "link" (optional): whether the text of the element is a possible link to the record on its source's site
+    - "attributes" (optional): a dictionary of attribute values that the element must have
+
+    Rules are compiled once, when the mapper is created, and looked up by path as elements end.
+    '''
+
+    def __init__(self, metadataFormat, rules):
+        '''
+        metadataFormat - the OAI-PMH metadataPrefix of the records
+        rules - a list of rules, as described above
+        '''
+        self.metadataFormat = metadataFormat
+        self.exactRules = collections.defaultdict(list)
+        self.wildcardRules = []
+        for rule in rules:
+            unknownKeys = set(rule) - {'path', 'field', 'thumbnail', 'link', 'attributes'}
+            if len(unknownKeys) > 0:
+                raise ValueError('Unknown mapping rule keys: {}'.format(', '.join(sorted(unknownKeys))))
+
+            if '*' in rule['path']:
+                regex = re.compile('^' + re.escape(rule['path']).replace('\\*', '[^/]*') + '$')
+                self.wildcardRules.append((regex, rule))
+            else:
+                self.exactRules[tuple(rule['path'].split('/'))].append(rule)
+
+        # rules that apply to each path that has been seen, so wildcards are only matched once per path
+        self.rulesByPath = {}
+
+
+    def rulesFor(self, path):
+        '''Return the rules that apply to elements at a path (a tuple of local names).'''
+
+        try:
+            return self.rulesByPath[path]
+        except KeyError:
+            rules = self.exactRules.get(path, []) + [rule for regex, rule in self.wildcardRules if regex.match('/'.join(path))]
+            self.rulesByPath[path] = rules
+            return rules
+
+
+    def map(self, source):
+        '''
+        Return a MappedRecord with the values of the Solr fields, the possible thumbnail URLs (in order of priority), and the possible links of a record, or None if the record is deleted or can't be read.
+
+        source - the path of an OAI-PMH record file, or a file object
+        '''
+
+        identifier = None
+        fields = {}
+        thumbnails = []
+        links = []
+
+        # local names of the open elements, and how many of them enclose the metadata
+        stack = []
+        metadataDepth = None
+        hasMetadata = False
+
+        try:
+            for event, element in etree.iterparse(source, events=('start', 'end')):
+                tag = element.tag
+                if not isinstance(tag, str):
+                    continue
+                name = tag[tag.rfind('}') + 1:]
+
+                if event == 'start':
+                    stack.append(name)
+                    if name == 'header' and element.get('status') == 'deleted':
+                        return None
+                    elif name == 'metadata' and metadataDepth is None:
+                        metadataDepth = len(stack)
+                        hasMetadata = True
+                    continue
+
+                if metadataDepth is not None and len(stack) > metadataDepth:
+                    rules = self.rulesFor(tuple(stack[metadataDepth:]))
+                    # only leaf elements have values
+                    if len(rules) > 0 and len(element) == 0 and element.text is not None:
+                        value = element.text
+                        for rule in rules:
+                            if any(element.get(attribute) != expected for attribute, expected in rule.get('attributes', {}).items()):
+                                continue
+                            if rule.get('field') is not None:
+                                fields.setdefault(rule['field'], []).append(value)
+                            if rule.get('thumbnail') is not None:
+                                thumbnails.append((rule['thumbnail'], len(thumbnails), value))
+                            if rule.get('link', False):
+                                links.append(value)
+                elif name == 'identifier' and identifier is None and len(stack) >= 2 and stack[-2] == 'header':
+                    identifier = element.text
+                elif name == 'metadata':
+                    metadataDepth = None
+
+                stack.pop()
+                # don't hold on to the parse tree
+                if len(stack) > 0:
+                    element.clear()
+        except etree.XMLSyntaxError as e:
+            logger.error('Cannot parse record: {}'.format(e))
+            return None
+
+        if identifier is None or not hasMetadata:
+            return None
+
+        # ordered set (dict keys preserve insertion order)
+        thumbnailUrls = {value: None for priority, order, value in sorted(thumbnails)}
+        return MappedRecord(identifier, fields, list(thumbnailUrls), list({value: None for value in links}))
+
+
+# Dublin Core elements and the Solr fields they go in
+dublinCoreFields = {
+    'title': 'title_keyword',
+    'creator': 'creator_keyword',
+    'subject': 'subject_keyword',
+    'description': 'description_keyword',
+    'publisher': 'publisher_keyword',
+    'contributor': 'contributor_keyword',
+    'date': 'date_keyword',
+    'type': 'type_keyword',
+    'format': 'format_keyword',
+    'identifier': 'identifier_keyword',
+    'source': 'source_keyword',
+    'language': 'language_keyword',
+    'relation': 'relation_keyword',
+    'coverage': 'coverage_keyword',
+    'rights': 'rights_keyword'
+    }
+
+dublinCoreRules = [{'path': 'dc/' + element, 'field': field} for element, field in dublinCoreFields.items() if element != 'identifier'] + [
+    {'path': 'dc/identifier.thumbnail', 'thumbnail': 0},
+    {'path': 'dc/identifier', 'field': 'identifier_keyword', 'thumbnail': 1, 'link': True},
+    {'path': 'dc/identifier.*', 'thumbnail': 2}
+    ]
+
+modsRules = [
+    {'path': 'mods/titleInfo/title', 'field': 'title_keyword'},
+    {'path': 'mods/name/namePart', 'field': 'creator_keyword'},
+    {'path': 'mods/subject/topic', 'field': 'subject_keyword'},
+    {'path': 'mods/subject/name/namePart', 'field': 'subject_keyword'},
+    {'path': 'mods/subject/geographic', 'field': 'coverage_keyword'},
+    {'path': 'mods/subject/temporal', 'field': 'coverage_keyword'},
+    {'path': 'mods/abstract', 'field': 'description_keyword'},
+    {'path': 'mods/note', 'field': 'description_keyword'},
+    {'path': 'mods/tableOfContents', 'field': 'description_keyword'},
+    {'path': 'mods/originInfo/publisher', 'field': 'publisher_keyword'},
+    {'path': 'mods/originInfo/dateIssued', 'field': 'date_keyword'},
+    {'path': 'mods/originInfo/dateCreated', 'field': 'date_keyword'},
+    {'path': 'mods/originInfo/copyrightDate', 'field': 'date_keyword'},
+    {'path': 'mods/originInfo/dateOther', 'field': 'date_keyword'},
+    {'path': 'mods/typeOfResource', 'field': 'type_keyword'},
+    {'path': 'mods/genre', 'field': 'type_keyword'},
+    {'path': 'mods/physicalDescription/form', 'field': 'format_keyword'},
+    {'path': 'mods/physicalDescription/extent', 'field': 'format_keyword'},
+    {'path': 'mods/physicalDescription/internetMediaType', 'field': 'format_keyword'},
+    {'path': 'mods/identifier', 'field': 'identifier_keyword', 'link': True},
+    {'path': 'mods/location/url', 'field': 'identifier_keyword', 'thumbnail': 2, 'link': True},
+    {'path': 'mods/location/url', 'attributes': {'access': 'preview'}, 'thumbnail': 0},
+    {'path': 'mods/location/url', 'attributes': {'access': 'raw object'}, 'thumbnail': 1},
+    {'path': 'mods/location/physicalLocation', 'field': 'source_keyword'},
+    {'path': 'mods/language/languageTerm', 'field': 'language_keyword'},
+    {'path': 'mods/relatedItem/titleInfo/title', 'field': 'relation_keyword'},
+    {'path': 'mods/accessCondition', 'field': 'rights_keyword'}
+    ]
+
+# metadata format -> MetadataMapper
+metadataMappers = {}
+
+
+def registerMetadataMapper(mapper):
+    '''Make a MetadataMapper available for collections whose `metadata_format` is its format.'''
+
+    metadataMappers[mapper.metadataFormat] = mapper
+    return mapper
+
+
+def metadataMapper(metadataFormat):
+    '''Return the MetadataMapper for a metadata format. Raises ValueError if there is none.'''
+
+    try:
+        return metadataMappers[metadataFormat]
+    except KeyError:
+        raise ValueError('No metadata mapper for format "{}"'.format(metadataFormat))
+
+
+registerMetadataMapper(MetadataMapper('oai_dc', dublinCoreRules))
+registerMetadataMapper(MetadataMapper('mods', modsRules))
+
+
+class SolrDocument:
+    '''
+    Compact representation of a Solr document.
+
+    Every field that can be indexed has a slot. Single-valued fields hold their value, and multi-valued fields hold a list of values that is created when the first value is added. Unset fields are not serialized.
+    '''
+
+    singleValuedFields = (
+        'id',
+        'collectionKey',
+        'collectionName',
+        'institutionKey',
+        'institutionName',
+        'thumbnail_url',
+        'first_title',
+        'sort_decade',
+        'year_start',
+        'year_end',
+        'external_link'
+        )
+
+    multiValuedFields = (
+        'title_keyword',
+        'creator_keyword',
+        'subject_keyword',
+        'description_keyword',
+        'publisher_keyword',
+        'contributor_keyword',
+        'date_keyword',
+        'type_keyword',
+        'format_keyword',
+        'identifier_keyword',
+        'source_keyword',
+        'language_keyword',
+        'relation_keyword',
+        'coverage_keyword',
+        'rights_keyword',
+        'decade',
+        'date_range',
+        'alternate_external_link'
+        )
+
+    fields = singleValuedFields + multiValuedFields
+
+    __slots__ = fields
+
+
+    def __init__(self, **fields):
+        '''
+        fields - initial values of single-valued fields, keyed by Solr field name
+        '''
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+
+    def get(self, field):
+        '''Return the value of a field, or None if it hasn't been set.'''
+
+        return getattr(self, field, None)
+
+
+    def add(self, field, value):
+        '''Append a value to a multi-valued field.'''
+
+        try:
+            getattr(self, field).append(value)
+        except AttributeError:
+            setattr(self, field, [value])
+
+
+    def toSolr(self):
+        '''
+        Return the document as a dictionary that pysolr can index.
+
+        Multi-valued fields with a single value are represented by that value.
+        '''
+
+        doc = {}
+        for field in self.singleValuedFields:
+            value = getattr(self, field, None)
+            if value is not None:
+                doc[field] = value
+        for field in self.multiValuedFields:
+            values = getattr(self, field, None)
+            if values is not None:
+                doc[field] = values[0] if len(values) == 1 else values
+        return doc
+
+
+class SolrJsonUpdateWriter:
+    '''
+    Writes Solr documents to a file that can be posted to Solr's JSON update handler.
+    '''
+
+    def __init__(self, path):
+        '''
+        path - location of the file to write to
+        '''
+        self.path = path
+        self.count = 0
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+
+
+    def write(self, docs):
+        '''Append a list of Solr documents to the file.'''
+
+        for doc in docs:
+            if self.count > 0:
+                self.file.write(',\n')
+            self.file.write(dumps(doc))
+            self.count += 1
+
+
+    def close(self):
+        '''Finish the JSON array and close the file.'''
+
+        self.file.write('\n]\n')
+        self.file.close()
+
+
+class SolrCsvUpdateWriter:
+    '''
+    Writes Solr documents to a file that can be posted to Solr's CSV update handler.
+
+    Multi-valued fields are joined with a separator, which Solr must be told to split on (see `updateParams`). Separators (and escape characters) within their values are escaped with a backslash, so that they aren't split.
+    '''
+
+    escape = '\\'
+
+    def __init__(self, path, fields, separator='|', multiValuedFields=None):
+        '''
+        path - location of the file to write to
+        fields - list of every Solr field name that may appear in a document, in column order
+        separator - string used to join the values of multi-valued fields
+        multiValuedFields - names of the fields that are split on the separator, whether their values are lists or single values; if None, the fields that are written with lists of values
+        '''
+        self.path = path
+        self.fields = fields
+        self.separator = separator
+        self.count = 0
+        self.fixedMultiValuedFields = multiValuedFields is not None
+        self.multiValuedFields = set(multiValuedFields or [])
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=fields)
+        self.writer.writeheader()
+
+
+    def write(self, docs):
+        '''Append a list of Solr documents to the file.'''
+
+        for doc in docs:
+            row = {}
+            for key, value in doc.items():
+                if isinstance(value, list):
+                    if not self.fixedMultiValuedFields:
+                        self.multiValuedFields.add(key)
+                    row[key] = self.separator.join(self.__escape(v) for v in value)
+                elif key in self.multiValuedFields and value is not None:
+                    row[key] = self.__escape(value)
+                else:
+                    row[key] = value
+            self.writer.writerow(row)
+            self.count += 1
+
+
+    def close(self):
+        '''Close the file.'''
+
+        self.file.close()
+
+
+    def updateParams(self):
+        '''Return the query string to use when posting the file to Solr's CSV update handler.'''
+
+        params = [('commit', 'true')]
+        for field in sorted(self.multiValuedFields):
+            params.append(('f.{}.split'.format(field), 'true'))
+            params.append(('f.{}.separator'.format(field), self.separator))
+            params.append(('f.{}.escape'.format(field), self.escape))
+        return urllib.parse.urlencode(params)
+
+
+    def __escape(self, value):
+        return str(value).replace(self.escape, self.escape + self.escape).replace(self.separator, self.escape + self.separator)
+
+
+class SolrWriter:
+    '''
+    Sends updates to a Solr index over a pool of kept-alive connections, optionally with gzipped request bodies.
+
+    Updates are sent in `streams` parallel streams. All of the updates to a document go through the same stream (chosen by a hash of its ID), so they're carried out in the order they were made. Updates aren't committed one by one: they become visible within `commitWithin` milliseconds, if it's set, or once `commit` is called.
+
+    Updates to single documents can be buffered (see `buffer`), so that each stream sends them in batches of up to `batchSize`, or whatever it has after `batchDelay` seconds, instead of making a request for each one.
+
+    Searches are delegated to a pysolr client that shares the connections.
+    '''
+
+    def __init__(self, url, streams=1, compress=False, commitWithin=None, softCommit=False, timeout=60, batchSize=100, batchDelay=1.0, breaker=None, clock=time.monotonic):
+        '''
+        url - URL of the Solr core
+        streams - number of updates to send at the same time
+        compress - whether to gzip the bodies of update requests (Solr has to be set up to accept them)
+        commitWithin - number of milliseconds within which Solr should commit each update, or None to leave it to `commit` and the autoCommit settings of the core
+        softCommit - whether `commit` makes updates visible without writing them to disk
+        timeout - number of seconds to wait for each response
+        batchSize - number of buffered updates that a stream sends at once
+        batchDelay - number of seconds after which a stream sends its buffered updates, even if there are fewer than `batchSize`
+        breaker - a CircuitBreaker that buffered updates aren't sent while it's open, or None
+        clock - function that returns the current time in seconds
+        '''
+        self.url = url.rstrip('/')
+        self.compress = compress
+        self.commitWithin = commitWithin
+        self.softCommit = softCommit
+        self.timeout = timeout
+        self.batchSize = batchSize
+        self.batchDelay = batchDelay
+        self.breaker = breaker
+        self.clock = clock
+
+        # a connection for each stream, and one for searches and commits
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=streams + 1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # each stream has a single thread, so that its updates are sent in order
+        self.streams = [ThreadPoolExecutor(max_workers=1) for i in range(streams)]
+
+        # updates that have been buffered for each stream, and when the oldest one was
+        self.buffers = [[] for i in range(streams)]
+        self.bufferedAt = [None] * streams
+        self.buffersLock = threading.Lock()
+
+        self.client = pysolr.Solr(self.url, timeout=timeout)
+        self.client.session = self.session
+
+
+    def stream(self, id):
+        '''Return the index of the stream that the updates to the document with the given ID go through.'''
+
+        return zlib.crc32(str(id).encode('utf-8')) % len(self.streams)
+
+
+    def submit(self, id, fn, *args, **kwargs):
+        '''Call a function in the stream of the document with the given ID, after everything that has been submitted or buffered for that stream before. Returns a Future.'''
+
+        i = self.stream(id)
+        self.__drain(i)
+        return self.streams[i].submit(fn, *args, **kwargs)
+
+
+    def buffer(self, operation, id, payload, done=None):
+        '''
+        Buffer an operation on a single document (see `send`), to be sent in a batch by its stream.
+
+        done - function that is called from the stream once the operation has been sent, with None, or with the exception (or reason) it couldn't be sent
+        '''
+
+        i = self.stream(id)
+        with self.buffersLock:
+            if len(self.buffers[i]) == 0:
+                self.bufferedAt[i] = self.clock()
+            self.buffers[i].append((operation, id, payload, done))
+            full = len(self.buffers[i]) >= self.batchSize
+
+        if full:
+            self.__drain(i)
+        # streams that haven't had anything to add for a while send what they have
+        now = self.clock()
+        for j, bufferedAt in enumerate(self.bufferedAt):
+            if bufferedAt is not None and now - bufferedAt >= self.batchDelay:
+                self.__drain(j)
+
+
+    def send(self, operation, payload):
+        '''
+        Carry out an operation right away, in the calling thread. Raises an exception if it fails.
+
+        operation - "add", with a payload of the form {"docs": [...], "fieldUpdates": {...}} (fieldUpdates, a dictionary from field names to atomic update operations like "set", may be omitted); or "delete", with a payload of the form {"id": ...} (an ID or a list of them) or {"query": ...}
+        '''
+
+        if operation == 'add':
+            fieldUpdates = payload.get('fieldUpdates') or {}
+            message = [{field: {fieldUpdates[field]: value} if field in fieldUpdates else value for field, value in doc.items()} for doc in payload['docs']]
+        elif operation == 'delete' and 'id' in payload:
+            message = {'delete': payload['id']}
+        elif operation == 'delete' and 'query' in payload:
+            message = {'delete': {'query': payload['query']}}
+        else:
+            raise ValueError('Unknown Solr operation: {}'.format(operation))
+
+        params = {} if self.commitWithin is None else {'commitWithin': int(self.commitWithin)}
+        self.__post(message, params)
+
+
+    def add(self, docs, fieldUpdates=None):
+        '''Add documents (or, with fieldUpdates, update their fields; see `send`) through their streams, and wait until they have all been sent. Raises the first exception, if any.'''
+
+        partitions = collections.defaultdict(list)
+        for doc in docs:
+            partitions[self.stream(doc['id'])].append(doc)
+        for i in partitions:
+            self.__drain(i)
+        futures = [self.streams[i].submit(self.send, 'add', {'docs': partition, 'fieldUpdates': fieldUpdates}) for i, partition in partitions.items()]
+        wait(futures)
+        for future in futures:
+            future.result()
+
+
+    def delete(self, id=None, q=None):
+        '''Delete a document by ID through its stream, or, once everything that has been submitted so far has been sent, the documents that match a query.'''
+
+        if id is not None:
+            self.submit(id, self.send, 'delete', {'id': id}).result()
+        elif q is not None:
+            self.flush()
+            self.send('delete', {'query': q})
+        else:
+            raise ValueError('An ID or a query is required')
+
+
+    def flush(self):
+        '''Wait until everything that has been submitted or buffered so far has been sent.'''
+
+        for i in range(len(self.streams)):
+            self.__drain(i)
+        wait([stream.submit(lambda: None) for stream in self.streams])
+
+
+    def commit(self):
+        '''Make everything that has been submitted so far visible to searches.'''
+
+        self.flush()
+        self.__post([], {'softCommit': 'true'} if self.softCommit else {'commit': 'true'})
+
+
+    def search(self, q, **kwargs):
+        '''Search the index; see pysolr.Solr.search.'''
+
+        return self.client.search(q, **kwargs)
+
+
+    def close(self):
+        '''Wait until everything that has been submitted or buffered has been sent, and close the connections.'''
+
+        for i in range(len(self.streams)):
+            self.__drain(i)
+        for stream in self.streams:
+            stream.shutdown()
+        self.session.close()
+
+
+    def __drain(self, i):
+        '''Have stream `i` send the updates that have been buffered for it.'''
+
+        with self.buffersLock:
+            entries = self.buffers[i]
+            if len(entries) == 0:
+                return
+            self.buffers[i] = []
+            self.bufferedAt[i] = None
+            # submitted while holding the lock, so that batches for the same stream can't overtake one another
+            self.streams[i].submit(self.__sendBuffered, entries)
+
+
+    def __sendBuffered(self, entries):
+        # consecutive adds (with the same field updates) and consecutive deletes by ID go in one request each, so that the order of the updates to each document is kept
+        runs = []
+        for entry in entries:
+            operation, id, payload, done = entry
+            key = (operation, dumps(payload.get('fieldUpdates'), sort_keys=True)) if operation == 'add' else (operation, 'id' in payload)
+            if len(runs) > 0 and runs[-1][0] == key and key != ('delete', False):
+                runs[-1][1].append(entry)
+            else:
+                runs.append((key, [entry]))
+
+        error = None
+        for (operation, detail), run in runs:
+            if error is None and self.breaker is not None and not self.breaker.allow():
+                error = 'circuit breaker open'
+            if error is None:
+                try:
+                    if operation == 'add':
+                        self.send('add', {'docs': [doc for entry in run for doc in entry[2]['docs']], 'fieldUpdates': run[0][2].get('fieldUpdates')})
+                    elif detail:
+                        self.send('delete', {'id': [entry[1] for entry in run]})
+                    else:
+                        self.send('delete', run[0][2])
+                except Exception as e:
+                    logger.error('Something went wrong while trying to send {} updates to Solr: {}'.format(len(run), e))
+                    error = e
+                    if self.breaker is not None:
+                        self.breaker.failure()
+                else:
+                    if self.breaker is not None:
+                        self.breaker.success()
+
+            # once an update can't be sent, the ones after it aren't tried either, so that none of them overtakes an earlier one on the same document
+            for operation, id, payload, done in run:
+                if done is not None:
+                    done(error)
+
+
+    def __post(self, message, params):
+        body = dumps(message).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.compress:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        response = self.session.post(self.url + '/update', params=dict(params, wt='json'), data=body, headers=headers, timeout=self.timeout)
+        if response.status_code >= 400:
+            raise pysolr.SolrError('Solr responded with {}: {}'.format(response.status_code, response.text[:500]))
+
+
+class SolrDocumentArchive:
+    '''
+    Columnar archive of the Solr documents that have been indexed, for analytics and for reloading Solr without parsing records again. Requires pyarrow.
+
+    Documents are stored in Parquet files partitioned by institution and collection (in Hive-style directories, "institutionKey=<key>/collectionKey=<key>"), with one file per partition per run, so that each run only adds files. The rows of each file are sorted by ID (keeping the order of the rows of each document), so that the files of a collection can be merged to replay it a document at a time. Besides the Solr fields, each row has the run that wrote it ("_run") and what was done ("_action"):
+    - "add": the document was indexed
+    - "set": the non-null fields of the document were set with an atomic update
+    - "delete": the document was deleted
+    '''
+
+    ADD = 'add'
+    SET = 'set'
+    DELETE = 'delete'
+
+    integerFields = {'sort_decade', 'year_start', 'year_end', 'decade'}
+
+    def __init__(self, root, runId=None, rowGroupSize=10000):
+        '''
+        root - the directory that holds the partitions
+        runId - name of the files written by this run, which must sort after those of earlier runs (defaults to the current UTC time and the process ID)
+        rowGroupSize - number of rows of a partition to buffer before writing them
+        '''
+        if pyarrow is None:
+            raise ImportError('pyarrow is required to archive Solr documents')
+
+        self.root = root
+        self.runId = runId if runId is not None else '{}-{}'.format(time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), os.getpid())
+        self.rowGroupSize = rowGroupSize
+        self.schema = self.__schema()
+        self.buffers = collections.defaultdict(list)
+        self.writers = {}
+        self.count = 0
+
+
+    @staticmethod
+    def available():
+        '''Return True if pyarrow is installed.'''
+
+        return pyarrow is not None
+
+
+    @classmethod
+    def __schema(cls):
+        columns = []
+        for field in SolrDocument.singleValuedFields:
+            columns.append((field, pyarrow.int64() if field in cls.integerFields else pyarrow.string()))
+        for field in SolrDocument.multiValuedFields:
+            columns.append((field, pyarrow.list_(pyarrow.int64() if field in cls.integerFields else pyarrow.string())))
+        columns += [('_action', pyarrow.string()), ('_run', pyarrow.string())]
+        return pyarrow.schema(columns)
+
+
+    def add(self, docs):
+        '''Append Solr documents (as returned by SolrDocument.toSolr) that have been indexed.'''
+
+        for doc in docs:
+            self.__append(doc['institutionKey'], doc['collectionKey'], doc, self.ADD)
+
+
+    def update(self, institutionKey, collectionKey, docs):
+        '''Append partial Solr documents of a collection whose fields have been set with an atomic update.'''
+
+        for doc in docs:
+            self.__append(institutionKey, collectionKey, doc, self.SET)
+
+
+    def delete(self, institutionKey, collectionKey, ids):
+        '''Append the IDs of Solr documents of a collection that have been deleted.'''
+
+        for id in ids:
+            self.__append(institutionKey, collectionKey, {'id': id}, self.DELETE)
+
+
+    def close(self):
+        '''Write the buffered rows and close the files.'''
+
+        for partition in list(self.buffers):
+            self.__flush(partition)
+        for partition, writer in self.writers.items():
+            writer.close()
+            self.__sortFile(self.__path(partition))
+        self.writers = {}
+        logger.info('Archived {} Solr document changes to "{}"'.format(self.count, self.root))
+
+
+    def partitions(self):
+        '''Return the (institution key, collection key) pairs that have been archived.'''
+
+        partitions = []
+        for institutionDir in sorted(glob.glob(os.path.join(glob.escape(self.root), 'institutionKey=*'))):
+            for collectionDir in sorted(glob.glob(os.path.join(glob.escape(institutionDir), 'collectionKey=*'))):
+                partitions.append((
+                    urllib.parse.unquote(os.path.basename(institutionDir).split('=', 1)[1]),
+                    urllib.parse.unquote(os.path.basename(collectionDir).split('=', 1)[1])))
+        return partitions
+
+
+    def documents(self, institutionKey, collectionKey, batchSize=100):
+        '''
+        Yield the current Solr documents of a collection, in order of ID, i.e., the result of replaying its archived rows in order: documents that were deleted last are left out, and fields set by atomic updates are applied.
+
+        The files of all the runs are merged by ID, reading `batchSize` rows of each at a time, so only the rows of one document are replayed at a time.
+        '''
+
+        runs = []
+        for path in sorted(glob.glob(os.path.join(glob.escape(self.partitionDir(institutionKey, collectionKey)), '*.parquet'))):
+            parquetFile = self.__open(path)
+            if (parquetFile.schema_arrow.metadata or {}).get(b'sorted_by') == b'id':
+                runs.append(self.__rows(parquetFile, range(parquetFile.num_row_groups), batchSize))
+            else:
+                # files written before they were sorted are sorted here, a row group at a time
+                runs += [sorted(self.__rows(parquetFile, [i], batchSize), key=self.__id) for i in range(parquetFile.num_row_groups)]
+
+        # the rows of each document come out of the merge in the order of the runs that wrote them
+        for id, rows in itertools.groupby(heapq.merge(*runs, key=self.__id), key=self.__id):
+            doc = None
+            for row in rows:
+                action = row.pop('_action')
+                del row['_run']
+                if action == self.DELETE:
+                    doc = None
+                elif action == self.SET:
+                    if doc is not None:
+                        doc.update((field, value) for field, value in row.items() if value is not None)
+                else:
+                    doc = {field: value for field, value in row.items() if value is not None}
+            if doc is not None:
+                yield doc
+
+
+    def partitionDir(self, institutionKey, collectionKey):
+        '''Return the directory that holds the files of a collection.'''
+
+        return os.path.join(
+            self.root,
+            'institutionKey=' + urllib.parse.quote(institutionKey, safe=''),
+            'collectionKey=' + urllib.parse.quote(collectionKey, safe=''))
+
+
+    def __append(self, institutionKey, collectionKey, doc, action):
+        row = {'_action': action, '_run': self.runId}
+        for field in SolrDocument.singleValuedFields:
+            row[field] = doc.get(field)
+        for field in SolrDocument.multiValuedFields:
+            value = doc.get(field)
+            # single values of multi-valued fields aren't in lists (see SolrDocument.toSolr)
+            row[field] = value if value is None or isinstance(value, list) else [value]
+
+        partition = (institutionKey, collectionKey)
+        self.buffers[partition].append(row)
+        self.count += 1
+        if len(self.buffers[partition]) >= self.rowGroupSize:
+            self.__flush(partition)
+
+
+    def __path(self, partition):
+        return os.path.join(self.partitionDir(*partition), self.runId + '.parquet')
+
+
+    @staticmethod
+    def __id(row):
+        return row['id']
+
+
+    @staticmethod
+    def __open(path):
+        # read a page at a time rather than a whole row group at once
+        return pyarrow.parquet.ParquetFile(path, buffer_size=64 * 1024, pre_buffer=False)
+
+
+    @staticmethod
+    def __rows(parquetFile, rowGroups, batchSize):
+        for batch in parquetFile.iter_batches(batch_size=batchSize, row_groups=list(rowGroups)):
+            yield from batch.to_pylist()
+
+
+    def __sortFile(self, path):
+        # merge the row groups of a file written by this run, each of which is sorted (see __flush), into a file that's sorted as a whole
+        parquetFile = self.__open(path)
+        rows = heapq.merge(*[self.__rows(parquetFile, [i], 100) for i in range(parquetFile.num_row_groups)], key=self.__id)
+        schema = self.schema.with_metadata({'sorted_by': 'id'})
+        with pyarrow.parquet.ParquetWriter(path + '.sorting', schema) as writer:
+            while True:
+                batch = list(itertools.islice(rows, self.rowGroupSize))
+                if len(batch) == 0:
+                    break
+                writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+        os.replace(path + '.sorting', path)
+
+
+    def __flush(self, partition):
+        rows = self.buffers.pop(partition, [])
+        if len(rows) == 0:
+            return
+        # stable, so the rows of each document stay in order
+        rows.sort(key=lambda row: row['id'])
+
+        if partition not in self.writers:
+            directory = self.partitionDir(*partition)
+            os.makedirs(directory, exist_ok=True)
+            self.writers[partition] = pyarrow.parquet.ParquetWriter(self.__path(partition), self.schema)
+        self.writers[partition].write_table(pyarrow.Table.from_pylist(rows, schema=self.schema))
+
+
+ResyncAction = collections.namedtuple('ResyncAction', ['action', 'resource_url', 'local_file'])
+
+
+resyncActionPattern = re.compile(rb'(created|updated|deleted): (.*?) -> (.*?)(?: -> .*)?\r?\n?$')
+
+
+def resyncActions(lines):
+    '''
+    Lazily parse lines of resync output, yielding a ResyncAction for each line that reports a created, updated, or deleted resource and skipping the rest.
+
+    lines - an iterable of bytes, e.g. the stdout of a resync process, which is only read as fast as the actions are consumed
+    '''
+
+    match = resyncActionPattern.match
+    for line in lines:
+        m = match(line)
+        if m is not None:
+            action, resourceUrl, localFile = m.groups()
+            yield ResyncAction(action.decode(), resourceUrl.decode(), os.fsdecode(localFile))
+
+
+SitemapEntry = collections.namedtuple('SitemapEntry', ['loc', 'change', 'length', 'datetime'])
+
+
+ChangePlan = collections.namedtuple('ChangePlan', ['resources', 'created', 'updated', 'deleted', 'bytes', 'unknown_lengths'])
+
+
+class SitemapFetcher:
+    '''
+    Fetches and parses ResourceSync documents (ResourceLists, ChangeLists, and the sitemap indexes that split them up) concurrently, without writing anything.
+
+    Each document is only fetched once for the lifetime of the object, even if it's asked for by several threads at once.
+    '''
+
+    sitemapNamespace = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+    resourceSyncNamespace = 'http://www.openarchives.org/rs/terms/'
+
+    def __init__(self, workers=8, timeout=30, fetch=get):
+        '''
+        workers - number of documents to fetch at the same time
+        timeout - number of seconds to wait for each response
+        fetch - function like requests.get
+        '''
+        self.timeout = timeout
+        self.fetch = fetch
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.bytes = 0
+
+
+    def document(self, url):
+        '''Return the parsed document at the given URL, fetching it if it hasn't been yet.'''
+
+        with self.lock:
+            future = self.cache.get(url)
+            if future is None:
+                future = self.pool.submit(self.__fetch, url)
+                self.cache[url] = future
+        return future.result()
+
+
+    def __fetch(self, url):
+        response = self.fetch(url, timeout=self.timeout)
+        response.raise_for_status()
+        with self.lock:
+            self.fetched += 1
+            self.bytes += len(response.content)
+        return etree.fromstring(response.content)
+
+
+    def entries(self, url):
+        '''Return the SitemapEntries of the sitemap at the given URL, fetching the sitemaps that it refers to concurrently if it's a sitemap index.'''
+
+        root = self.document(url)
+        if etree.QName(root).localname == 'sitemapindex':
+            urls = [loc.text.strip() for loc in root.iter('{%s}loc' % self.sitemapNamespace)]
+            # start fetching all of them before waiting for any
+            for sitemapUrl in urls:
+                with self.lock:
+                    if sitemapUrl not in self.cache:
+                        self.cache[sitemapUrl] = self.pool.submit(self.__fetch, sitemapUrl)
+            return [entry for sitemapUrl in urls for entry in self.entries(sitemapUrl)]
+
+        entries = []
+        for element in root.iter('{%s}url' % self.sitemapNamespace):
+            loc = element.findtext('{%s}loc' % self.sitemapNamespace)
+            if loc is None:
+                continue
+            md = element.find('{%s}md' % self.resourceSyncNamespace)
+            attributes = md.attrib if md is not None else {}
+            length = attributes.get('length')
+            entries.append(SitemapEntry(
+                loc.strip(),
+                attributes.get('change'),
+                int(length) if length is not None and length.isdigit() else None,
+                attributes.get('datetime') or element.findtext('{%s}lastmod' % self.sitemapNamespace)))
+        return entries
+
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def planChanges(resources, changes=None, since=None):
+    '''
+    Return a ChangePlan of what syncing a collection would do, from the SitemapEntries of its ResourceList and of its ChangeList.
+
+    If `changes` is None, a baseline sync is planned, which creates every resource. Otherwise, an incremental sync is planned: the last change to each resource since the time `since` (in seconds since the epoch; or ever, if None) is counted.
+    '''
+
+    if changes is None:
+        planned = {entry.loc: entry._replace(change='created') for entry in resources}
+    else:
+        planned = {}
+        for entry in changes:
+            if since is not None and entry.datetime is not None and parse(entry.datetime).timestamp() < since:
+                continue
+            # a resource that was created and then updated is still new to the destination
+            if entry.change == 'updated' and planned.get(entry.loc, entry).change == 'created':
+                entry = entry._replace(change='created')
+            planned[entry.loc] = entry
+
+    counts = collections.Counter(entry.change for entry in planned.values())
+    lengths = [entry.length for entry in planned.values() if entry.change != 'deleted']
+    return ChangePlan(
+        len(resources),
+        counts['created'],
+        counts['updated'],
+        counts['deleted'],
+        sum(length for length in lengths if length is not None),
+        len([length for length in lengths if length is None]))
+
+
+def discoverCollections(resourcesync_sourcedescription, oaipmh_endpoint, collection_keys=None, institution_name=None, resource_dir='resourcesync', metadata_format=None):
+    '''
+    Return the rows that `PRRLATinyDB.import_collections` would add to the database for an institution's ResourceSync-able collections, without adding them. See `PRRLATinyDB.import_collections` for the arguments.
+    '''
+    if metadata_format is None:
+        metadata_format = 'oai_dc'
+    # make sure the records can be mapped
+    metadataMapper(metadata_format)
+
+    rs_soup = BeautifulSoup(get(resourcesync_sourcedescription).content, 'xml')
+    capabilitylist_urls = [a.string for a in rs_soup.find_all('loc')]
+
+    sickle = Sickle(oaipmh_endpoint)
+    sets = sickle.ListSets()
+    identify = sickle.Identify()
+
+    set_spec_to_name = {z.setSpec:z.setName for z in sets}
+    url_map_from = '/'.join(oaipmh_endpoint.split(sep='/')[:-1]) + '/'
+
+    i_name = institution_name if institution_name is not None else identify.repositoryName
+
+    has_capability = lambda c, tag: tag.md is not None and 'capability' in tag.md.attrs and tag.md['capability'] == c
+
+    rows = []
+    for capabilitylist_url in capabilitylist_urls:
+
+        # For now, get setSpec from the path component of the CapabilityList URL (which may have percent-encoded characters)
+        set_spec = urllib.parse.unquote(urllib.parse.urlparse(capabilitylist_url).path.split(sep='/')[2])
+
+        # If a subset of collections is specified, only add collections that belong to it. Otherwise, add all collections.
+        if collection_keys is None or (collection_keys is not None and set_spec in collection_keys):
+
+            r_soup = BeautifulSoup(get(capabilitylist_url).content, 'xml')
+
+            # ResourceList should always exist, but if it doesn't, log it and skip this collection
+            try:
+                resourcelist_url = r_soup.find(functools.partial(has_capability, 'resourcelist')).loc.string
+            except AttributeError:
+                # TODO: log it
+                pass
+                continue
+
+            # If no ChangeList exists yet, that's ok; predict what its URL will be
+            try:
+                changelist_url = r_soup.find(functools.partial(has_capability, 'changelist')).loc.string
+            except AttributeError:
+                changelist_url = '/'.join(resourcelist_url.split(sep='/')[:-1] + ['changelist_0000.xml'])
+
+            rows.append({
+                'institution_key': identify.repositoryIdentifier,
+                'institution_name': i_name,
+                'collection_key': set_spec,
+                'collection_name': set_spec_to_name[set_spec],
+                'resourcelist_uri': resourcelist_url,
+                'changelist_uri': changelist_url,
+                'url_map_from': url_map_from,
+                'file_path_map_to': resource_dir,
+                'metadata_format': metadata_format,
+                'new': True
+                })
+    return rows
+
+
+class PRRLATinyDB:
+    '''
+    Helper class for simplifying interactions with the TinyDB instance.
+    '''
+
+    def __init__(self, path):
+        self.db = TinyDB(path)
+
+
+    def show_collections(self, institution_keys=None):
+        '''
+        Prints a list of collections from the database.
+
+        If a list of institution keys is specified (with values found in the 
+        `institution_key` column in the database), then show collections of 
+        only those institutions. Otherwise, show all collections in the 
+        database.
+
+        Args:
+          institution_keys: a list of values found in the `institution_key` 
+              column in the database
+
+        Returns:
+          None
+        '''
+        # TODO: add parameter to choose which fields to print, or to print data in tabular form
+        if (institution_keys is None):
+            print(dumps(self.db.all(), indent=4))
+        else:
+            Row = Query()
+            results = []
+            for institution_key in institution_keys:
+                results += self.db.search(Row.institution_key == institution_key)
+            print(dumps(results, indent=4))
+
+
+    def import_collections(self, resourcesync_sourcedescription, oaipmh_endpoint, collection_keys=None, institution_name=None, resource_dir='resourcesync', overwrite=False, metadata_format=None):
+        '''
+        Adds an institution's ResourceSync-able collections to the database.
+
+        If `collection_keys` is specified, then add to the database only
+        the collections specified by that list. Otherwise, add all collections 
+        to the database.
+
+        Args:
+          resourcesync_sourcedescription: a ResourceSync SourceDescription URL
+              see https://www.openarchives.org/rs/1.1/resourcesync#SourceDesc
+          oaipmh_endpoint: a OAI-PMH base URL
+              see https://www.openarchives.org/OAI/openarchivesprotocol.html#Identify
+          collection_keys: a list of collection keys specifying an
+              exclusive list of collections to add to the database
+          institution_name: human-readable name of the institution which
+              should be used instead of its OAI-PMH repositoryName
+          resource_dir: path to the local directory to store copies of the
+              synced resources to, relative to the home directory "~"
+          overwrite: whether or not to overwrite rows in the database that
+              match the `collection_key` and `institution_key`
+          metadata_format: the OAI-PMH metadata format that the collections
+              are published in by the source (see `metadataMappers`); if
+              it isn't specified, new collections get "oai_dc" and
+              overwritten ones keep the format they have
+
+        Returns:
+          None
+        '''
+        for row in discoverCollections(resourcesync_sourcedescription, oaipmh_endpoint, collection_keys, institution_name, resource_dir, metadata_format):
+
+            print(self.__collection_identifier(row['institution_name'], row['institution_key'], row['collection_name'], row['collection_key']))
+
+            # We can add the collection to the database now
+            # TODO: catch exceptions
+            self.__insert_or_update(
+                row['institution_key'],
+                row['institution_name'],
+                row['collection_key'],
+                row['collection_name'],
+                row['resourcelist_uri'],
+                row['changelist_uri'],
+                row['url_map_from'],
+                row['file_path_map_to'],
+                overwrite,
+                metadata_format
+                )
+
+
+    def set_thumbnail_rules(self, institution_key, collection_key, rules):
+        '''
+        Sets the rules used to find thumbnails for a collection without making network requests.
+
+        Args:
+          institution_key: a value found in the `institution_key` column in
+              the database
+          collection_key: a value found in the `collection_key` column in
+              the database
+          rules: a dictionary of rules as described in `ThumbnailRules`, or
+              None to remove the rules
+
+        Returns:
+          None
+        '''
+        # make sure the rules are valid
+        ThumbnailRules(rules)
+
+        Row = Query()
+        self.db.update({'thumbnail_rules': rules}, (Row.institution_key == institution_key) & (Row.collection_key == collection_key))
+
+
+    def remove_collections(self, institution_key, collection_keys=None):
+        '''
+        Removes collections of a given institution from the database.
+
+        If a list of collection keys is specified (with values found in the 
+        `collection_key` column in the database), then remove only those 
+        collections. Otherwise, remove all of the institution's collections.
+
+        Only the rows are removed; to also remove the collections' Solr
+        documents, thumbnails, and synced files, use `destination.py purge`.
+
+        Args:
+          institution_key: a value found in the `institution_key` column in 
+              the database
+          collection_keys: a list of values found in the `collection_key` 
+              column in the database
+
+        Returns
+          None
+        '''
+        # TODO: print collections that we remove
+        Row = Query()
+        if (collection_keys is None):
+            self.db.remove(Row.institution_key == institution_key)
+        else:
+            for collection_key in collection_keys:
+                self.db.remove((Row.institution_key == institution_key) & (Row.collection_key == collection_key))
+
+
+    def __insert_or_update(self, institution_key, institution_name, collection_key, collection_name, resourcelist_uri, changelist_uri, url_map_from, resource_dir='resourcesync', overwrite=False, metadata_format=None):
+        '''
+        Adds or updates a single row in the database.
+
+        This method should normally be called only by `import_collections`.
+
+        Args:
+          institution_key: a machine-readable name for an institution
+          institution_name: a human-readable name for an institution
+          collection_key: a machine-readable name for a collection
+          collection_name: a human-readable name for a collection
+          resourcelist_uri: a URL for a ResourceSync ResourceList
+          changelist_uri: a URL for a ResourceSync ChangeList
+          url_map_from: the leading part of a Resource's URL to cut off in 
+              order to map the URL to a local filename
+          resource_dir: path to the local directory to store copies of the 
+              synced resources to, relative to the home directory "~"
+          overwrite: whether or not to overwrite rows in the database that 
+              match the `collection_key` and `institution_key`
+          metadata_format: the OAI-PMH metadata format of the collection's
+              records, or None to use "oai_dc" for a new row and to keep
+              the format of an existing one
+
+        Returns:
+          None
+        '''
+        # TODO: change *_uri parameters to *_url
+        # TODO: throw errors when warranted
+        Row = Query()
+        row_query = (Row.institution_key == institution_key) & (Row.collection_key == collection_key)
+        existing_row = self.db.get(row_query)
+        if existing_row is None:
+            # NOTE: if either `collection_key` or `institution_key` change for any given collection,
+            # the filesystem location of the saved files will also change,
+            # since resources are saved under the path `file_path_map_to`/`institution_key`/`collection_key`.
+
+            # TODO: keep track of potential stale directories so they can be manually deleted.
+            # This could involve logging calls to `add` where a row in the DB doesn't match the `institution_key` and `collection_key` parameters,
+            # but DOES match either 1) both the `institution_name` and `collection_name` parameters, or 2) one of the URI parameters.
+
+            self.db.insert({
+                'institution_key': institution_key,
+                'institution_name': institution_name,
+                'collection_key': collection_key,
+                'collection_name': collection_name,
+                'resourcelist_uri': resourcelist_uri,
+                'changelist_uri': changelist_uri,
+                'url_map_from': url_map_from,
+                'file_path_map_to': resource_dir,
+                'metadata_format': metadata_format if metadata_format is not None else 'oai_dc',
+                'new': True
+                })
+        elif overwrite == True:
+
+            # TODO: if `file_path_map_to` changes, then we need to do a baseline synchronization again,
+            # because that means the files will change location on the filesystem.
+            # However, `file_path_map_to` should not be changed once chosen.
+            fields = {
+                'institution_key': institution_key,
+                'institution_name': institution_name,
+                'collection_key': collection_key,
+                'collection_name': collection_name,
+                'resourcelist_uri': resourcelist_uri,
+                'changelist_uri': changelist_uri,
+                'url_map_from': url_map_from,
+                'file_path_map_to': resource_dir
+                }
+            if metadata_format is not None:
+                fields['metadata_format'] = metadata_format
+
+            # Solr documents hold copies of the names, so they need to be updated too (see `destination.py update-metadata`)
+            if existing_row['institution_name'] != institution_name or existing_row['collection_name'] != collection_name:
+                fields['solr_metadata_stale'] = True
+
+            self.db.update(fields, row_query)
         else:
             # If row already exists and we don't want to overwrite, no-op.
             # TODO: log
@@ -0,0 +1,44 @@
+'''
+Micro-benchmark for DateCleanerAndFaceter.
+
+Run from the root of the repository:
+
+    PYTHONPATH=. python3 test/bench_util.py
+'''
+
+import random
+import timeit
+from resourcesync_oai_pmh.destination.util import DateCleanerAndFaceter
+from test_util import DATES
+
+
+def syntheticCorpus(n, seed=0):
+    '''
+    Return n date strings, mostly in the shapes that are common in our metadata, with a few dirty dates mixed in.
+    '''
+
+    r = random.Random(seed)
+    dirty = [d for d, decades in DATES]
+    corpus = []
+    for i in range(n):
+        year = r.randint(1400, 2020)
+        shape = r.random()
+        if shape < 0.6:
+            corpus.append('{}'.format(year))
+        elif shape < 0.8:
+            corpus.append('{}-{:02d}-{:02d}'.format(year, r.randint(1, 12), r.randint(1, 28)))
+        elif shape < 0.9:
+            corpus.append('{}-{:02d}-{:02d}T{:02d}:{:02d}:00Z'.format(year, r.randint(1, 12), r.randint(1, 28), r.randint(0, 23), r.randint(0, 59)))
+        else:
+            corpus.append(r.choice(dirty))
+    return corpus
+
+
+def bench(name, corpus, repeat=3):
+    seconds = min(timeit.repeat(lambda: [DateCleanerAndFaceter(d).decades() for d in corpus], number=1, repeat=repeat))
+    print('{:<24} {:>8} dates {:>10.3f} s {:>12.0f} dates/s'.format(name, len(corpus), seconds, len(corpus) / seconds))
+
+
+if __name__ == '__main__':
+    bench('test corpus (x100)', [d for d, decades in DATES] * 100)
+    bench('synthetic corpus', syntheticCorpus(100000))
@@ -1,10 +1,21 @@
 import unittest
 import sys
 import functools
+import gzip
+import http.server
 import pdb
 import traceback
 import logging
-from resourcesync_oai_pmh.destination.util import DateCleanerAndFaceter, HyperlinkRelevanceHeuristicSorter
+import csv
+import io
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+from resourcesync_oai_pmh.destination.util import CircuitBreaker, CollectionScheduler, DateCleanerAndFaceter, FileLayout, HostHealth, HyperlinkRelevanceHeuristicSorter, HyperlinkRelevanceScorer, LeaseKeeper, MetadataMapper, PackedRecordStore, PRRLATinyDB, ResyncAction, RetryQueue, SitemapFetcher, SolrCsvUpdateWriter, SolrDocument, SolrDocumentArchive, SolrJsonUpdateWriter, SolrWriter, SyncHistory, ThumbnailDeletionQueue, ThumbnailJobQueue, ThumbnailProbeStats, ThumbnailProcessor, ThumbnailRules, ThumbnailStore, UrlClassifier, WorkQueue, metadataMapper, planChanges, resyncActions
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -13,59 +24,98 @@ logging.basicConfig(
     )
 logger = logging.getLogger('root')
 
+# dirty dates found in metadata, and the decades they should be faceted under
+DATES = [
+    ('[186-?]', {1860}),
+    ('c1904', {1900}),
+    ('[1899?]', {1890}),
+    ('1900]', {1900}),
+    ('1903], c1895', {1890, 1900}),
+    ('1973-08', {1970}),
+    ('1956-09-07', {1950}),
+    ('ca 1904', {1900}),
+    ('500 BC', {-500}),
+    ('2013-01-01T08:00:00Z', {2010}),
+    ('1922-1927', {1920}),
+    ('1903?', {1900}),
+    ('2004/5', {2000}),
+    ('1959 1960', {1950, 1960}),
+    ('13-Mar-76', {1970}),
+    ('1972 1973 1974 1975 1976 Date notes: Digital photos created 2002. Pottery found 1972-1976', {1970, 2000}),
+    ('Feb-76', {1970}),
+    ('1300-1200 BC', set(range(-1300, -1200 + 1, 10))),
+    ('2nd C BC', {-200, -190, -180, -170, -160, -150, -140, -130, -120, -110}),
+    ('3rd C AD', {200, 210, 220, 230, 240, 250, 260, 270, 280, 290}),
+    ('1993-03 - 1993-05', {1990}),
+    ('4th C  AD', {300, 310, 320, 330, 340, 350, 360, 370, 380, 390}),
+    ('2800 BC [ca.]', {-2800}),
+    ('447-432 BC', {-450, -440}),
+    ('1965-1969?', {1960}),
+    ('1978-03/ 1978-10', {1970}),
+    ('c1963', {1960}),
+    ('pre 1993/4', {1990}),
+    ('07 Mar 1976. 7.30pm', {1970}),
+    ('1500 [ca.]', {1500}),
+    ('1970s', {1970}),
+    ('1851,  modified 1853-1854',{1850}),
+    ('c. 470-460 BC', {-470, -460}),
+    ('2550-2530 BC [ca.]', {-2550, -2540, -2530}),
+    ('c.1926', {1920}),
+    ('1980-03/1980-07', {1980}),
+    ('12 Mar 1976. 2.00am', {1970}),
+    ('1600-1040 BC', set(range(-1600, -1040 + 1, 10))),
+    ('1600-1046 BC', set(range(-1600, -1050 + 1, 10))),
+    ('1600 BC - 1046 BC', set(range(-1600, -1050 + 1, 10))),
+    ('1600 BC-1046 BC', set(range(-1600, -1050 + 1, 10))),
+    ('Notamonth 11 (1968)', {1960}),
+    ('Notamonth 46 (1968)', {1960}),
+    ('10-Oct-1999', {1990}),
+    ('199-', {1990}),
+    ('1976', {1970}),
+    ('2017-03-14T10:00:00.123+01:00', {2010}),
+    ('31-12-1976', {1970}),
+    ('25-12-1976', {1970}),
+    ('12-25-1976', {1970}),
+    ('12-1976', {1970}),
+    ('31-12-76', {1970}),
+    ('9-30-2001', {2000}),
+    ('ca. 12-1976', {1970}),
+    ('20010101', {2000}),
+    ('19760512', {1970}),
+    ('19761225T101010Z', {1970}),
+    ('19761225T1010', {1970}),
+    ('1976-123', set()),
+    ('1990-1980', {1980, 1990})
+    ]
+
 class TestUtil(unittest.TestCase):
 
     def test_DateCleanerAndFaceter(self):
-        dates = [
-            ('[186-?]', {1860}),
-            ('c1904', {1900}),
-            ('[1899?]', {1890}),
-            ('1900]', {1900}),
-            ('1903], c1895', {1890, 1900}),
-            ('1973-08', {1970}),
-            ('1956-09-07', {1950}),
-            ('ca 1904', {1900}),
-            ('500 BC', {-500}),
-            ('2013-01-01T08:00:00Z', {2010}),
-            ('1922-1927', {1920}),
-            ('1903?', {1900}),
-            ('2004/5', {2000}),
-            ('1959 1960', {1950, 1960}),
-            ('13-Mar-76', {1970}),
-            ('1972 1973 1974 1975 1976 Date notes: Digital photos created 2002. Pottery found 1972-1976', {1970, 2000}),
-            ('Feb-76', {1970}),
-            ('1300-1200 BC', set(range(-1300, -1200 + 1, 10))),
-            ('2nd C BC', {-200, -190, -180, -170, -160, -150, -140, -130, -120, -110}),
-            ('3rd C AD', {200, 210, 220, 230, 240, 250, 260, 270, 280, 290}),
-            ('1993-03 - 1993-05', {1990}),
-            ('4th C  AD', {300, 310, 320, 330, 340, 350, 360, 370, 380, 390}),
-            ('2800 BC [ca.]', {-2800}),
-            ('447-432 BC', {-450, -440}),
-            ('1965-1969?', {1960}),
-            ('1978-03/ 1978-10', {1970}),
-            ('c1963', {1960}),
-            ('pre 1993/4', {1990}),
-            ('07 Mar 1976. 7.30pm', {1970}),
-            ('1500 [ca.]', {1500}),
-            ('1970s', {1970}),
-            ('1851,  modified 1853-1854',{1850}),
-            ('c. 470-460 BC', {-470, -460}),
-            ('2550-2530 BC [ca.]', {-2550, -2540, -2530}),
-            ('c.1926', {1920}),
-            ('1980-03/1980-07', {1980}),
-            ('12 Mar 1976. 2.00am', {1970}),
-            ('1600-1040 BC', set(range(-1600, -1040 + 1, 10))),
-            ('1600-1046 BC', set(range(-1600, -1050 + 1, 10))),
-            ('1600 BC - 1046 BC', set(range(-1600, -1050 + 1, 10))),
-            ('1600 BC-1046 BC', set(range(-1600, -1050 + 1, 10))),
-            ('Notamonth 11 (1968)', {1960}),
-            ('Notamonth 46 (1968)', {1960})
-            ]
-
-        for i in range(0, len(dates)):
+        for i in range(0, len(DATES)):
             self.assertEqual(
-                DateCleanerAndFaceter(dates[i][0]).decades(),
-                dates[i][1])
+                DateCleanerAndFaceter(DATES[i][0]).decades(),
+                DATES[i][1])
+
+    def test_DateCleanerAndFaceter_intervals(self):
+        dcf = DateCleanerAndFaceter({'1922-1927', '1925', '1929', '447-432 BC'})
+        self.assertEqual(dcf.intervals(), [(-447, -432), (1922, 1927), (1929, 1929)])
+        self.assertEqual(dcf.intervals(disjoint=False), [(-447, 1929)])
+        self.assertEqual(dcf.years(), set(range(-447, -431)) | set(range(1922, 1928)) | {1929})
+        self.assertEqual(dcf.decades(), {-450, -440, 1920})
+        self.assertEqual(dcf.decades(disjoint=False), set(range(-450, 1921, 10)))
+
+        self.assertEqual(DateCleanerAndFaceter('1956-09-07').years(), {1956})
+        self.assertEqual(DateCleanerAndFaceter('no date').intervals(disjoint=False), [])
+        self.assertEqual(DateCleanerAndFaceter.dateRangeValue((1922, 1927)), '[1922 TO 1927]')
+        self.assertEqual(DateCleanerAndFaceter.dateRangeValue((-500, -500)), '-0499')
+        self.assertEqual(DateCleanerAndFaceter.mergeIntervals([(1950, 1959), (1900, 1900), (1960, 1965), (1901, 1901)]), [(1900, 1901), (1950, 1965)])
+        self.assertEqual(
+            DateCleanerAndFaceter.decadeColumn([[(-447, -432), (1922, 1927)], [], [(2000, 2000)]]),
+            [{-450, -440, 1920}, set(), {2000}])
+
+        # the same decades as one value at a time
+        column = [DateCleanerAndFaceter(date).intervals() for date, decades in DATES]
+        self.assertEqual(DateCleanerAndFaceter.decadeColumn(column), [decades for date, decades in DATES])
 
     def test_HyperlinkRelevanceHeuristicSorter(self):
         links = [
@@ -98,5 +148,991 @@ class TestUtil(unittest.TestCase):
                 hrhs.mostRelevant(),
                 links[i][2])
 
+    def test_HyperlinkRelevanceScorer(self):
+        scorer = HyperlinkRelevanceScorer(
+            'repository.x.y.edu',
+            identifier=lambda identifier: identifier.split(':')[-1],
+            kinds=[UrlClassifier.LANDING_PAGE])
+        records = [
+            ('oai:x.y.edu:aaa-1000', [
+                'http://archives.x.y.edu/repositories/1/archival_objects/aaa-1000',
+                'http://repository.x.y.edu/img/aaa-1000.jpg',
+                'http://repository.x.y.edu/en/item/aaa-1000',
+                'http://repository.x.y.edu/en/item/aaa-1000',
+                'http://repository.x.y.edu/en/collection/all'
+                ]),
+            ('oai:x.y.edu:bbb-1000', ['not a url']),
+            ('oai:x.y.edu:ccc-1000', ['http://repository.x.y.edu/en/collection/all', 'http://archives.x.y.edu/ccc-1000'])
+            ]
+        self.assertEqual(scorer.rankMany(records), [
+            [
+                'http://repository.x.y.edu/en/item/aaa-1000',
+                'http://archives.x.y.edu/repositories/1/archival_objects/aaa-1000',
+                'http://repository.x.y.edu/en/collection/all'
+            ],
+            [],
+            # equal scores keep their order
+            ['http://repository.x.y.edu/en/collection/all', 'http://archives.x.y.edu/ccc-1000']
+            ])
+        self.assertEqual(scorer.rank(*records[0]), scorer.rankMany(records)[0])
+
+        # extra rules
+        scorer.rules.append((2, lambda classified, identifier, host: classified.path.startswith('/en/item/')))
+        self.assertEqual(scorer.rank('oai:x.y.edu:ddd-1000', ['http://archives.x.y.edu/ddd-1000', 'http://elsewhere.edu/en/item/1']), ['http://elsewhere.edu/en/item/1', 'http://archives.x.y.edu/ddd-1000'])
+
+    def test_UrlClassifier(self):
+        urls = [
+            ('http://repository.x.y.edu/en/item/aaa-1000', UrlClassifier.LANDING_PAGE, 'repository.x.y.edu'),
+            ('http://repository.x.y.edu/img/aaa-1000.JPG', UrlClassifier.IMAGE, 'repository.x.y.edu'),
+            ('https://images.x.y.edu/aaa-1000.tiff?size=full', UrlClassifier.IMAGE, 'images.x.y.edu'),
+            ('aaa-1000', UrlClassifier.INVALID, None),
+            (None, UrlClassifier.INVALID, None)
+            ]
+
+        classifier = UrlClassifier()
+        for url, kind, netloc in urls + urls:
+            classified = classifier.classify(url)
+            self.assertEqual(classified.kind, kind)
+            self.assertEqual(classified.netloc, netloc)
+
+        # the second pass is served from the cache
+        self.assertEqual(classifier.cacheInfo().hits, 4)
+
+    def test_ThumbnailRules(self):
+        rules = ThumbnailRules({
+            'templates': ['https://iiif.x.y.edu/{identifier}/full/200,/0/default.jpg'],
+            'patterns': [r'^https://images\.x\.y\.edu/thumb/'],
+            'image_extensions': ['.JP2'],
+            'non_image_hosts': ['archives.x.y.edu']
+            })
+
+        self.assertEqual(
+            rules.fromTemplates('aaa-1000', 'oai:x.y.edu:aaa-1000'),
+            ['https://iiif.x.y.edu/aaa-1000/full/200,/0/default.jpg'])
+        self.assertTrue(rules.judge('https://images.x.y.edu/thumb/aaa-1000'))
+        self.assertTrue(rules.judge('https://repository.x.y.edu/aaa-1000.jp2'))
+        self.assertFalse(rules.judge('http://archives.x.y.edu/repositories/1/archival_objects/aaa-1000'))
+        self.assertFalse(rules.judge('aaa-1000'))
+        self.assertIsNone(rules.judge('http://repository.x.y.edu/en/item/aaa-1000'))
+
+        # no rules means every URL needs to be checked
+        self.assertEqual(ThumbnailRules().fromTemplates('aaa-1000', 'oai:x.y.edu:aaa-1000'), [])
+        self.assertIsNone(ThumbnailRules(None).judge('http://repository.x.y.edu/en/item/aaa-1000'))
+
+    def test_ThumbnailProbeStats(self):
+        stats = ThumbnailProbeStats()
+        for i in range(10):
+            stats.record('http://archives.x.y.edu/objects/{}'.format(i), ThumbnailProbeStats.PROBE_MISS)
+            stats.record('http://images.x.y.edu/{}.png'.format(i), ThumbnailProbeStats.PROBE_HIT)
+        stats.record('http://repository.x.y.edu/item/1', ThumbnailProbeStats.PROBE_HIT)
+
+        summary = stats.summary()
+        self.assertEqual(len(summary), 3)
+        self.assertIn('"non_image_hosts": ["archives.x.y.edu"]', summary[0])
+        self.assertIn('"image_extensions": [".png"]', summary[1])
+        self.assertNotIn('suggested rule', summary[2])
+
+    @unittest.skipUnless(ThumbnailProcessor.available(), 'requires Pillow')
+    def test_ThumbnailProcessor(self):
+        from PIL import Image
+
+        def encode(image, format):
+            f = io.BytesIO()
+            image.save(f, format)
+            return f.getvalue()
+
+        # a gradient, so that the difference hash isn't trivial
+        image = Image.new('RGB', (1200, 600))
+        image.putdata([(x * 255 // 1200, 0, 0) for y in range(600) for x in range(1200)])
+        tiff = encode(image, 'TIFF')
+
+        processor = ThumbnailProcessor(maxWidth=400, maxHeight=400)
+        processed = processor.process(tiff)
+        self.assertEqual((processed.width, processed.height), (400, 200))
+        self.assertEqual((processed.extension, processed.content_type), ('.jpg', 'image/jpeg'))
+        self.assertLess(len(processed.data), len(tiff) // 10)
+        with Image.open(io.BytesIO(processed.data)) as result:
+            self.assertEqual((result.format, result.size), ('JPEG', (400, 200)))
+
+        # the same image gets the same hashes, however it was encoded
+        again = processor.process(encode(image, 'PNG'))
+        self.assertEqual(again.content_hash, processed.content_hash)
+        self.assertEqual(again.perceptual_hash, processed.perceptual_hash)
+        self.assertEqual(len(processed.perceptual_hash), 16)
+        mirrored = processor.process(encode(image.transpose(Image.FLIP_LEFT_RIGHT), 'PNG'))
+        self.assertNotEqual(mirrored.perceptual_hash, processed.perceptual_hash)
+
+        # small images aren't enlarged, and transparency is flattened
+        small = processor.process(encode(Image.new('RGBA', (50, 20), (0, 0, 0, 0)), 'PNG'))
+        self.assertEqual((small.width, small.height), (50, 20))
+        with Image.open(io.BytesIO(small.data)) as result:
+            self.assertEqual(result.getpixel((0, 0)), (255, 255, 255))
+
+        self.assertRaises(Exception, processor.process, b'not an image')
+        self.assertRaises(ValueError, ThumbnailProcessor, format='GIF')
+
+    def test_ThumbnailStore(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'thumbnails.json')
+            store = ThumbnailStore(path)
+            placeholder = ThumbnailStore.objectKey(ThumbnailStore.contentHash(b'placeholder'), '.jpg')
+            photo = ThumbnailStore.objectKey(ThumbnailStore.contentHash(b'photo'), '.jpg')
+            self.assertRegex(placeholder, '^[0-9a-f]{64}\\.jpg$')
+
+            # records of two collections share a placeholder
+            store.assign('a', placeholder, 'x.y.edu', 'aaa')
+            store.assign('b', placeholder, 'x.y.edu', 'aaa')
+            store.assign('c', placeholder, 'x.y.edu', 'bbb')
+            store.assign('c', placeholder, 'x.y.edu', 'bbb')
+            self.assertEqual(len(store), 1)
+            self.assertEqual(store.references(placeholder), 3)
+            self.assertEqual(sorted(store.recordsOf('x.y.edu', 'aaa')), ['a', 'b'])
+
+            # a record gets a thumbnail of its own
+            store.assign('a', photo, 'x.y.edu', 'aaa')
+            self.assertEqual(store.get('a'), photo)
+            self.assertEqual(store.references(placeholder), 2)
+
+            store.release('b')
+            store.release('unknown')
+            self.assertEqual(store.sweep(), [])
+            store.save()
+
+            # the index is persisted
+            store = ThumbnailStore(path)
+            self.assertEqual(store.get('c'), placeholder)
+            self.assertIsNone(store.get('b'))
+
+            # objects are only swept once no record refers to them, and can be referred to again until then
+            store.release('c')
+            store.release('a')
+            self.assertTrue(store.has(placeholder))
+            store.assign('d', photo, 'x.y.edu', 'bbb')
+            self.assertEqual(store.sweep(), [placeholder])
+            self.assertFalse(store.has(placeholder))
+            self.assertEqual(store.references(photo), 1)
+            self.assertEqual(store.sweep(), [])
+
+    def test_FileLayout(self):
+        with tempfile.TemporaryDirectory() as d:
+            names = ['?verb=GetRecord&identifier=oai:x.y.edu:aaa-{}'.format(i) for i in range(50)] + ['sub/dir/file.xml']
+            flat = FileLayout(d)
+            sharded = FileLayout(d, 'sharded', depth=2)
+            for name in names:
+                os.makedirs(os.path.dirname(flat.path(name)), exist_ok=True)
+                with open(flat.path(name), 'w') as f:
+                    f.write(name)
+
+            name = names[0]
+            path = sharded.path(name)
+            self.assertEqual(os.path.relpath(path, d).split(os.sep)[:2], [FileLayout.hash(name)[:2], FileLayout.hash(name)[2:4]])
+            self.assertEqual(sharded.name(path), name)
+            self.assertEqual(sharded.name(flat.path(name)), name)
+            self.assertEqual(sharded.name(sharded.path('sub/dir/file.xml')), 'sub/dir/file.xml')
+            self.assertEqual(flat.locate(flat.path(name)), flat.path(name))
+            self.assertEqual(sharded.locate(flat.path(name)), flat.path(name))
+
+            self.assertEqual(sharded.migrate(), len(names))
+            self.assertEqual(sharded.migrate(), 0)
+            self.assertEqual(sorted(os.listdir(d)), sorted({FileLayout.hash(name)[:2] for name in names}))
+            self.assertEqual(sharded.locate(flat.path(name)), path)
+            for path in sharded.files():
+                with open(path) as f:
+                    self.assertEqual(f.read(), sharded.name(path))
+
+            # back again, leaving no empty directories behind
+            self.assertEqual(flat.migrate(), len(names))
+            self.assertEqual(sorted(flat.files()), sorted(flat.path(name) for name in names))
+            self.assertEqual(sorted(os.listdir(d)), sorted([name for name in names if '/' not in name] + ['sub']))
+
+            # linking leaves the file where it is too
+            self.assertEqual(sharded.place(flat.path(name), link=True), sharded.path(name))
+            self.assertTrue(os.path.samefile(flat.path(name), sharded.path(name)))
+            self.assertEqual(sharded.place(flat.path(name), link=True), sharded.path(name))
+            os.remove(sharded.path(name))
+
+            with self.assertRaises(ValueError):
+                FileLayout(d, 'nested')
+
+    def test_PackedRecordStore(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'aaa.pack')
+            pack = PackedRecordStore(path)
+            for i in range(100):
+                pack.put('?identifier=oai:x.y.edu:aaa-{}'.format(i), '<record>{}</record>'.format(i).encode() * 10)
+            self.assertEqual(pack.get('?identifier=oai:x.y.edu:aaa-7'), b'<record>7</record>' * 10)
+            pack.put('?identifier=oai:x.y.edu:aaa-7', b'<record>updated</record>')
+            self.assertTrue(pack.delete('?identifier=oai:x.y.edu:aaa-8'))
+            self.assertFalse(pack.delete('?identifier=oai:x.y.edu:aaa-8'))
+            self.assertIsNone(pack.get('?identifier=oai:x.y.edu:aaa-8'))
+            self.assertEqual(len(pack), 99)
+            self.assertGreater(pack.garbageRatio(), 0)
+            pack.close()
+
+            # the saved index is caught up on with the entries after it, and a partial entry at the end is cut off
+            pack = PackedRecordStore(path)
+            pack.put('?identifier=oai:x.y.edu:aaa-100', b'<record>100</record>')
+            pack.file.flush()
+            with open(path, 'ab') as f:
+                f.write(PackedRecordStore.header.pack(PackedRecordStore.RECORD, 3, 100, 0) + b'abc')
+            pack = PackedRecordStore(path)
+            self.assertEqual(len(pack), 100)
+            self.assertEqual(pack.get('?identifier=oai:x.y.edu:aaa-100'), b'<record>100</record>')
+            self.assertEqual(pack.get('?identifier=oai:x.y.edu:aaa-7'), b'<record>updated</record>')
+            keys = [key for key, data in pack.items()]
+            self.assertEqual(keys[-2:], ['?identifier=oai:x.y.edu:aaa-7', '?identifier=oai:x.y.edu:aaa-100'])
+
+            size = pack.size()
+            self.assertGreater(pack.compact(), 0)
+            self.assertLess(pack.size(), size)
+            self.assertEqual(pack.garbageRatio(), 0)
+            self.assertEqual([key for key, data in pack.items()], keys)
+            pack.close()
+
+            # without the index, every entry is read
+            os.remove(path + '.idx')
+            pack = PackedRecordStore(path)
+            self.assertEqual(dict(pack.items())['?identifier=oai:x.y.edu:aaa-0'], b'<record>0</record>' * 10)
+            pack.close()
+
+    def test_ThumbnailDeletionQueue(self):
+        class FakeS3:
+            def __init__(self):
+                self.requests = []
+
+            def delete_objects(self, Bucket, Delete):
+                self.requests.append([o['Key'] for o in Delete['Objects']])
+                return {}
+
+        s3 = FakeS3()
+        with tempfile.TemporaryDirectory() as d:
+            for name in ['oai%3Ax.y.edu%3A0.jpg', 'oai%3Ax.y.edu%3A01.jpg']:
+                open(os.path.join(d, name), 'w').close()
+
+            q = ThumbnailDeletionQueue(s3, 'bucket', batchSize=1000, flushInterval=60)
+            keys = ['oai%3Ax.y.edu%3A{}'.format(i) for i in range(2500)]
+            for key in keys:
+                q.delete(key, d)
+            q.close()
+
+            # only the thumbnail of the first record is deleted locally
+            self.assertEqual(os.listdir(d), ['oai%3Ax.y.edu%3A01.jpg'])
+
+        self.assertEqual([len(r) for r in s3.requests], [1000, 1000, 500])
+        self.assertEqual(sum(s3.requests, []), keys)
+        self.assertEqual(q.deleted, 2500)
+
+    def test_MetadataMapper(self):
+        def record(metadata, status=''):
+            return io.BytesIO('''<?xml version="1.0" encoding="UTF-8"?>
+                <OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+                  <GetRecord><record>
+                    <header{}><identifier>oai:x.y.edu:aaa/1</identifier></header>
+                    <metadata>{}</metadata>
+                  </record></GetRecord>
+                </OAI-PMH>'''.format(status, metadata).encode())
+
+        dc = record('''
+            <oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/">
+              <dc:title>First</dc:title>
+              <dc:title>Second</dc:title>
+              <dc:date>1965-1972</dc:date>
+              <dc:description/>
+              <dc:identifier>http://x.y.edu/items/1</dc:identifier>
+              <dc:identifier.thumbnail>http://x.y.edu/thumbs/1.png</dc:identifier.thumbnail>
+              <dc:identifier.other>http://x.y.edu/other/1</dc:identifier.other>
+            </oai_dc:dc>''')
+        mapped = metadataMapper('oai_dc').map(dc)
+        self.assertEqual(mapped.identifier, 'oai:x.y.edu:aaa/1')
+        self.assertEqual(mapped.fields, {
+            'title_keyword': ['First', 'Second'],
+            'date_keyword': ['1965-1972'],
+            'identifier_keyword': ['http://x.y.edu/items/1']
+            })
+        self.assertEqual(mapped.thumbnails, ['http://x.y.edu/thumbs/1.png', 'http://x.y.edu/items/1', 'http://x.y.edu/other/1'])
+        self.assertEqual(mapped.links, ['http://x.y.edu/items/1'])
+
+        mods = record('''
+            <mods xmlns="http://www.loc.gov/mods/v3">
+              <titleInfo><title>A map</title></titleInfo>
+              <relatedItem><titleInfo><title>An atlas</title></titleInfo></relatedItem>
+              <name><namePart>Someone</namePart><role><roleTerm>creator</roleTerm></role></name>
+              <originInfo><dateIssued>1880</dateIssued></originInfo>
+              <subject><geographic>Los Angeles</geographic></subject>
+              <location>
+                <url access="object in context">http://x.y.edu/items/1</url>
+                <url access="preview">http://x.y.edu/thumbs/1.jpg</url>
+              </location>
+            </mods>''')
+        mapped = metadataMapper('mods').map(mods)
+        self.assertEqual(mapped.fields['title_keyword'], ['A map'])
+        self.assertEqual(mapped.fields['relation_keyword'], ['An atlas'])
+        self.assertEqual(mapped.fields['creator_keyword'], ['Someone'])
+        self.assertEqual(mapped.fields['date_keyword'], ['1880'])
+        self.assertEqual(mapped.fields['coverage_keyword'], ['Los Angeles'])
+        self.assertEqual(mapped.thumbnails, ['http://x.y.edu/thumbs/1.jpg', 'http://x.y.edu/items/1'])
+        self.assertEqual(mapped.links, ['http://x.y.edu/items/1', 'http://x.y.edu/thumbs/1.jpg'])
+
+        # deleted, unreadable, and empty records
+        self.assertIsNone(metadataMapper('oai_dc').map(record('', ' status="deleted"')))
+        self.assertIsNone(metadataMapper('oai_dc').map(io.BytesIO(b'<OAI-PMH><GetRecord>')))
+        self.assertIsNone(metadataMapper('mods').map(io.BytesIO(b'<OAI-PMH/>')))
+
+        # custom formats
+        mapper = MetadataMapper('custom', [{'path': 'r/*/t', 'field': 'title_keyword'}])
+        self.assertEqual(mapper.map(record('<r><a><t>1</t></a><b><t>2</t></b><t>3</t></r>')).fields, {'title_keyword': ['1', '2']})
+        self.assertRaises(ValueError, MetadataMapper, 'custom', [{'path': 'r', 'feild': 'title_keyword'}])
+        self.assertRaises(ValueError, metadataMapper, 'unknown')
+
+    def test_SolrDocument(self):
+        doc = SolrDocument(id='oai:x.y.edu:aaa-1000', collectionKey='aaa')
+        doc.add('title_keyword', 'First')
+        doc.add('title_keyword', 'Second')
+        doc.add('subject_keyword', 'Only')
+        doc.first_title = 'First'
+
+        self.assertEqual(doc.get('first_title'), 'First')
+        self.assertIsNone(doc.get('thumbnail_url'))
+        self.assertEqual(
+            doc.toSolr(),
+            {
+                'id': 'oai:x.y.edu:aaa-1000',
+                'collectionKey': 'aaa',
+                'first_title': 'First',
+                'title_keyword': ['First', 'Second'],
+                'subject_keyword': 'Only'
+            })
+
+        with self.assertRaises(AttributeError):
+            doc.add('not_a_field', 'value')
+        with self.assertRaises(AttributeError):
+            doc.__dict__
+
+    def test_SolrUpdateWriters(self):
+        docs = [
+            {'id': 'a', 'title_keyword': 'A', 'decade': [1960, 1970]},
+            {'id': 'b', 'title_keyword': ['B', 'Bee']}
+        ]
+
+        with tempfile.TemporaryDirectory() as d:
+            writer = SolrJsonUpdateWriter(os.path.join(d, 'docs.json'))
+            writer.write(docs[:1])
+            writer.write(docs[1:])
+            writer.close()
+            with open(writer.path) as f:
+                self.assertEqual(json.load(f), docs)
+
+            writer = SolrCsvUpdateWriter(os.path.join(d, 'docs.csv'), ['id', 'title_keyword', 'decade'])
+            writer.write(docs)
+            writer.close()
+            with open(writer.path, newline='') as f:
+                self.assertEqual(
+                    list(csv.reader(f)),
+                    [['id', 'title_keyword', 'decade'], ['a', 'A', '1960|1970'], ['b', 'B|Bee', '']])
+            self.assertIn('f.decade.split=true', writer.updateParams())
+            self.assertIn('f.title_keyword.split=true', writer.updateParams())
+
+            # separators within values are escaped, whether or not the values are in lists
+            writer = SolrCsvUpdateWriter(os.path.join(d, 'docs.csv'), ['id', 'title_keyword', 'decade'], multiValuedFields=['title_keyword', 'decade'])
+            writer.write([{'id': 'a|b', 'title_keyword': 'A | B', 'decade': [1960]}, {'id': 'c', 'title_keyword': ['C|D', 'E\\F']}])
+            writer.close()
+            with open(writer.path, newline='') as f:
+                self.assertEqual(
+                    list(csv.reader(f))[1:],
+                    [['a|b', 'A \\| B', '1960'], ['c', 'C\\|D|E\\\\F', '']])
+            self.assertIn('f.title_keyword.escape=%5C', writer.updateParams())
+            self.assertNotIn('f.id.split', writer.updateParams())
+
+    def test_resyncActions(self):
+        lines = [
+            b'Status: NOT IN SYNC\n',
+            b'created: https://x.y.edu/oai?verb=GetRecord&metadataPrefix=oai_dc&identifier=oai:x.y.edu:aaa-1 -> /data/x.y.edu/aaa/1.xml\n',
+            b'updated: https://x.y.edu/oai?identifier=oai:x.y.edu:aaa-2 -> /data/x.y.edu/aaa/a file.xml -> ignored\r\n',
+            b'deleted: https://x.y.edu/oai?identifier=oai:x.y.edu:aaa-3 -> /data/x.y.edu/aaa/3.xml',
+            b'Completed incremental sync\n'
+            ]
+        self.assertEqual(list(resyncActions(lines)), [
+            ResyncAction('created', 'https://x.y.edu/oai?verb=GetRecord&metadataPrefix=oai_dc&identifier=oai:x.y.edu:aaa-1', '/data/x.y.edu/aaa/1.xml'),
+            ResyncAction('updated', 'https://x.y.edu/oai?identifier=oai:x.y.edu:aaa-2', '/data/x.y.edu/aaa/a file.xml'),
+            ResyncAction('deleted', 'https://x.y.edu/oai?identifier=oai:x.y.edu:aaa-3', '/data/x.y.edu/aaa/3.xml')
+            ])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'ru_maxrss is in kilobytes on Linux')
+    def test_resyncActions_memory(self):
+        # peak RSS of a process that streams the actions of a resync run from a pipe, which shouldn't depend on the number of actions
+        script = '\n'.join([
+            'import resource, subprocess, sys',
+            'from resourcesync_oai_pmh.destination.util import resyncActions',
+            'line = "created: https://x.y.edu/oai?verb=GetRecord&metadataPrefix=oai_dc&identifier=oai:x.y.edu:aaa-{0} -> /data/x.y.edu/aaa/{0}.xml"',
+            'resync = subprocess.Popen([sys.executable, "-c", "for i in range({}): print({!r}.format(i))".format(sys.argv[1], line)], stdout=subprocess.PIPE)',
+            'n = sum(1 for action in resyncActions(resync.stdout))',
+            'resync.wait()',
+            'print(n, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'
+            ])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        def peakRss(n):
+            output = subprocess.check_output([sys.executable, '-c', script, str(n)], cwd=root, env=dict(os.environ, PYTHONPATH=root))
+            count, rss = map(int, output.split())
+            self.assertEqual(count, n)
+            return rss
+
+        # holding every line of the larger run (over 40 MB) would add far more than this
+        self.assertLess(peakRss(300000) - peakRss(1000), 16 * 1024)
+
+    def test_SolrWriter(self):
+        requests = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                requests.append((self.path, json.loads(body.decode('utf-8'))))
+                # slow down the first requests, so that later ones would overtake them if they weren't ordered
+                time.sleep(0.05 if len(requests) < 4 else 0)
+                status = 400 if b'bad' in body else 200
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            writer = SolrWriter('http://127.0.0.1:{}/solr/test/'.format(server.server_port), streams=4, compress=True, commitWithin=5000, softCommit=True)
+            self.assertEqual(writer.stream('aaa'), writer.stream('aaa'))
+
+            # updates to the same document are sent in order, even when they're submitted from different threads
+            for version in range(5):
+                writer.submit('aaa', writer.send, 'add', {'docs': [{'id': 'aaa', 'version': version}]})
+            writer.add([{'id': 'aaa', 'title': 'A'}, {'id': 'bbb', 'title': 'B'}], fieldUpdates={'title': 'set'})
+            writer.delete(id='bbb')
+            writer.delete(q='collectionKey:"x"')
+            writer.commit()
+            with self.assertRaises(Exception):
+                writer.add([{'id': 'bad'}])
+            writer.close()
+
+            messages = [message for path, message in requests]
+            versions = [message[0]['version'] for message in messages if isinstance(message, list) and len(message) == 1 and 'version' in message[0]]
+            self.assertEqual(versions, [0, 1, 2, 3, 4])
+            docs = [doc for message in messages if isinstance(message, list) for doc in message]
+            self.assertIn({'id': 'aaa', 'title': {'set': 'A'}}, docs)
+            self.assertIn({'id': 'bbb', 'title': {'set': 'B'}}, docs)
+            self.assertLess(messages.index({'delete': 'bbb'}), messages.index({'delete': {'query': 'collectionKey:"x"'}}))
+            self.assertTrue(all(path.startswith('/solr/test/update?') and 'commitWithin=5000' in path for path, message in requests if message != []))
+            self.assertIn('softCommit=true', requests[messages.index([])][0])
+
+            # buffered updates are sent in batches, keeping the order of the updates to each document
+            del requests[:]
+            now = [0.0]
+            results = {}
+            breaker = CircuitBreaker(failureThreshold=1, resetTimeout=None)
+            writer = SolrWriter('http://127.0.0.1:{}/solr/test'.format(server.server_port), streams=2, batchSize=4, batchDelay=10, breaker=breaker, clock=lambda: now[0])
+            done = lambda id: lambda error: results.setdefault(id, []).append(error)
+            for i in range(10):
+                writer.buffer('add', 'd{}'.format(i), {'docs': [{'id': 'd{}'.format(i), 'version': 1}]}, done('d{}'.format(i)))
+            writer.buffer('delete', 'd1', {'id': 'd1'}, done('d1'))
+            writer.buffer('add', 'd1', {'docs': [{'id': 'd1', 'version': 2}]}, done('d1'))
+            writer.flush()
+            self.assertLess(len(requests), 12)
+            self.assertEqual({id: errors for id, errors in results.items() if id != 'd1'}, {'d{}'.format(i): [None] for i in range(10) if i != 1})
+            self.assertEqual(results['d1'], [None, None, None])
+            d1 = [message for path, message in requests if message == {'delete': ['d1']} or isinstance(message, list) and ({'id': 'd1', 'version': 1} in message or {'id': 'd1', 'version': 2} in message)]
+            self.assertEqual(len(d1), 3)
+            self.assertIn({'id': 'd1', 'version': 2}, d1[2])
+
+            # a stream that has had updates buffered for longer than batchDelay sends them
+            results.clear()
+            writer.buffer('add', 'e', {'docs': [{'id': 'e'}]}, done('e'))
+            now[0] += 11
+            other = next(id for id in 'fghij' if writer.stream(id) != writer.stream('e'))
+            writer.buffer('add', other, {'docs': [{'id': other}]}, done(other))
+            writer.streams[writer.stream('e')].submit(lambda: None).result()
+            self.assertEqual(results['e'], [None])
+
+            # failures are passed to the callbacks, and nothing is sent while the breaker is open
+            results.clear()
+            writer.buffer('add', 'bad', {'docs': [{'id': 'bad'}]}, done('bad'))
+            writer.flush()
+            self.assertIsInstance(results['bad'][0], Exception)
+            count = len(requests)
+            writer.buffer('add', 'g', {'docs': [{'id': 'g'}]}, done('g'))
+            writer.close()
+            self.assertEqual(results['g'], ['circuit breaker open'])
+            self.assertEqual(len(requests), count)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_purge(self):
+        # destination.py sets itself up from its config when it's imported, so it's run in a process of its own, with its home, AWS config, and Solr in a temporary directory
+        queries = []
+        posts = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                q = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)['q'][0]
+                queries.append(q)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({'response': {'numFound': 3 if 'hi' in q else 0, 'docs': []}}).encode())
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                posts.append((self.path, body))
+                # deleting the documents of the first collection fails
+                self.send_response(500 if b'hi' in body else 200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        script = '\n'.join([
+            'import json, os, sys',
+            'sys.argv = ["destination.py"]',
+            'import destination as D',
+            'from tinydb import TinyDB',
+            'home, url = os.environ["HOME"], os.environ["SOLR_URL"]',
+            'D.config["Solr"]["url"] = url',
+            'rows = [dict(institution_key="x.y.edu", institution_name="X", collection_key=key, collection_name=key, file_path_map_to=os.path.join(home, "records")) for key in [\'say "hi": c/1\', "a\\\\b"]]',
+            'db = TinyDB(os.path.join(home, "db.json"))',
+            'for row in rows:',
+            '    db.insert(row)',
+            'os.makedirs(os.path.join(D.collectionDir(rows[0]), "1"))',
+            'for name in ["a.xml", "b.xml", "1/c.xml"]:',
+            '    open(os.path.join(D.collectionDir(rows[0]), name), "w").close()',
+            'os.makedirs(D.thumbnailDir(rows[0]))',
+            'open(os.path.join(D.thumbnailDir(rows[0]), "oai%3Ax.y.edu%3A9.jpg"), "w").close()',
+            'D.thumbnailStore.assign("oai:x.y.edu:1", "1.jpg", "x.y.edu", rows[0]["collection_key"])',
+            'D.thumbnailStore.assign("oai:x.y.edu:2", "2.jpg", "x.y.edu", rows[0]["collection_key"])',
+            'D.thumbnailStore.assign("oai:x.y.edu:3", "2.jpg", "x.y.edu", rows[1]["collection_key"])',
+            'D.thumbnailStore.assign("oai:x.y.edu:4", "4.jpg", "x.y.edu", rows[1]["collection_key"])',
+            'print(json.dumps([D.collectionQuery(row) for row in rows]))',
+            'D.purge(db, rows, dryRun=True)',
+            'print(json.dumps([len(db), D.countFiles(D.collectionDir(rows[0])), sum(len(D.thumbnailStore.recordsOf("x.y.edu", row["collection_key"])) for row in rows)]))',
+            'class FakeS3:',
+            '    def delete_objects(self, Bucket, Delete):',
+            '        raise Exception("S3 is down")',
+            'D.s3 = FakeS3()',
+            'D.config["Solr"]["url"] = url + "-purge"',
+            'D.purge(db, rows)',
+            'print(json.dumps([[row["collection_key"] for row in db.all()], D.countFiles(D.collectionDir(rows[0])), os.path.isdir(D.thumbnailDir(rows[0])), [entry["payload"] for entry in D.getRetryQueue().take("s3")]]))'
+            ])
+        directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resourcesync_oai_pmh', 'destination')
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                with open(os.path.join(d, 'aws_config'), 'w') as f:
+                    f.write('[profile my-aws-profile-name]\nregion = us-east-1\n')
+                env = dict(os.environ, PYTHONPATH=directory, HOME=d, AWS_CONFIG_FILE=os.path.join(d, 'aws_config'), SOLR_URL='http://127.0.0.1:{}/solr/test'.format(server.server_port))
+                output = subprocess.check_output([sys.executable, '-c', script], cwd=d, env=env).decode().splitlines()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        # the results that the script prints, among the log messages
+        results = [json.loads(line) for line in output if line.startswith('[')]
+
+        # quotes and backslashes in keys are escaped, and colons are left alone inside the phrases
+        self.assertEqual(results[0], [
+            'institutionKey:"x.y.edu" AND collectionKey:"say \\"hi\\": c/1"',
+            'institutionKey:"x.y.edu" AND collectionKey:"a\\\\b"'])
+        self.assertEqual(queries, results[0] * 2)
+
+        # thumbnails that are shared with another collection aren't counted
+        report = [line.split(' | ')[-1] for line in output if 'Would purge' in line]
+        self.assertEqual(report, [
+            'Would purge X: say "hi": c/1: 3 Solr documents, 3 record files, 2 thumbnails',
+            'Would purge X: a\\b: 0 Solr documents, 0 record files, 1 thumbnails'])
+
+        # and nothing is removed
+        self.assertEqual(results[1], [2, 3, 4])
+        self.assertEqual([path for path, body in posts if path.startswith('/solr/test/')], [])
+
+        # a collection whose Solr documents couldn't be deleted is kept, so that it can be purged again, and thumbnails that couldn't be deleted from S3 are queued to be tried again
+        self.assertEqual(results[2], [['say "hi": c/1'], 3, True, [{'keys': ['4.jpg']}]])
+
+    @unittest.skipUnless(SolrDocumentArchive.available(), 'requires pyarrow')
+    def test_SolrDocumentArchive(self):
+        import pyarrow.parquet
+
+        with tempfile.TemporaryDirectory() as d:
+            archive = SolrDocumentArchive(d, runId='1')
+            archive.add([
+                {'id': 'a', 'institutionKey': 'x.y.edu', 'collectionKey': 'c/1', 'title_keyword': 'A', 'decade': [1960, 1970]},
+                {'id': 'b', 'institutionKey': 'x.y.edu', 'collectionKey': 'c/1', 'title_keyword': ['B', 'Bee']},
+                {'id': 'c', 'institutionKey': 'x.y.edu', 'collectionKey': 'c2'}
+            ])
+            archive.update('x.y.edu', 'c/1', [{'id': 'a', 'thumbnail_url': 'https://s3/a.jpg'}])
+            archive.close()
+
+            # a later run deletes a document and adds it again, and deletes another
+            archive = SolrDocumentArchive(d, runId='2', rowGroupSize=1)
+            archive.delete('x.y.edu', 'c/1', ['a', 'b'])
+            archive.add([{'id': 'a', 'institutionKey': 'x.y.edu', 'collectionKey': 'c/1', 'title_keyword': 'A2'}])
+            archive.close()
+
+            self.assertEqual(archive.partitions(), [('x.y.edu', 'c/1'), ('x.y.edu', 'c2')])
+            self.assertEqual(
+                list(archive.documents('x.y.edu', 'c/1')),
+                [{'id': 'a', 'institutionKey': 'x.y.edu', 'collectionKey': 'c/1', 'title_keyword': ['A2']}])
+            self.assertEqual(
+                list(SolrDocumentArchive(d).documents('x.y.edu', 'c2')),
+                [{'id': 'c', 'institutionKey': 'x.y.edu', 'collectionKey': 'c2'}])
+            self.assertEqual(list(archive.documents('x.y.edu', 'none')), [])
+
+            archive = SolrDocumentArchive(d, runId='3')
+            archive.update('x.y.edu', 'c/1', [{'id': 'a', 'collectionName': 'Renamed'}])
+            archive.close()
+            self.assertEqual(next(archive.documents('x.y.edu', 'c/1'))['collectionName'], 'Renamed')
+
+            # the runs are merged by ID, whatever order the documents were written in, with the rows of each document replayed in order
+            archive = SolrDocumentArchive(d, runId='4', rowGroupSize=3)
+            archive.add([{'id': 'd{}'.format(i), 'institutionKey': 'x.y.edu', 'collectionKey': 'c3', 'title_keyword': 'D'} for i in reversed(range(10))])
+            archive.delete('x.y.edu', 'c3', ['d3', 'd5'])
+            archive.update('x.y.edu', 'c3', [{'id': 'd5', 'title_keyword': ['E']}, {'id': 'd7', 'title_keyword': ['F']}])
+            archive.add([{'id': 'd5', 'institutionKey': 'x.y.edu', 'collectionKey': 'c3', 'title_keyword': 'G'}])
+            archive.close()
+            docs = list(archive.documents('x.y.edu', 'c3', batchSize=2))
+            self.assertEqual([doc['id'] for doc in docs], ['d0', 'd1', 'd2', 'd4', 'd5', 'd6', 'd7', 'd8', 'd9'])
+            self.assertEqual({doc['id']: doc['title_keyword'] for doc in docs if doc['title_keyword'] != ['D']}, {'d5': ['G'], 'd7': ['F']})
+
+            # files written before they were sorted are still read
+            path = os.path.join(archive.partitionDir('x.y.edu', 'c3'), '5.parquet')
+            rows = [dict({field: None for field in archive.schema.names}, id=id, _action=action, _run='5') for id, action in [('d9', 'delete'), ('d0', 'delete'), ('d9', 'add')]]
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows, schema=archive.schema.remove_metadata()), path)
+            self.assertEqual([doc['id'] for doc in archive.documents('x.y.edu', 'c3')], ['d1', 'd2', 'd4', 'd5', 'd6', 'd7', 'd8', 'd9'])
+
+    def test_PRRLATinyDB_rename(self):
+        with tempfile.TemporaryDirectory() as d:
+            db = PRRLATinyDB(os.path.join(d, 'db.json'))
+            args = ['x.y.edu', 'X', 'aaa', 'Collection A', 'http://x.y.edu/rl.xml', 'http://x.y.edu/cl.xml', 'http://x.y.edu/']
+            db._PRRLATinyDB__insert_or_update(*args)
+            db._PRRLATinyDB__insert_or_update('x.y.edu', 'X', 'bbb', 'Collection B', *args[4:])
+
+            # same names
+            db._PRRLATinyDB__insert_or_update(*args, overwrite=True)
+            self.assertNotIn('solr_metadata_stale', db.db.all()[0])
+
+            # renamed collection
+            args[3] = 'Collection A (renamed)'
+            db._PRRLATinyDB__insert_or_update(*args, overwrite=True)
+            rows = db.db.all()
+            self.assertEqual(rows[0]['collection_name'], 'Collection A (renamed)')
+            self.assertTrue(rows[0]['solr_metadata_stale'])
+            self.assertEqual(rows[1]['collection_name'], 'Collection B')
+            self.assertNotIn('solr_metadata_stale', rows[1])
+
+            # the metadata format is only changed when one is given
+            self.assertEqual(rows[0]['metadata_format'], 'oai_dc')
+            db._PRRLATinyDB__insert_or_update(*args, overwrite=True, metadata_format='mods')
+            db._PRRLATinyDB__insert_or_update(*args, overwrite=True)
+            self.assertEqual(db.db.all()[0]['metadata_format'], 'mods')
+            db._PRRLATinyDB__insert_or_update(*args, overwrite=True, metadata_format='oai_dc')
+            self.assertEqual(db.db.all()[0]['metadata_format'], 'oai_dc')
+
+    def test_CircuitBreaker(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failureThreshold=2, resetTimeout=10.0, clock=lambda: now[0])
+        self.assertTrue(breaker.allow())
+
+        # a success resets the count of consecutive failures
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+        # one trial request after the timeout, which opens the breaker again if it fails
+        now[0] = 10.0
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+        now[0] = 20.0
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_HostHealth(self):
+        health = HostHealth(failureThreshold=2, defaultTimeout=30.0, minTimeout=2.0, maxTimeout=60.0, multiplier=3.0, minSamples=10)
+
+        # the default timeout holds until enough responses have been seen
+        for i in range(9):
+            health.success('fast.edu', 0.5)
+        self.assertEqual(health.timeout('fast.edu'), 30.0)
+        health.success('fast.edu', 0.5)
+        self.assertEqual(health.timeout('fast.edu'), 2.0)
+
+        for i in range(99):
+            health.success('slow.edu', 1.0)
+        health.success('slow.edu', 100.0)
+        self.assertEqual(health.p99('slow.edu'), 1.0)
+        self.assertEqual(health.timeout('slow.edu'), 3.0)
+        health.success('slow.edu', 100.0)
+        self.assertEqual(health.timeout('slow.edu'), 60.0)
+
+        # a host that keeps failing is skipped for the rest of the run
+        health.failure('down.edu')
+        health.success('down.edu', 1.0)
+        health.failure('down.edu')
+        self.assertTrue(health.allow('down.edu'))
+        health.failure('down.edu')
+        self.assertFalse(health.allow('down.edu'))
+        self.assertFalse(health.allow('down.edu'))
+        self.assertTrue(health.allow('fast.edu'))
+        self.assertIn('down.edu: 1 responses, p99 unknown, timeout 30.0s, 2 requests skipped after 2 consecutive failures', health.summary())
+
+    def test_CollectionScheduler(self):
+        now = 100000.0
+        with tempfile.TemporaryDirectory() as d:
+            history = SyncHistory(os.path.join(d, 'history.json'), keep=3)
+            # a small collection synced an hour ago, a big one synced a minute ago, and one whose baseline was cut short
+            for started in (now - 7200, now - 3600):
+                history.record('x.y.edu', 'small', False, started, started + 5, 10, True)
+            history.record('x.y.edu', 'big', False, now - 1000, now - 60, 50000, True)
+            history.record('x.y.edu', 'new', True, now - 500, now - 400, 1000, False)
+            for started in range(4):
+                history.record('x.y.edu', 'pruned', False, started, started + 1, 1, True)
+            self.assertEqual([run['started'] for run in history.runs('x.y.edu', 'pruned')], [1, 2, 3])
+
+            rows = [
+                {'institution_key': 'x.y.edu', 'collection_key': 'new', 'new': True},
+                {'institution_key': 'x.y.edu', 'collection_key': 'big', 'new': False},
+                {'institution_key': 'x.y.edu', 'collection_key': 'small', 'new': False},
+                {'institution_key': 'x.y.edu', 'collection_key': 'unknown', 'new': False}
+                ]
+            scheduler = CollectionScheduler(history, baselineEstimate=3600, incrementalEstimate=60, maxStaleness=86400, clock=lambda: now)
+            self.assertEqual(scheduler.estimate(rows[1]), 940)
+            self.assertEqual(scheduler.estimate(rows[0]), 3600)
+            self.assertEqual(scheduler.staleness(rows[2]), 3595)
+            self.assertEqual(scheduler.staleness(rows[0]), 86400)
+            self.assertEqual([row['collection_key'] for row in scheduler.order(rows)], ['unknown', 'small', 'new', 'big'])
+
+            # only the latest runs count, however long an older one took
+            history = SyncHistory(os.path.join(d, 'history2.json'), keep=10)
+            for started, seconds in [(0, 10000), (20000, 10), (30000, 20)]:
+                history.record('x.y.edu', 'big', False, started, started + seconds, 100, True)
+            scheduler = CollectionScheduler(history, samples=2, clock=lambda: now)
+            self.assertEqual(scheduler.estimate(rows[1]), 20)
+
+    def test_SitemapFetcher(self):
+        documents = {
+            'http://x.y.edu/resourcelist-index.xml': b'''<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+                <sitemap><loc>http://x.y.edu/resourcelist_0000.xml</loc></sitemap>
+                <sitemap><loc>http://x.y.edu/resourcelist_0001.xml</loc></sitemap>
+            </sitemapindex>''',
+            'http://x.y.edu/resourcelist_0000.xml': b'''<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:rs="http://www.openarchives.org/rs/terms/">
+                <rs:md capability="resourcelist"/>
+                <url><loc>http://x.y.edu/a</loc><rs:md length="100"/></url>
+                <url><loc>http://x.y.edu/b</loc><rs:md length="200"/></url>
+            </urlset>''',
+            'http://x.y.edu/resourcelist_0001.xml': b'''<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:rs="http://www.openarchives.org/rs/terms/">
+                <url><loc>http://x.y.edu/c</loc></url>
+            </urlset>''',
+            'http://x.y.edu/changelist.xml': b'''<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:rs="http://www.openarchives.org/rs/terms/">
+                <url><loc>http://x.y.edu/a</loc><rs:md change="updated" datetime="2018-01-01T00:00:00Z" length="90"/></url>
+                <url><loc>http://x.y.edu/c</loc><rs:md change="updated" datetime="2018-02-01T00:00:00Z" length="10"/></url>
+                <url><loc>http://x.y.edu/d</loc><rs:md change="created" datetime="2018-02-01T00:00:00Z" length="30"/></url>
+                <url><loc>http://x.y.edu/d</loc><rs:md change="updated" datetime="2018-03-01T00:00:00Z" length="40"/></url>
+                <url><loc>http://x.y.edu/b</loc><rs:md change="deleted" datetime="2018-03-01T00:00:00Z"/></url>
+            </urlset>'''
+            }
+        requested = []
+
+        class Response:
+            def __init__(self, content):
+                self.content = content
+
+            def raise_for_status(self):
+                pass
+
+        def fetch(url, timeout=None):
+            requested.append(url)
+            return Response(documents[url])
+
+        fetcher = SitemapFetcher(workers=2, fetch=fetch)
+        resources = fetcher.entries('http://x.y.edu/resourcelist-index.xml')
+        self.assertEqual([(entry.loc, entry.length) for entry in resources], [('http://x.y.edu/a', 100), ('http://x.y.edu/b', 200), ('http://x.y.edu/c', None)])
+        changes = fetcher.entries('http://x.y.edu/changelist.xml')
+        self.assertEqual(len(changes), 5)
+
+        # documents are only fetched once
+        fetcher.entries('http://x.y.edu/resourcelist-index.xml')
+        self.assertEqual(sorted(requested), sorted(documents))
+        fetcher.close()
+
+        self.assertEqual(planChanges(resources), (3, 3, 0, 0, 300, 1))
+        # a resource that is created and then updated is still created
+        self.assertEqual(planChanges(resources, changes), (3, 1, 2, 1, 140, 0))
+        since = time.mktime((2018, 1, 15, 0, 0, 0, 0, 0, 0))
+        self.assertEqual(planChanges(resources, changes, since), (3, 1, 1, 1, 50, 0))
+
+    def test_WorkQueue(self):
+        now = [1000.0]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'work.sqlite')
+            queue = WorkQueue(path, maxAttempts=2, clock=lambda: now[0])
+            self.assertTrue(queue.enqueue('collection/x.y.edu/aaa', {'kind': 'collection'}))
+            self.assertTrue(queue.enqueue('collection/x.y.edu/bbb'))
+            self.assertFalse(queue.enqueue('collection/x.y.edu/aaa'))
+
+            # tasks are claimed in order, by one worker each, even through another connection
+            other = WorkQueue(path, maxAttempts=2, clock=lambda: now[0])
+            a = queue.claim('node-1', lease=60)
+            b = other.claim('node-2', lease=60)
+            self.assertEqual((a.key, a.payload, a.attempts), ('collection/x.y.edu/aaa', {'kind': 'collection'}, 1))
+            self.assertEqual(b.key, 'collection/x.y.edu/bbb')
+            self.assertIsNone(queue.claim('node-3'))
+            self.assertEqual(queue.counts(), {'waiting': 0, 'claimed': 2, 'dead': 0})
+
+            # a renewed lease keeps a task, and an expired one lets another worker claim it
+            now[0] += 50
+            self.assertTrue(queue.heartbeat(a, lease=60))
+            now[0] += 50
+            c = other.claim('node-3', lease=60)
+            self.assertEqual(c.key, 'collection/x.y.edu/bbb')
+            self.assertEqual(c.attempts, 2)
+            self.assertFalse(other.heartbeat(b))
+            self.assertFalse(other.complete(b))
+            self.assertTrue(queue.complete(a))
+
+            # released tasks wait, and are given up on after too many attempts
+            queue.release(c)
+            queue.enqueue('collection/x.y.edu/ccc')
+            d = queue.claim('node-1')
+            queue.release(d, delay=30)
+            self.assertIsNone(queue.claim('node-1'))
+            self.assertEqual(queue.counts(), {'waiting': 1, 'claimed': 0, 'dead': 1})
+            now[0] += 30
+            self.assertEqual(queue.claim('node-1').key, 'collection/x.y.edu/ccc')
+            self.assertEqual(len(queue), 2)
+            queue.close()
+            other.close()
+
+        queue = WorkQueue()
+        queue.enqueue('task')
+        task = queue.claim('node-1', lease=0.2)
+        with LeaseKeeper(queue, task, lease=0.2, interval=0.05) as keeper:
+            time.sleep(0.4)
+        self.assertFalse(keeper.lost.is_set())
+        self.assertIsNone(queue.claim('node-2', lease=0.2))
+
+        # a task claimed by another worker is lost
+        queue.release(task)
+        with LeaseKeeper(queue, task, lease=0.2, interval=0.05) as keeper:
+            queue.claim('node-2')
+            self.assertTrue(keeper.lost.wait(1))
+
+    def test_RetryQueue(self):
+        now = [0.0]
+        with tempfile.TemporaryDirectory() as d:
+            deadLetterPath = os.path.join(d, 'dead_letter.jsonl')
+            queue = RetryQueue(os.path.join(d, 'retry.json'), deadLetterPath, maxAttempts=3, baseDelay=1.0, maxDelay=4.0, clock=lambda: now[0])
+            queue.push('solr', 'add', 'a', {'docs': [{'id': 'a'}]}, 'timed out')
+            queue.push('solr', 'delete', 'b', {'id': 'b'})
+            queue.push('s3', 'put', 'a', {'key': 'a'})
+            self.assertEqual(len(queue), 3)
+
+            # nothing is due before the backoff delay has passed
+            self.assertTrue(all(queue.delay(n) <= 4.0 for n in range(10)))
+            now[0] = 4.0
+            self.assertEqual([e['id'] for e in queue.due('solr')], ['a', 'b'])
+
+            # a newer operation on "b" supersedes the queued one, but only for its target
+            queue.discard('solr', 'b')
+            queue.discard('solr', 'c')
+            self.assertEqual([(e['target'], e['id']) for e in queue.due()], [('solr', 'a'), ('s3', 'a')])
+
+            # entries are persisted
+            queue = RetryQueue(os.path.join(d, 'retry.json'), deadLetterPath, maxAttempts=3, baseDelay=1.0, maxDelay=4.0, clock=lambda: now[0])
+            solrEntry, s3Entry = queue.due()
+            queue.succeeded(s3Entry)
+            queue.failed(solrEntry, 'timed out again')
+            self.assertEqual(len(queue), 1)
+            self.assertFalse(os.path.exists(deadLetterPath))
+
+            now[0] = 8.0
+            entry = queue.due()[0]
+            self.assertEqual(entry['attempts'], 2)
+            queue.failed(entry, 'gave up')
+            self.assertEqual(len(queue), 0)
+            with open(deadLetterPath) as f:
+                deadLetters = [json.loads(line) for line in f]
+            self.assertEqual(len(deadLetters), 1)
+            self.assertEqual(deadLetters[0]['id'], 'a')
+            self.assertEqual(deadLetters[0]['attempts'], 3)
+            self.assertEqual(deadLetters[0]['error'], 'gave up')
+
+            # scheduled entries are due right away
+            queue.schedule('thumbnail', 'fetch', 'c', {'local_file': 'c.xml'})
+            self.assertEqual(queue.count('thumbnail'), 1)
+            self.assertEqual(queue.count('solr'), 0)
+            entry = queue.due('thumbnail')[0]
+            self.assertEqual(entry['attempts'], 0)
+            queue.failed(entry)
+            self.assertEqual(queue.due('thumbnail'), [])
+
+            # entries can be moved elsewhere
+            self.assertEqual([entry['id'] for entry in queue.take('thumbnail')], ['c'])
+            self.assertEqual(queue.count('thumbnail'), 0)
+
+    def test_ThumbnailJobQueue(self):
+        now = [0.0]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'thumbnail_jobs.sqlite')
+            deadLetterPath = os.path.join(d, 'dead_letter.jsonl')
+            queue = ThumbnailJobQueue(path, deadLetterPath, maxAttempts=2, baseDelay=1.0, maxDelay=4.0, clock=lambda: now[0])
+            queue.schedule('a', {'local_file': 'a.xml'})
+            queue.schedule('b', {'local_file': 'b.xml'})
+            queue.discard('c')
+            self.assertEqual([(job['id'], job['payload'], job['attempts']) for job in queue.due()], [('a', {'local_file': 'a.xml'}, 0), ('b', {'local_file': 'b.xml'}, 0)])
+
+            # a job that is replaced while it's being carried out isn't removed
+            a, b = queue.due()
+            queue.schedule('a', {'local_file': 'a2.xml'})
+            queue.succeeded(a)
+            queue.failed(b, 'timed out')
+            self.assertEqual([(job['id'], job['payload']) for job in queue.due()], [('a', {'local_file': 'a2.xml'})])
+            queue.discard('a')
+
+            # jobs are persisted, and given up on after too many attempts
+            queue.close()
+            queue = ThumbnailJobQueue(path, deadLetterPath, maxAttempts=2, baseDelay=1.0, maxDelay=4.0, clock=lambda: now[0])
+            now[0] = 4.0
+            b = queue.due()[0]
+            self.assertEqual(b['attempts'], 1)
+            queue.failed(b, 'gave up')
+            self.assertEqual(len(queue), 0)
+            with open(deadLetterPath) as f:
+                deadLetters = [json.loads(line) for line in f]
+            self.assertEqual([(job['id'], job['attempts'], job['error']) for job in deadLetters], [('b', 2, 'gave up')])
+
+            # adding and removing jobs doesn't get slower as the queue grows
+            started = time.time()
+            for i in range(4000):
+                queue.discard(str(i))
+                queue.schedule(str(i), {'local_file': '{}.xml'.format(i)})
+            self.assertLess(time.time() - started, 10)
+            self.assertEqual(len(queue), 4000)
+            queue.close()
+
 if __name__ == '__main__':
     unittest.main()